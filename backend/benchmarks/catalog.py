@@ -0,0 +1,85 @@
+"""Bulk catalog import benchmark
+
+Writes a synthetic catalog file, then times loading it the way the
+startup loader and POST /admin/catalog/import do - streamed parse, batch
+validation, one index build and the swap - and reports peak RSS:
+
+    python -m benchmarks.catalog --products 1000000
+    python -m benchmarks.catalog --products 1000000 --format csv
+"""
+from typing import List, Optional
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+WORDS = ["wireless", "keyboard", "monitor", "watch", "pro", "gaming", "usb", "desk", "lamp", "cable",
+         "charger", "stand", "mouse", "speaker", "camera", "trail", "shoe", "jacket", "bottle", "bag"]
+
+def _rss_mb(maxrss: int) -> float:
+    # ru_maxrss is bytes on macOS, KiB elsewhere
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+def write_catalog(path: str, products: int, fmt: str, seed_value: int):
+    rng = random.Random(seed_value)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer is not None:
+            writer.writerow(["id", "name", "price", "description", "image_url"])
+        for i in range(products):
+            name = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}"
+            row = [f"sku-{i}", name, round(rng.uniform(5, 500), 2),
+                   f"{' '.join(rng.sample(WORDS, 6))} item {i}", f"https://example.com/sku/{i}.jpg"]
+            if writer is not None:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(["id", "name", "price", "description", "image_url"], row))) + "\n")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=1_000_000)
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the generated catalog")
+    parser.add_argument("--file", help="Load this catalog instead of generating one")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from store.catalog_import import format_of, load_catalog, open_catalog
+    from store.memory_store import InMemoryStore
+
+    path, fmt = args.file, args.format
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), f"catalog.{fmt}")
+        started = time.perf_counter()
+        write_catalog(path, args.products, fmt, args.seed)
+        print(f"wrote {args.products:,} products to {path} in {time.perf_counter() - started:.1f}s")
+    else:
+        fmt = format_of(path)
+
+    memory_store = InMemoryStore()
+    baseline = _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    started = time.perf_counter()
+    with open_catalog(path) as stream:
+        loaded = load_catalog(stream, fmt)
+    swap_started = time.perf_counter()
+    asyncio.run(memory_store.replace_catalog(loaded.products, loaded.index))
+    swap_seconds = time.perf_counter() - swap_started
+    total = time.perf_counter() - started
+    peak = _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    print(f"python {platform.python_version()} on {platform.machine()}")
+    print(f"file:        {os.path.getsize(path) / 1e6:,.0f} MB {fmt}")
+    print(f"products:    {len(memory_store.products):,} loaded, {loaded.rejected} rejected")
+    print(f"load time:   {total:.1f}s ({len(loaded.products) / total:,.0f} products/s), swap {swap_seconds * 1000:.2f} ms")
+    print(f"peak RSS:    {peak:,.0f} MB ({peak - baseline:,.0f} MB above start)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
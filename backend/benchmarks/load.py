@@ -0,0 +1,396 @@
+"""Load and latency benchmark for the store API
+
+Drives a weighted mix of shopper and admin traffic against the ASGI app
+in-process, a local uvicorn server it starts itself, or any running
+server, then reports throughput and p50/p95/p99 latency per route plus
+peak RSS. Results are saved as JSON and can be compared against a
+previous run:
+
+    python -m benchmarks.load --target inprocess --output base.json
+    python -m benchmarks.load --target uvicorn --compare base.json
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import httpx
+
+DEFAULT_MIX = "browse=45,search=15,cart=20,checkout=10,checkout_discount=5,admin=5"
+SEARCH_TERMS = ["wireless", "keyboard", "monitor", "watch", "pro", "gaming", "bench", "usb"]
+
+# Seeding - runs in the process that serves the app
+
+async def seed(products: int, carts: int, orders: int, discount_codes: int, seed_value: int) -> List[str]:
+    """Fill the store to the requested sizes; returns the unused discount codes"""
+    from models.schemas import Cart, CartItem, DiscountCode, Order, Product
+    from store.backend import create_backend
+    from store.memory_store import store
+
+    rng = random.Random(seed_value)
+    # The catalog is per process; one bulk index build instead of an insert each
+    for i in range(products):
+        product = Product(id=f"bench-{i}", name=f"Bench {rng.choice(SEARCH_TERMS).title()} {i}",
+                          price=round(rng.uniform(5, 500), 2), description=f"Benchmark product {i}",
+                          image_url=f"https://example.com/bench/{i}.jpg")
+        store.products[product.id] = product
+    store.catalog_index.rebuild(store.products.values())
+    store.catalog_version += 1
+    product_ids = list(store.products)
+
+    # Carts, orders and codes go through the configured backend so a shared
+    # STORE_BACKEND is seeded too
+    backend = create_backend(os.environ.get("STORE_BACKEND"))
+    try:
+        for i in range(carts):
+            items = [CartItem(product_id=product_id, quantity=rng.randint(1, 3))
+                     for product_id in rng.sample(product_ids, rng.randint(1, 3))]
+            await backend.create_cart(Cart(id=f"bench-cart-{i}", items=items, created_at=datetime.now()))
+
+        start = datetime.now() - timedelta(days=30)
+        step = timedelta(days=30) / max(orders, 1)
+        for i in range(orders):
+            await backend.next_order_number()
+            items = [CartItem(product_id=product_id, quantity=rng.randint(1, 3))
+                     for product_id in rng.sample(product_ids, rng.randint(1, 3))]
+            subtotal = sum(store.products[item.product_id].price * item.quantity for item in items)
+            await backend.add_order(Order(id=f"bench-order-{i}", cart_id=f"bench-done-{i}", items=items,
+                                          subtotal=subtotal, discount_amount=0, total=subtotal,
+                                          created_at=start + step * i))
+
+        codes = [f"BENCH-{seed_value}-{i}" for i in range(discount_codes)]
+        for code in codes:
+            await backend.add_discount_code(DiscountCode(code=code, order_number=0, is_used=False,
+                                                         created_at=datetime.now()))
+        await backend.commit()
+    finally:
+        if os.environ.get("STORE_BACKEND"):
+            await backend.close()
+    return codes
+
+# Traffic
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.statuses: Dict[int, int] = {}
+        self.enabled = False
+
+    async def request(self, client: httpx.AsyncClient, method: str, route: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - started
+        if self.enabled:
+            label = f"{method} {route}"
+            self.latencies.setdefault(label, []).append(elapsed)
+            self.statuses[response.status_code] = self.statuses.get(response.status_code, 0) + 1
+            if response.status_code >= 400:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        return response
+
+class Traffic:
+    """Shopper and admin scenarios, each a short sequence of requests"""
+
+    def __init__(self, recorder: Recorder, product_ids: List[str], discount_codes: List[str]):
+        self.recorder = recorder
+        self.product_ids = product_ids
+        self.discount_codes = discount_codes
+
+    async def browse(self, client, rng):
+        await self.recorder.request(client, "GET", "/products", "/products")
+        product_id = rng.choice(self.product_ids)
+        await self.recorder.request(client, "GET", "/products/{id}", f"/products/{product_id}")
+
+    async def search(self, client, rng):
+        params = {"q": rng.choice(SEARCH_TERMS), "sort": rng.choice(["relevance", "price_asc", "name"])}
+        await self.recorder.request(client, "GET", "/products/search", "/products/search", params=params)
+
+    async def _filled_cart(self, client, rng, lines: int) -> Optional[str]:
+        response = await self.recorder.request(client, "POST", "/cart", "/cart")
+        if response.status_code != 200:
+            return None
+        cart_id = response.json()["id"]
+        for product_id in rng.sample(self.product_ids, lines):
+            await self.recorder.request(client, "POST", "/cart/{id}/items", f"/cart/{cart_id}/items",
+                                        json={"product_id": product_id, "quantity": rng.randint(1, 3)})
+        return cart_id
+
+    async def cart(self, client, rng):
+        cart_id = await self._filled_cart(client, rng, 2)
+        if cart_id is None:
+            return
+        cart = await self.recorder.request(client, "GET", "/cart/{id}", f"/cart/{cart_id}")
+        product_id = cart.json()["items"][0]["product_id"]
+        await self.recorder.request(client, "PUT", "/cart/{id}/items/{product_id}",
+                                    f"/cart/{cart_id}/items/{product_id}", params={"quantity": rng.randint(1, 5)})
+
+    async def checkout(self, client, rng, discount_code: Optional[str] = None):
+        cart_id = await self._filled_cart(client, rng, rng.randint(1, 3))
+        if cart_id is None:
+            return
+        body = {"cart_id": cart_id}
+        if discount_code is not None:
+            body["discount_code"] = discount_code
+        await self.recorder.request(client, "POST", "/checkout", "/checkout", json=body)
+
+    async def checkout_discount(self, client, rng):
+        # Each seeded code is spent once; plain checkout once they run out
+        await self.checkout(client, rng, self.discount_codes.pop() if self.discount_codes else None)
+
+    async def admin(self, client, rng):
+        await self.recorder.request(client, "GET", "/admin/statistics", "/admin/statistics")
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name.startswith("_") or not callable(getattr(Traffic, name, None)):
+            raise ValueError(f"Unknown scenario: {name}")
+        weights[name] = float(weight)
+    return weights
+
+async def drive(client: httpx.AsyncClient, traffic: Traffic, mix: Dict[str, float],
+                iterations: int, concurrency: int, seed_value: int) -> float:
+    """Run iterations scenarios over concurrency workers; returns elapsed seconds"""
+    names, weights = list(mix), list(mix.values())
+    remaining = iterations
+
+    async def worker(worker_id: int):
+        nonlocal remaining
+        rng = random.Random(seed_value * 1000 + worker_id)
+        while remaining > 0:
+            remaining -= 1
+            scenario = rng.choices(names, weights)[0]
+            await getattr(traffic, scenario)(client, rng)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return time.perf_counter() - started
+
+# Reporting
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    routes = {}
+    for label, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        routes[label] = {
+            "count": len(values),
+            "errors": recorder.errors.get(label, 0),
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "mean_ms": round(sum(values) / len(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    total = sum(route["count"] for route in routes.values())
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(recorder.errors.values()),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "status_codes": {str(code): count for code, count in sorted(recorder.statuses.items())},
+        "routes": routes,
+    }
+
+def peak_rss_bytes(pid: Optional[int] = None) -> Optional[int]:
+    """Peak resident set size of a process (default: this one)"""
+    if pid is None:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "git_commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+    }
+
+def print_report(result: dict):
+    summary = result["summary"]
+    print(f"{result['config']['target']}: {summary['requests']} requests in {summary['elapsed_s']}s "
+          f"({summary['throughput_rps']} req/s, {summary['errors']} errors)")
+    print(f"{'route':40} {'count':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, route in summary["routes"].items():
+        print(f"{label:40} {route['count']:>7} {route['throughput_rps']:>9} "
+              f"{route['p50_ms']:>9} {route['p95_ms']:>9} {route['p99_ms']:>9}")
+    for name, value in result["peak_rss_bytes"].items():
+        if value is not None:
+            print(f"peak RSS ({name}): {value / (1 << 20):.1f} MiB")
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Routes whose p95 latency regressed by more than tolerance (a fraction)"""
+    regressions = []
+    if baseline["config"]["target"] != result["config"]["target"]:
+        print(f"\nwarning: baseline ran against {baseline['config']['target']!r}, "
+              f"this run against {result['config']['target']!r}")
+    print(f"\n{'route':40} {'p95 base':>10} {'p95 now':>10} {'change':>8}")
+    for label, route in result["summary"]["routes"].items():
+        base = baseline["summary"]["routes"].get(label)
+        if base is None or not base["p95_ms"]:
+            continue
+        change = route["p95_ms"] / base["p95_ms"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(label)
+            flag = "  REGRESSION"
+        print(f"{label:40} {base['p95_ms']:>10} {route['p95_ms']:>10} {change:>+7.0%}{flag}")
+    return regressions
+
+# Targets
+
+async def run_inprocess(args, traffic_for) -> dict:
+    from main import app
+
+    codes = await seed(args.products, args.carts, args.orders, args.discount_codes, args.seed)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return await run_traffic(client, args, traffic_for(codes))
+
+async def run_http(args, base_url: str, codes: List[str], traffic_for) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        return await run_traffic(client, args, traffic_for(codes))
+
+async def run_traffic(client: httpx.AsyncClient, args, traffic: Traffic) -> dict:
+    response = await client.get("/products")
+    traffic.product_ids = [product["id"] for product in response.json()]
+    mix = parse_mix(args.mix)
+    await drive(client, traffic, mix, args.warmup, args.concurrency, args.seed + 1)
+    traffic.recorder.enabled = True
+    elapsed = await drive(client, traffic, mix, args.iterations, args.concurrency, args.seed)
+    return summarize(traffic.recorder, elapsed)
+
+def start_server(args) -> subprocess.Popen:
+    command = [sys.executable, "-m", "benchmarks.load", "--serve", str(args.port),
+               "--products", str(args.products), "--carts", str(args.carts), "--orders", str(args.orders),
+               "--discount-codes", str(args.discount_codes), "--seed", str(args.seed)]
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(command, cwd=backend_dir)
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Benchmark server exited during startup")
+        try:
+            if httpx.get(f"{base_url}/products", timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Benchmark server did not become ready")
+
+def serve(args):
+    """Seed this process, then serve the app with uvicorn"""
+    import uvicorn
+
+    from main import app
+
+    # The driver derives the same discount codes from the seed
+    asyncio.run(seed(args.products, args.carts, args.orders, args.discount_codes, args.seed))
+    uvicorn.run(app, host="127.0.0.1", port=args.serve, log_level="warning")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="inprocess",
+                        help="'inprocess', 'uvicorn' (start a local server) or a base URL")
+    parser.add_argument("--iterations", type=int, default=2000, help="Scenarios to run (after warm-up)")
+    parser.add_argument("--warmup", type=int, default=200, help="Unrecorded scenarios run first")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Scenario weights, e.g. browse=1,checkout=1")
+    parser.add_argument("--products", type=int, default=1000, help="Extra products to seed")
+    parser.add_argument("--carts", type=int, default=1000, help="Carts to seed")
+    parser.add_argument("--orders", type=int, default=10000, help="Orders to seed")
+    parser.add_argument("--discount-codes", type=int, default=1000, help="Unused codes to seed")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for data and traffic")
+    parser.add_argument("--port", type=int, default=8765, help="Port for --target uvicorn")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.20,
+                        help="Allowed p95 slowdown per route before --compare fails")
+    parser.add_argument("--admission", action="store_true",
+                        help="Keep admission control on; the driver is a single client, so its rate limits apply")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # Inherited by --target uvicorn's server process
+    if not args.admission:
+        os.environ.setdefault("ADMISSION_CONTROL", "off")
+
+    if args.serve is not None:
+        serve(args)
+        return 0
+
+    parse_mix(args.mix)
+    recorder = Recorder()
+    traffic_for = lambda codes: Traffic(recorder, [], list(codes))
+    server_pid = None
+    if args.target == "inprocess":
+        summary = asyncio.run(run_inprocess(args, traffic_for))
+    elif args.target == "uvicorn":
+        base_url = f"http://127.0.0.1:{args.port}"
+        process = start_server(args)
+        try:
+            wait_until_ready(base_url, process)
+            codes = [f"BENCH-{args.seed}-{i}" for i in range(args.discount_codes)]
+            summary = asyncio.run(run_http(args, base_url, codes, traffic_for))
+            server_pid = process.pid
+            server_rss = peak_rss_bytes(server_pid)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    else:
+        # Someone else's server - it was seeded (or not) by whoever started it
+        summary = asyncio.run(run_http(args, args.target.rstrip("/"), [], traffic_for))
+
+    rss = {"driver": peak_rss_bytes()}
+    if server_pid is not None:
+        rss["server"] = server_rss
+    result = {"config": vars(args), "environment": environment(), "summary": summary, "peak_rss_bytes": rss}
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
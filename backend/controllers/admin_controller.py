@@ -1,13 +1,69 @@
-from fastapi import APIRouter
-from services.business_logic import AdminService
+from datetime import datetime
+from fastapi import APIRouter, Header, Query, Request
+from typing import Literal, Optional
+from models.schemas import AnalyticsReport, DiscountCodePage, StockLevel
+from services.business_logic import AdminService, CatalogService, DiscountCodeService, InventoryService
+from services.compression import versioned_response
+from services.metrics import InstrumentedRoute
+from services.serialized import make_etag
+import json
 
 # Admin endpoints - statistics and discount management
-router = APIRouter(prefix="/admin", tags=["Admin"])
+router = APIRouter(prefix="/admin", tags=["Admin"], route_class=InstrumentedRoute)
 
 @router.post("/generate-discount")
 async def generate_discount_code():
     return await AdminService.generate_discount_code()
 
+# Keyed by a hash of the payload, so repeated polls between orders reuse
+# the compressed bytes and can revalidate with If-None-Match
 @router.get("/statistics")
-async def get_statistics():
-    return await AdminService.get_statistics()
+async def get_statistics(if_none_match: Optional[str] = Header(None),
+                         accept_encoding: Optional[str] = Header(None)):
+    body = json.dumps(await AdminService.get_statistics(), separators=(",", ":")).encode()
+    return versioned_response(body, make_etag(body), if_none_match, accept_encoding)
+
+# Revenue, units and discounts per hour or day, optionally per product
+@router.get("/analytics", response_model=AnalyticsReport)
+async def get_analytics(
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    granularity: Literal["hour", "day"] = "day",
+    group_by: Optional[Literal["product"]] = None
+):
+    return await AdminService.get_analytics(start, end, granularity, group_by)
+
+# Codes in creation order, a page at a time - optionally only used, unused or expired ones
+@router.get("/discount-codes", response_model=DiscountCodePage)
+async def list_discount_codes(
+    status: Optional[Literal["used", "unused", "expired"]] = None,
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    return await DiscountCodeService.list_codes(status, limit, cursor)
+
+# Runs periodically anyway; useful after changing retention
+@router.post("/discount-codes/compact")
+async def compact_discount_codes():
+    return await DiscountCodeService.compact()
+
+@router.get("/carts")
+async def get_cart_metrics():
+    return await AdminService.get_cart_metrics()
+
+# Set a product's stock level; null on_hand stops tracking it
+@router.put("/inventory/{product_id}")
+async def set_stock(product_id: str, level: StockLevel):
+    return await InventoryService.set_stock(product_id, level.on_hand)
+
+# Bulk catalog load from a JSON Lines or CSV request body. replace makes the
+# file the whole catalog, merge adds and updates products; either way the
+# new catalog is swapped in at once. Refused (409) with several workers,
+# since it would update only the one handling it.
+@router.post("/catalog/import")
+async def import_catalog(
+    request: Request,
+    fmt: Literal["jsonl", "csv"] = Query("jsonl", alias="format"),
+    mode: Literal["replace", "merge"] = "replace"
+):
+    return await CatalogService.import_upload(request.stream(), fmt, mode)
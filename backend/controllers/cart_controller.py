@@ -1,9 +1,10 @@
 from fastapi import APIRouter
-from models.schemas import Cart, CartItem
+from models.schemas import Cart, CartItem, CartBatchRequest
 from services.business_logic import CartService
+from services.metrics import InstrumentedRoute
 
 # Shopping cart endpoints - create, update, remove items
-router = APIRouter(prefix="/cart", tags=["Cart"])
+router = APIRouter(prefix="/cart", tags=["Cart"], route_class=InstrumentedRoute)
 
 @router.post("", response_model=Cart)
 async def create_cart():
@@ -24,3 +25,8 @@ async def update_cart_item_quantity(cart_id: str, product_id: str, quantity: int
 @router.delete("/{cart_id}/items/{product_id}")
 async def remove_from_cart(cart_id: str, product_id: str):
     return await CartService.remove_item_from_cart(cart_id, product_id)
+
+# Apply many add/update/remove operations atomically in one request
+@router.post("/{cart_id}/items:batch")
+async def apply_cart_batch(cart_id: str, batch: CartBatchRequest):
+    return await CartService.apply_batch(cart_id, batch)
@@ -1,18 +1,39 @@
-from fastapi import APIRouter
-from typing import List
-from models.schemas import Order, CheckoutRequest
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import datetime
+from models.schemas import Order, OrderPage, CheckoutRequest
 from services.business_logic import CheckoutService, OrderService
+from services.metrics import InstrumentedRoute
 
 # Checkout and order history endpoints
-router = APIRouter(tags=["Checkout & Orders"])
+router = APIRouter(tags=["Checkout & Orders"], route_class=InstrumentedRoute)
 
+# Retries carrying the same Idempotency-Key get the original order back
 @router.post("/checkout", response_model=Order)
-async def checkout(request: CheckoutRequest):
-    return await CheckoutService.process_checkout(request)
+async def checkout(request: CheckoutRequest, idempotency_key: Optional[str] = Header(None)):
+    return await CheckoutService.process_checkout(request, idempotency_key)
 
-@router.get("/orders", response_model=List[Order])
-async def get_orders():
-    return await OrderService.get_all_orders()
+# cart_id and product_id filters use secondary indexes, not a scan
+@router.get("/orders", response_model=OrderPage)
+async def get_orders(
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    cart_id: Optional[str] = None,
+    product_id: Optional[str] = None
+):
+    return await OrderService.get_orders_page(limit, cursor, created_from, created_to, cart_id, product_id)
+
+# Streams every matching order as NDJSON - memory stays flat
+@router.get("/orders/export")
+async def export_orders(created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                        cart_id: Optional[str] = None, product_id: Optional[str] = None):
+    return StreamingResponse(
+        OrderService.export_orders(created_from, created_to, cart_id, product_id),
+        media_type="application/x-ndjson"
+    )
 
 @router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str):
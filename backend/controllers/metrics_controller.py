@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from services.business_logic import MetricsService
+from services.metrics import InstrumentedRoute
+
+# Prometheus scrape endpoint
+router = APIRouter(tags=["Metrics"], route_class=InstrumentedRoute)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(await MetricsService.render_metrics(), media_type="text/plain; version=0.0.4")
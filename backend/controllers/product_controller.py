@@ -1,15 +1,48 @@
-from fastapi import APIRouter
-from typing import List
-from models.schemas import Product
-from services.business_logic import ProductService
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from typing import List, Literal, Optional
+from models.schemas import Availability, Product, ProductListing, ProductSearchResult
+from services.business_logic import InventoryService, ProductService
+from services.compression import versioned_response
+from services.metrics import InstrumentedRoute
+from services.serialized import serialized_catalog
 
 # Product endpoints - all operations are cached
-router = APIRouter(prefix="/products", tags=["Products"])
+router = APIRouter(prefix="/products", tags=["Products"], route_class=InstrumentedRoute)
 
-@router.get("", response_model=List[Product])
-async def get_products():
-    return await ProductService.get_all_products()
+# Served from pre-serialised, pre-compressed bytes - no per-request
+# validation, encoding or compression. include=availability adds free
+# units per product; that variant changes with every cart, so it is
+# encoded per request and carries no ETag.
+@router.get("", response_model=List[ProductListing])
+async def get_products(include: Optional[Literal["availability"]] = None,
+                       if_none_match: Optional[str] = Header(None),
+                       accept_encoding: Optional[str] = Header(None)):
+    if include == "availability":
+        return Response(content=await ProductService.list_with_availability(), media_type="application/json")
+    body, etag = serialized_catalog.catalog()
+    return versioned_response(body, etag, if_none_match, accept_encoding)
+
+# Indexed catalog query - search, price range, sort and pagination
+@router.get("/search", response_model=ProductSearchResult)
+async def search_products(
+    q: Optional[str] = Query(None, max_length=200),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    sort: Literal["relevance", "price_asc", "price_desc", "name"] = "relevance",
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    return await ProductService.search_products(q, min_price, max_price, sort, offset, limit)
+
+# Stock on hand, held by carts and free, for every tracked product
+@router.get("/availability", response_model=List[Availability])
+async def get_availability():
+    return await InventoryService.get_availability()
 
 @router.get("/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    return await ProductService.get_product_by_id(product_id)
+async def get_product(product_id: str, if_none_match: Optional[str] = Header(None),
+                      accept_encoding: Optional[str] = Header(None)):
+    entry = serialized_catalog.product(product_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return versioned_response(entry[0], entry[1], if_none_match, accept_encoding)
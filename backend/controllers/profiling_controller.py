@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from services.metrics import InstrumentedRoute
+from services.profiling import ProfilerBusy, format_collapsed, profiler
+
+def require_profiling_token(x_profiling_token: Optional[str] = Header(None)):
+    # Hidden entirely unless PROFILING_TOKEN is configured
+    if profiler.token is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not profiler.authorized(x_profiling_token):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+# On-demand CPU and allocation profiling - admin only
+router = APIRouter(prefix="/admin/profiling", tags=["Profiling"], route_class=InstrumentedRoute,
+                   dependencies=[Depends(require_profiling_token)])
+
+# Collapsed stacks (one "frame;frame;frame samples" line each) for flamegraphs
+@router.post("/cpu", response_class=PlainTextResponse)
+async def profile_cpu(seconds: float = Query(10.0, gt=0, le=120),
+                      interval_ms: float = Query(5.0, ge=1, le=1000)):
+    try:
+        samples = await profiler.sample_cpu(seconds, interval_ms / 1000)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    return PlainTextResponse(format_collapsed(samples))
+
+@router.post("/allocations")
+async def profile_allocations(seconds: float = Query(10.0, gt=0, le=120),
+                              limit: int = Query(25, ge=1, le=500),
+                              frames: int = Query(16, ge=1, le=100)):
+    try:
+        return await profiler.trace_allocations(seconds, limit, frames)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+
+# Profiles of requests sent with an "X-Profile: <token>" header
+@router.get("/requests")
+async def list_request_profiles():
+    return {"profile_ids": list(profiler.request_profiles)}
+
+@router.get("/requests/{profile_id}", response_class=PlainTextResponse)
+async def get_request_profile(profile_id: str):
+    stacks = profiler.request_profiles.get(profile_id)
+    if stacks is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(format_collapsed(stacks))
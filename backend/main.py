@@ -2,19 +2,115 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
-from controllers import product_controller, cart_controller, checkout_controller, admin_controller
+from contextlib import asynccontextmanager
+from controllers import product_controller, cart_controller, checkout_controller, admin_controller, metrics_controller, profiling_controller
+from services.admission import AdmissionMiddleware, admission
+from services.business_logic import CartService, CatalogService, CheckoutService, DiscountCodeService, InventoryService
+from services.cache import ttl_cache
+from services.events import event_bus
+from services.idempotency import idempotency_results
+from services.metrics import InstrumentedRoute
+from services.profiling import profiler
+from store.backend import configure_storage, create_backend, get_storage
+from store.memory_store import store
+from typing import Optional
+import asyncio
+import os
 import time
 
+def worker_config_error(workers: int) -> Optional[str]:
+    """Why this environment cannot run with several workers, if it can't"""
+    if workers <= 1:
+        return None
+    # Per-process state would give every worker its own carts and orders
+    if os.environ.get("STORE_BACKEND", "memory") == "memory":
+        return "WEB_CONCURRENCY > 1 needs a shared STORE_BACKEND, e.g. sqlite:///store.db"
+    # Workers would rotate and delete each other's WAL segments and snapshots
+    if os.environ.get("STORE_DATA_DIR"):
+        return "STORE_DATA_DIR cannot be shared by several workers - unset it with WEB_CONCURRENCY > 1"
+    return None
+
+# Background maintenance tasks run for the lifetime of the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Also checked here for workers started by the uvicorn CLI, which reads WEB_CONCURRENCY too
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    error = worker_config_error(workers)
+    if error:
+        raise RuntimeError(error)
+    # Each worker holds its own catalog - uploads would update just one
+    CatalogService.accept_uploads = workers <= 1
+    
+    tasks = [
+        asyncio.create_task(ttl_cache.run_sweeper(interval=30)),
+        asyncio.create_task(CartService.run_cart_reaper(interval=60)),
+        asyncio.create_task(idempotency_results.run_sweeper(interval=60)),
+        asyncio.create_task(CheckoutService.run_idempotency_sweeper(interval=600)),
+        asyncio.create_task(InventoryService.run_reservation_sweeper(interval=30)),
+        asyncio.create_task(DiscountCodeService.run_compactor(interval=600)),
+    ]
+    
+    # Durable mode - recover from and log to STORE_DATA_DIR when set
+    data_dir = os.environ.get("STORE_DATA_DIR")
+    if data_dir:
+        store.open_wal(data_dir)
+        store.wal.start()
+        snapshot_interval = float(os.environ.get("STORE_SNAPSHOT_INTERVAL", "300"))
+        tasks.append(asyncio.create_task(store.run_snapshotter(interval=snapshot_interval)))
+    
+    # Bulk catalog - CATALOG_FILE (JSON Lines or CSV, optionally gzipped) replaces the sample products
+    catalog_file = os.environ.get("CATALOG_FILE")
+    if catalog_file:
+        await CatalogService.load_file(catalog_file)
+    
+    # Shared mode - carts, orders and codes live in a backend every worker sees
+    storage_url = os.environ.get("STORE_BACKEND")
+    if storage_url:
+        configure_storage(create_backend(storage_url))
+    # Profiling endpoints and X-Profile requests stay disabled without a token
+    profiler.token = os.environ.get("PROFILING_TOKEN") or None
+    # Priority queueing, per-client rate limits and load shedding; ADMISSION_CONTROL=off disables
+    admission.enabled = os.environ.get("ADMISSION_CONTROL", "on") != "off"
+    admission.max_concurrency = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", admission.max_concurrency))
+    
+    # Codes owed to orders whose handler never ran (a crash or kill)
+    await CheckoutService.issue_pending_codes()
+    # Post-checkout side effects run on worker tasks from here on
+    event_bus.start()
+    
+    yield
+    # Drained first - handlers still write to the storage closed below
+    await event_bus.stop()
+    profiler.token = None
+    admission.enabled = False
+    CatalogService.accept_uploads = True
+    for task in tasks:
+        task.cancel()
+    if storage_url:
+        await get_storage().close()
+        configure_storage(None)
+    if store.wal is not None:
+        await store.wal.stop()
+        await store.snapshot()
+        store.wal.close()
+        store.wal = None
+
 app = FastAPI(
     title="Ecommerce Store API",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
+# Per-route latency and status metrics for routes declared on the app
+app.router.route_class = InstrumentedRoute
 
 # GZip compression - 60-70% smaller responses
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
+# Admission control - sheds and rate limits before any route work is done
+app.add_middleware(AdmissionMiddleware)
+
 # CORS - allow frontend to call API
 app.add_middleware(
     CORSMiddleware,
@@ -24,12 +120,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Performance timing - adds X-Process-Time header (in ms)
+# Performance timing - adds X-Process-Time header (in ms), on a monotonic clock
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
+    start_time = time.perf_counter()
     response = await call_next(request)
-    process_time = time.time() - start_time
+    process_time = time.perf_counter() - start_time
     response.headers["X-Process-Time"] = str(round(process_time * 1000, 2))
     return response
 
@@ -37,6 +133,8 @@ app.include_router(product_controller.router)
 app.include_router(cart_controller.router)
 app.include_router(checkout_controller.router)
 app.include_router(admin_controller.router)
+app.include_router(metrics_controller.router)
+app.include_router(profiling_controller.router)
 
 @app.get("/")
 async def read_root():
@@ -49,10 +147,15 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    error = worker_config_error(workers)
+    if error:
+        raise SystemExit(error)
     uvicorn.run(
-        app,
+        "main:app" if workers > 1 else app,
         host="0.0.0.0",
         port=8000,
+        workers=workers,
         log_level="info",
         access_log=True
     )
\ No newline at end of file
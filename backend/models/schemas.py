@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, ConfigDict, field_validator
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, PrivateAttr, field_validator
+from typing import Dict, List, Literal, Optional
 from datetime import datetime
 
 # Pydantic models with validation and auto-generated API docs
@@ -25,6 +25,24 @@ class Product(BaseModel):
         }
     )
 
+class ProductSearchResult(BaseModel):
+    items: List[Product] = Field(..., description="Products in this page")
+    total: int = Field(..., description="Total products matching the query")
+    offset: int = Field(..., description="Index of the first returned product")
+    limit: int = Field(..., description="Maximum products per page")
+
+class ProductListing(Product):
+    available: Optional[int] = Field(None, description="Units free to add to a cart; null if stock is not tracked")
+
+class Availability(BaseModel):
+    product_id: str = Field(..., description="Tracked product")
+    on_hand: int = Field(..., description="Units in stock")
+    reserved: int = Field(..., description="Units held by carts")
+    available: int = Field(..., description="Units free to add to a cart")
+
+class StockLevel(BaseModel):
+    on_hand: Optional[int] = Field(..., ge=0, description="Units in stock; null stops tracking the product")
+
 class CartItem(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     
@@ -44,6 +62,47 @@ class Cart(BaseModel):
     id: str = Field(..., description="Unique cart identifier")
     items: List[CartItem] = Field(default_factory=list, description="Cart items")
     created_at: datetime = Field(..., description="Cart creation timestamp")
+    
+    # Lines keyed by product_id - the source of truth for mutations.
+    # items is rebuilt from it (in insertion order) only when the cart is read.
+    _lines: Dict[str, CartItem] = PrivateAttr(default_factory=dict)
+    _items_stale: bool = PrivateAttr(default=False)
+    # The stored state this cart was read from, as the backend records it -
+    # save_cart only writes over that same state
+    _revision: Optional[str] = PrivateAttr(default=None)
+    
+    def model_post_init(self, __context) -> None:
+        self._lines = {item.product_id: item for item in self.items}
+    
+    @property
+    def lines(self) -> Dict[str, CartItem]:
+        return self._lines
+    
+    def set_quantity(self, product_id: str, quantity: int) -> None:
+        line = self._lines.get(product_id)
+        if line is None:
+            self._lines[product_id] = CartItem(product_id=product_id, quantity=quantity)
+        else:
+            line.quantity = quantity
+        self._items_stale = True
+    
+    def remove_line(self, product_id: str) -> None:
+        if self._lines.pop(product_id, None) is not None:
+            self._items_stale = True
+    
+    def sync_items(self) -> "Cart":
+        if self._items_stale:
+            self.items = list(self._lines.values())
+            self._items_stale = False
+        return self
+
+class CartOperation(BaseModel):
+    op: Literal["add", "update", "remove"] = Field(..., description="Operation to apply")
+    product_id: str = Field(..., description="Product ID the operation targets")
+    quantity: Optional[int] = Field(None, description="Quantity to add (add) or set (update, 0 removes)")
+
+class CartBatchRequest(BaseModel):
+    operations: List[CartOperation] = Field(..., min_length=1, max_length=1000, description="Operations applied in order")
 
 class CheckoutRequest(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -63,6 +122,11 @@ class Order(BaseModel):
     discount_code_used: Optional[str] = Field(None, description="Discount code used")
     created_at: datetime = Field(..., description="Order creation timestamp")
 
+class OrderPage(BaseModel):
+    items: List[Order] = Field(..., description="Orders in this page, oldest first")
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page, null on the last page")
+    limit: int = Field(..., description="Maximum orders per page")
+
 class DiscountCode(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     
@@ -70,3 +134,23 @@ class DiscountCode(BaseModel):
     order_number: int = Field(..., description="Order number that triggered generation")
     is_used: bool = Field(..., description="Whether code has been used")
     created_at: datetime = Field(..., description="Code creation timestamp")
+    expires_at: Optional[datetime] = Field(None, description="When the code stops being accepted, null for never")
+    used_at: Optional[datetime] = Field(None, description="When the code was spent")
+
+class DiscountCodePage(BaseModel):
+    items: List[DiscountCode] = Field(..., description="Codes in this page, oldest first")
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page, null on the last page")
+    limit: int = Field(..., description="Maximum codes per page")
+
+class AnalyticsBucket(BaseModel):
+    start: datetime = Field(..., description="Bucket start (UTC)")
+    product_id: Optional[str] = Field(None, description="Product, when grouped by product")
+    revenue: float = Field(..., description="Revenue after discounts")
+    units: int = Field(..., description="Units sold")
+    discount: float = Field(..., description="Discount given")
+    orders: int = Field(..., description="Orders placed (containing the product, when grouped)")
+
+class AnalyticsReport(BaseModel):
+    granularity: Literal["hour", "day"] = Field(..., description="Bucket width")
+    group_by: Optional[Literal["product"]] = Field(None, description="Grouping within each bucket")
+    buckets: List[AnalyticsBucket] = Field(..., description="Non-empty buckets, oldest first")
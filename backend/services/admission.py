@@ -0,0 +1,199 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+from fastapi.responses import JSONResponse
+import asyncio
+import math
+import time
+
+# Admission control in front of the routes. Each request is put in a
+# route class; classes share a pool of concurrency slots, and a freed
+# slot goes to the most important class with someone waiting. A request
+# that would queue longer than its class's target is turned away at once
+# with a 503 rather than adding to the pile, and each client is rate
+# limited per class with a token bucket (429). Limits are per process.
+
+@dataclass(frozen=True)
+class RouteClass:
+    name: str
+    # Lower runs first when slots are scarce
+    priority: int
+    # Most requests of this class in flight at once
+    max_concurrency: int
+    # Longest queueing delay (seconds) before requests are shed
+    queue_target: float
+    # Per-client token bucket: requests per second and burst size
+    rate: float
+    burst: float
+
+DEFAULT_CLASSES = (
+    RouteClass("checkout", priority=0, max_concurrency=64, queue_target=0.5, rate=10.0, burst=30.0),
+    RouteClass("browse", priority=1, max_concurrency=48, queue_target=0.25, rate=50.0, burst=100.0),
+    RouteClass("admin", priority=2, max_concurrency=4, queue_target=0.1, rate=5.0, burst=10.0),
+)
+
+# Path prefix -> route class; anything else (health, metrics, docs) bypasses admission
+ROUTE_PREFIXES = (("/checkout", "checkout"), ("/cart", "checkout"),
+                  ("/products", "browse"), ("/orders", "browse"), ("/admin", "admin"))
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+class TokenBuckets:
+    """Per-client token buckets, least recently seen clients dropped first"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> [tokens, last refill time]
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def take(self, client: str, now: float) -> float:
+        """Spend a token; returns 0 if one was available, else seconds until one is"""
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = [self.burst, now]
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+class ClassState:
+    """Queue and counters for one route class"""
+
+    def __init__(self, route_class: RouteClass):
+        self.route_class = route_class
+        self.buckets = TokenBuckets(route_class.rate, route_class.burst)
+        # (enqueued at, future resolved when a slot is granted)
+        self.waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+
+    def queue_delay(self, now: float) -> float:
+        """How long the request at the head of the queue has waited"""
+        while self.waiters and self.waiters[0][1].done():
+            self.waiters.popleft()
+        return now - self.waiters[0][0] if self.waiters else 0.0
+
+class AdmissionController:
+    def __init__(self, classes: Tuple[RouteClass, ...] = DEFAULT_CLASSES, max_concurrency: int = 64):
+        # Off until the app lifespan turns it on (ADMISSION_CONTROL)
+        self.enabled = False
+        self.max_concurrency = max_concurrency
+        self.configure(classes)
+
+    def configure(self, classes: Tuple[RouteClass, ...]):
+        self.classes: Dict[str, ClassState] = {route_class.name: ClassState(route_class) for route_class in classes}
+        self._by_priority = sorted(self.classes.values(), key=lambda state: state.route_class.priority)
+        self.in_flight = 0
+
+    def classify(self, path: str) -> Optional[ClassState]:
+        for prefix, name in ROUTE_PREFIXES:
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.classes.get(name)
+        return None
+
+    def _has_slot(self, state: ClassState) -> bool:
+        return self.in_flight < self.max_concurrency and state.in_flight < state.route_class.max_concurrency
+
+    def _grant(self, state: ClassState):
+        self.in_flight += 1
+        state.in_flight += 1
+        state.admitted += 1
+
+    async def acquire(self, state: ClassState, client: str):
+        """Take a slot for one request of state's class, or raise Rejected"""
+        route_class = state.route_class
+        now = time.monotonic()
+        retry_after = state.buckets.take(client, now)
+        if retry_after:
+            state.rate_limited += 1
+            raise Rejected(429, retry_after, "Too many requests")
+
+        # Nobody more important is waiting - run straight away
+        if self._has_slot(state) and not any(
+                other.waiters for other in self._by_priority if other.route_class.priority <= route_class.priority):
+            self._grant(state)
+            return
+
+        # Shed early: the queue is already slower than the target
+        if state.queue_delay(now) >= route_class.queue_target:
+            state.shed += 1
+            raise Rejected(503, route_class.queue_target, "Server busy, please retry")
+
+        future = asyncio.get_running_loop().create_future()
+        state.waiters.append((now, future))
+        state.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), route_class.queue_target)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                state.shed += 1
+                raise Rejected(503, route_class.queue_target, "Server busy, please retry")
+        except asyncio.CancelledError:
+            # The slot may have been granted just as the client went away
+            if future.done() and not future.cancelled():
+                self.release(state)
+            else:
+                future.cancel()
+            raise
+        state.wait_seconds += time.monotonic() - now
+
+    def release(self, state: ClassState):
+        self.in_flight -= 1
+        state.in_flight -= 1
+        # Hand freed slots to waiters, most important class first
+        for waiting in self._by_priority:
+            while waiting.waiters and self._has_slot(waiting):
+                _, future = waiting.waiters.popleft()
+                if not future.done():
+                    self._grant(waiting)
+                    future.set_result(None)
+
+admission = AdmissionController()
+
+class AdmissionMiddleware:
+    """ASGI middleware applying admission control
+
+    A slot is held until the response body has been sent, streamed
+    exports included.
+    """
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None):
+        self.app = app
+        self.controller = controller or admission
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        if scope["type"] != "http" or not controller.enabled:
+            return await self.app(scope, receive, send)
+        state = controller.classify(scope["path"])
+        if state is None:
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        try:
+            await controller.acquire(state, client[0] if client else "unknown")
+        except Rejected as exc:
+            response = JSONResponse({"detail": exc.detail}, status_code=exc.status_code,
+                                    headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(state)
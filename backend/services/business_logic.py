@@ -1,16 +1,42 @@
-from typing import List, Optional
+from typing import IO, AsyncIterator, Dict, List, Optional, Sequence
 from fastapi import HTTPException
-from models.schemas import Product, Cart, CartItem, Order, CheckoutRequest, DiscountCode
+from models.schemas import Product, ProductSearchResult, Cart, CartItem, CartBatchRequest, Order, OrderPage, CheckoutRequest, DiscountCode, DiscountCodePage, AnalyticsReport, Availability
 from store.memory_store import store
-from datetime import datetime
-from services.cache import cached_with_ttl, invalidate_cache
+from datetime import datetime, timedelta
+from services.cache import ttl_cache
+from services.admission import admission
+from services.compression import compressed_cache
+from services.events import OrderPlaced, event_bus
+from services.metrics import metrics
+from services.serialized import serialized_catalog
+from services.idempotency import IDEMPOTENCY_TTL, MAX_KEY_LENGTH, idempotency_results
+from services.locks import cart_locks, catalog_locks, discount_code_locks, idempotency_locks
+from store.backend import get_storage, CartNotFound, CartChanged, DiscountCodeUnavailable, IdempotencyKeyUsed, OutOfStock
+from store.catalog_import import CatalogImportError, format_of, load_catalog, open_catalog, text_stream
+import asyncio
+import json
+import tempfile
 import uuid
 
 class ProductService:
+    # The full listing is served by services.serialized, which re-encodes
+    # it when store.catalog_version changes
     @staticmethod
-    @cached_with_ttl(ttl=300, key_prefix="products")  # Cache for 5 minutes
-    async def get_all_products() -> List[Product]:
-        return list(store.products.values())
+    async def list_with_availability() -> bytes:
+        # Running on-hand and reserved totals - no scan of the carts
+        available = {
+            product_id: max(0, on_hand - reserved)
+            for product_id, on_hand, reserved in await get_storage().get_availability()
+        }
+        return serialized_catalog.with_availability(available)
+    
+    @staticmethod
+    async def search_products(q: Optional[str] = None, min_price: Optional[float] = None,
+                              max_price: Optional[float] = None, sort: str = "relevance",
+                              offset: int = 0, limit: int = 20) -> ProductSearchResult:
+        ids, total = store.catalog_index.search(q, min_price, max_price, sort, offset, limit)
+        items = [store.products[product_id] for product_id in ids]
+        return ProductSearchResult(items=items, total=total, offset=offset, limit=limit)
     
     @staticmethod
     async def get_product_by_id(product_id: str) -> Product:
@@ -18,81 +44,323 @@ class ProductService:
             raise HTTPException(status_code=404, detail="Product not found")
         return store.products[product_id]
 
+class CatalogService:
+    # Invalid rows skipped before an import is refused as a whole
+    MAX_ERRORS = 100
+    # Uploads bigger than this are spooled to disk while they arrive
+    SPOOL_BYTES = 16 * 1024 * 1024
+    # An upload swaps only the catalog of the worker that receives it, so
+    # it is refused when several workers each hold their own
+    accept_uploads = True
+    
+    @staticmethod
+    async def _load(stream: IO[str], fmt: str, mode: str = "replace") -> dict:
+        # One import at a time - a merge must start from the latest catalog
+        async with catalog_locks.acquire("catalog"):
+            base = store.products if mode == "merge" else None
+            # Parsing, validation and indexing run off the event loop on
+            # private objects; the swap itself is a few assignments
+            loaded = await asyncio.to_thread(
+                load_catalog, stream, fmt, base, max_errors=CatalogService.MAX_ERRORS
+            )
+            # Bumps catalog_version, which the serialised listing keys on;
+            # returns once the new catalog is durable
+            await store.replace_catalog(loaded.products, loaded.index)
+        
+        return {
+            "products": len(loaded.products),
+            "rows": loaded.rows,
+            "rejected": loaded.rejected,
+            "errors": loaded.errors,
+            "seconds": round(loaded.seconds, 3)
+        }
+    
+    @staticmethod
+    async def import_upload(body: AsyncIterator[bytes], fmt: str, mode: str) -> dict:
+        if not CatalogService.accept_uploads:
+            raise HTTPException(
+                status_code=409,
+                detail="Catalog import only updates one worker - set CATALOG_FILE and restart the workers instead"
+            )
+        with tempfile.SpooledTemporaryFile(max_size=CatalogService.SPOOL_BYTES) as spool:
+            async for chunk in body:
+                spool.write(chunk)
+            spool.seek(0)
+            try:
+                return await CatalogService._load(text_stream(spool), fmt, mode)
+            except CatalogImportError as exc:
+                raise HTTPException(status_code=422, detail={"message": str(exc), "errors": exc.errors})
+            except UnicodeDecodeError:
+                raise HTTPException(status_code=400, detail="Catalog must be UTF-8")
+    
+    @staticmethod
+    async def load_file(path: str) -> dict:
+        """Replace the catalog with a JSON Lines or CSV file (optionally .gz)"""
+        with open_catalog(path) as stream:
+            return await CatalogService._load(stream, format_of(path))
+
 class CartService:
+    @staticmethod
+    async def _load_cart(cart_id: str) -> Cart:
+        cart = await get_storage().get_cart(cart_id)
+        if cart is None:
+            raise HTTPException(status_code=404, detail="Cart not found")
+        return cart
+    
+    @staticmethod
+    async def _reserve(cart_id: str, quantities: Dict[str, int]):
+        """Hold stock for the cart's new line quantities, or 409 if it ran out"""
+        try:
+            await get_storage().reserve_stock(cart_id, quantities)
+        except OutOfStock as exc:
+            raise HTTPException(status_code=409, detail=f"Only {exc.available} of product {exc.product_id} available")
+    
+    @staticmethod
+    async def _save(cart: Cart, products: Sequence[str]):
+        """Write the cart back; 404 or 409 if another worker checked it out or
+        changed it since it was read (cart_locks only cover this process)"""
+        storage = get_storage()
+        try:
+            await storage.save_cart(cart)
+        except (CartNotFound, CartChanged):
+            # The holds just taken go back to what the stored cart has
+            current = await storage.get_cart(cart.id)
+            if current is None:
+                await storage.delete_cart(cart.id)
+                raise HTTPException(status_code=404, detail="Cart not found")
+            try:
+                await storage.reserve_stock(cart.id, {
+                    product_id: current.lines[product_id].quantity if product_id in current.lines else 0
+                    for product_id in products
+                })
+            except OutOfStock:
+                pass
+            raise HTTPException(status_code=409, detail="Cart was changed by another request, please retry")
+    
     @staticmethod
     async def create_cart() -> Cart:
         cart_id = str(uuid.uuid4())
         cart = Cart(id=cart_id, items=[], created_at=datetime.now())
-        store.carts[cart_id] = cart
+        await get_storage().create_cart(cart)
         return cart
     
     @staticmethod
     async def get_cart(cart_id: str) -> Cart:
-        if cart_id not in store.carts:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        return store.carts[cart_id]
+        return await CartService._load_cart(cart_id)
     
     @staticmethod
     async def add_item_to_cart(cart_id: str, item: CartItem) -> dict:
-        if cart_id not in store.carts:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        
-        if item.product_id not in store.products:
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        cart = store.carts[cart_id]
-        
-        existing_item = next((i for i in cart.items if i.product_id == item.product_id), None)
-        if existing_item:
-            existing_item.quantity += item.quantity
-        else:
-            cart.items.append(item)
+        async with cart_locks.acquire(cart_id):
+            cart = await CartService._load_cart(cart_id)
+            
+            if item.product_id not in store.products:
+                raise HTTPException(status_code=404, detail="Product not found")
+            
+            existing_item = cart.lines.get(item.product_id)
+            quantity = existing_item.quantity + item.quantity if existing_item else item.quantity
+            await CartService._reserve(cart_id, {item.product_id: quantity})
+            cart.set_quantity(item.product_id, quantity)
+            await CartService._save(cart, [item.product_id])
         
-        return {"message": "Item added to cart", "cart": cart}
+        return {"message": "Item added to cart", "cart": cart.sync_items()}
     
     @staticmethod
     async def remove_item_from_cart(cart_id: str, product_id: str) -> dict:
-        if cart_id not in store.carts:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        
-        cart = store.carts[cart_id]
-        cart.items = [item for item in cart.items if item.product_id != product_id]
+        async with cart_locks.acquire(cart_id):
+            cart = await CartService._load_cart(cart_id)
+            if product_id in cart.lines:
+                await CartService._reserve(cart_id, {product_id: 0})
+            cart.remove_line(product_id)
+            await CartService._save(cart, [product_id])
         
-        return {"message": "Item removed from cart", "cart": cart}
+        return {"message": "Item removed from cart", "cart": cart.sync_items()}
     
     @staticmethod
     async def update_item_quantity(cart_id: str, product_id: str, quantity: int) -> dict:
-        if cart_id not in store.carts:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        
-        cart = store.carts[cart_id]
-        item = next((i for i in cart.items if i.product_id == product_id), None)
-        
-        if not item:
-            raise HTTPException(status_code=404, detail="Item not found in cart")
+        async with cart_locks.acquire(cart_id):
+            cart = await CartService._load_cart(cart_id)
+            
+            if product_id not in cart.lines:
+                raise HTTPException(status_code=404, detail="Item not found in cart")
+            
+            await CartService._reserve(cart_id, {product_id: max(quantity, 0)})
+            if quantity <= 0:
+                cart.remove_line(product_id)
+            else:
+                cart.set_quantity(product_id, quantity)
+            await CartService._save(cart, [product_id])
         
-        if quantity <= 0:
-            cart.items = [i for i in cart.items if i.product_id != product_id]
-        else:
-            item.quantity = quantity
+        return {"message": "Quantity updated", "cart": cart.sync_items()}
+    
+    @staticmethod
+    async def apply_batch(cart_id: str, batch: CartBatchRequest) -> dict:
+        async with cart_locks.acquire(cart_id):
+            cart = await CartService._load_cart(cart_id)
+            
+            # Validate every operation against a pending overlay first, so a
+            # failing batch leaves the cart untouched. None marks a removal.
+            pending = {}
+            for index, operation in enumerate(batch.operations):
+                product_id = operation.product_id
+                if product_id in pending:
+                    current = pending[product_id]
+                else:
+                    line = cart.lines.get(product_id)
+                    current = line.quantity if line else None
+                
+                if operation.op == "add":
+                    if product_id not in store.products:
+                        raise HTTPException(status_code=404, detail=f"Product not found (operation {index})")
+                    if operation.quantity is None or operation.quantity <= 0:
+                        raise HTTPException(status_code=400, detail=f"Quantity must be greater than 0 (operation {index})")
+                    pending[product_id] = (current or 0) + operation.quantity
+                elif operation.op == "update":
+                    if current is None:
+                        raise HTTPException(status_code=404, detail=f"Item not found in cart (operation {index})")
+                    if operation.quantity is None:
+                        raise HTTPException(status_code=400, detail=f"Quantity is required (operation {index})")
+                    pending[product_id] = operation.quantity if operation.quantity > 0 else None
+                else:
+                    pending[product_id] = None
+            
+            # All or nothing - one sold-out product fails the whole batch
+            await CartService._reserve(cart_id, {product_id: quantity or 0 for product_id, quantity in pending.items()})
+            for product_id, quantity in pending.items():
+                if quantity is None:
+                    cart.remove_line(product_id)
+                else:
+                    cart.set_quantity(product_id, quantity)
+            await CartService._save(cart, list(pending))
         
-        return {"message": "Quantity updated", "cart": cart}
+        return {"message": f"Applied {len(batch.operations)} operations", "cart": cart.sync_items()}
+    
+    @staticmethod
+    async def run_cart_reaper(interval: float = 60.0, batch_size: int = 1000):
+        """Periodically evict idle and over-cap carts from the configured
+        backend, yielding to the event loop between batches"""
+        while True:
+            await asyncio.sleep(interval)
+            while await get_storage().reap_idle_carts(batch_size) == batch_size:
+                await asyncio.sleep(0)
+
+class InventoryService:
+    @staticmethod
+    async def get_availability() -> List[Availability]:
+        # Running reserved totals - no scan of the carts holding them
+        return [
+            Availability(product_id=product_id, on_hand=on_hand, reserved=reserved,
+                         available=max(0, on_hand - reserved))
+            for product_id, on_hand, reserved in await get_storage().get_availability()
+        ]
+    
+    @staticmethod
+    async def set_stock(product_id: str, on_hand: Optional[int]) -> dict:
+        if product_id not in store.products:
+            raise HTTPException(status_code=404, detail="Product not found")
+        storage = get_storage()
+        await storage.set_stock(product_id, on_hand)
+        await storage.commit()
+        return {"product_id": product_id, "on_hand": on_hand}
+    
+    @staticmethod
+    async def run_reservation_sweeper(interval: float = 30.0):
+        """Periodically release holds of carts left alone past the timeout"""
+        while True:
+            await asyncio.sleep(interval)
+            while await get_storage().expire_reservations() > 0:
+                await asyncio.sleep(0)
 
 class CheckoutService:
     @staticmethod
-    async def process_checkout(request: CheckoutRequest) -> Order:
+    async def process_checkout(request: CheckoutRequest, idempotency_key: Optional[str] = None) -> Order:
+        if idempotency_key is None:
+            return await CheckoutService._checkout(request)
+        
+        if not idempotency_key.strip() or len(idempotency_key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+        
+        # Duplicates in this worker wait here for the in-flight attempt, then
+        # replay its result; the key itself is recorded in storage with the
+        # order, so retries reaching other workers or a restart replay too
+        cache_key = f"checkout:{idempotency_key}"
+        fingerprint = json.dumps([request.cart_id, request.discount_code])
+        async with idempotency_locks.acquire(idempotency_key):
+            cached = idempotency_results.get(cache_key)
+            if cached is None:
+                cached = await CheckoutService._recorded_checkout(idempotency_key)
+            if cached is None:
+                # Only successes are recorded - a failed checkout changed
+                # nothing, so a retry simply runs again
+                try:
+                    order = await CheckoutService._checkout(request, (idempotency_key, fingerprint))
+                    cached = (fingerprint, order)
+                    idempotency_results.set(cache_key, cached, ttl=IDEMPOTENCY_TTL)
+                except IdempotencyKeyUsed:
+                    # Another worker completed a checkout with this key first
+                    cached = await CheckoutService._recorded_checkout(idempotency_key)
+                    if cached is None:
+                        raise HTTPException(status_code=409, detail="Idempotency-Key was already used")
+            if cached[0] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different checkout")
+            return cached[1]
+    
+    @staticmethod
+    async def _recorded_checkout(idempotency_key: str) -> Optional[tuple]:
+        """(fingerprint, order) stored for a key - replayed until the sweeper
+        purges it, and cached here for the rest of its TTL"""
+        storage = get_storage()
+        recorded = await storage.get_idempotent_checkout(idempotency_key)
+        if recorded is None:
+            return None
+        fingerprint, order_id, recorded_at = recorded
+        order = await storage.get_order(order_id)
+        if order is None:
+            return None
+        cached = (fingerprint, order)
+        remaining = IDEMPOTENCY_TTL - (datetime.now() - recorded_at).total_seconds()
+        if remaining > 0:
+            idempotency_results.set(f"checkout:{idempotency_key}", cached, ttl=remaining)
+        return cached
+    
+    @staticmethod
+    async def run_idempotency_sweeper(interval: float = 60.0, batch_size: int = 1000):
+        """Periodically forget stored Idempotency-Keys past IDEMPOTENCY_TTL"""
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+            while await get_storage().purge_idempotency_keys(cutoff, batch_size) == batch_size:
+                await asyncio.sleep(0)
+    
+    @staticmethod
+    async def _checkout(request: CheckoutRequest, idempotency: Optional[tuple] = None) -> Order:
+        # Serialise checkouts per cart and per discount code only - checkouts
+        # for different carts and codes proceed concurrently
+        async with cart_locks.acquire(request.cart_id):
+            if not request.discount_code:
+                return await CheckoutService._checkout_locked(request, idempotency)
+            async with discount_code_locks.acquire(request.discount_code):
+                return await CheckoutService._checkout_locked(request, idempotency)
+    
+    @staticmethod
+    async def _checkout_locked(request: CheckoutRequest, idempotency: Optional[tuple] = None) -> Order:
+        storage = get_storage()
+        
         # Validate cart exists and has items
-        if request.cart_id not in store.carts:
+        cart = await storage.get_cart(request.cart_id)
+        if cart is None:
             raise HTTPException(status_code=404, detail="Cart not found")
         
-        cart = store.carts[request.cart_id]
-        
-        if not cart.items:
+        if not cart.lines:
             raise HTTPException(status_code=400, detail="Cart is empty")
         
+        # A catalog import may have dropped a product since it was added
+        missing = next((product_id for product_id in cart.lines if product_id not in store.products), None)
+        if missing is not None:
+            raise HTTPException(status_code=409, detail=f"Product {missing} is no longer available")
+        
         subtotal = sum(
             store.products[item.product_id].price * item.quantity 
-            for item in cart.items
+            for item in cart.lines.values()
         )
         
         # Apply discount if code provided
@@ -100,27 +368,28 @@ class CheckoutService:
         discount_code_used = None
         
         if request.discount_code:
-            if request.discount_code not in store.discount_codes:
-                raise HTTPException(status_code=400, detail="Invalid discount code")
+            discount = await storage.get_discount_code(request.discount_code)
             
-            discount = store.discount_codes[request.discount_code]
+            if discount is None:
+                raise HTTPException(status_code=400, detail="Invalid discount code")
             
             if discount.is_used:
                 raise HTTPException(status_code=400, detail="Discount code already used")
             
+            if discount.expires_at is not None and discount.expires_at <= datetime.now():
+                raise HTTPException(status_code=400, detail="Discount code expired")
+            
             discount_amount = subtotal * 0.10
-            discount.is_used = True
             discount_code_used = request.discount_code
         
         total = subtotal - discount_amount
         
-        store.order_counter += 1
         order_id = str(uuid.uuid4())
         
         order = Order(
             id=order_id,
             cart_id=request.cart_id,
-            items=cart.items.copy(),
+            items=list(cart.lines.values()),
             subtotal=subtotal,
             discount_amount=discount_amount,
             total=total,
@@ -128,86 +397,252 @@ class CheckoutService:
             created_at=datetime.now()
         )
         
-        store.orders[order_id] = order
-        
-        # Auto-generate discount code every nth order
-        if store.order_counter % store.nth_order == 0:
-            code = f"SAVE10-{str(uuid.uuid4())[:8].upper()}"
-            discount_code = DiscountCode(
-                code=code,
-                order_number=store.order_counter,
-                is_used=False,
-                created_at=datetime.now()
-            )
-            store.discount_codes[code] = discount_code
+        # Spend the code, number and store the order, and drop the cart as
+        # one step - safe against other workers sharing the backend
+        try:
+            order_number = await storage.complete_checkout(cart, order, discount_code_used, idempotency,
+                                                           nth_order=store.nth_order)
+        except CartNotFound:
+            raise HTTPException(status_code=404, detail="Cart not found")
+        except CartChanged:
+            raise HTTPException(status_code=409, detail="Cart changed during checkout, please retry")
+        except DiscountCodeUnavailable:
+            raise HTTPException(status_code=400, detail="Discount code already used")
+        except OutOfStock as exc:
+            raise HTTPException(status_code=409, detail=f"Only {exc.available} of product {exc.product_id} available")
         
-        del store.carts[request.cart_id]
+        # Group-committed with concurrent checkouts when the WAL is enabled
+        await storage.commit()
         
-        # Invalidate cached stats after new order
-        invalidate_cache("admin_stats")
+        # Everything else happens off the request path
+        await event_bus.publish(OrderPlaced(order=order, order_number=order_number))
         
         return order
+    
+    @staticmethod
+    async def issue_nth_order_codes(events: Sequence[OrderPlaced]):
+        """OrderPlaced handler - a discount code for every nth order
+
+        complete_checkout queued the order number with the order, so a code
+        lost to a crash before this ran is issued by issue_pending_codes.
+        """
+        storage = get_storage()
+        issued = False
+        for event in events:
+            if event.order_number % store.nth_order == 0:
+                code = DiscountCodeService.new_code(event.order_number)
+                issued = await storage.issue_nth_order_code(event.order_number, code) or issued
+        # One commit for the whole batch
+        if issued:
+            await storage.commit()
+    
+    @staticmethod
+    async def issue_pending_codes() -> int:
+        """Issue nth-order codes still queued - run at startup"""
+        storage = get_storage()
+        issued = 0
+        for order_number in await storage.pending_nth_order_codes():
+            issued += await storage.issue_nth_order_code(order_number, DiscountCodeService.new_code(order_number))
+        if issued:
+            await storage.commit()
+        return issued
+
+event_bus.subscribe("nth_order_discount", CheckoutService.issue_nth_order_codes)
 
 class OrderService:
+    EXPORT_CHUNK_SIZE = 500
+    
     @staticmethod
-    async def get_all_orders() -> List[Order]:
-        return list(store.orders.values())
+    async def get_orders_page(limit: int = 50, cursor: Optional[str] = None,
+                              created_from: Optional[datetime] = None,
+                              created_to: Optional[datetime] = None,
+                              cart_id: Optional[str] = None,
+                              product_id: Optional[str] = None) -> OrderPage:
+        if cursor is not None and not cursor.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        
+        items, next_cursor = await get_storage().list_orders(
+            limit, cursor, created_from, created_to, cart_id, product_id
+        )
+        return OrderPage(items=items, next_cursor=next_cursor, limit=limit)
+    
+    @staticmethod
+    async def export_orders(created_from: Optional[datetime] = None,
+                            created_to: Optional[datetime] = None,
+                            cart_id: Optional[str] = None,
+                            product_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """Yield orders as NDJSON in fixed-size chunks"""
+        storage = get_storage()
+        cursor = None
+        
+        while True:
+            orders, cursor = await storage.list_orders(
+                OrderService.EXPORT_CHUNK_SIZE, cursor, created_from, created_to, cart_id, product_id
+            )
+            if orders:
+                yield b"".join(order.model_dump_json().encode() + b"\n" for order in orders)
+            if cursor is None:
+                break
+            # Let other requests run between chunks
+            await asyncio.sleep(0)
     
     @staticmethod
     async def get_order_by_id(order_id: str) -> Order:
-        if order_id not in store.orders:
+        order = await get_storage().get_order(order_id)
+        if order is None:
             raise HTTPException(status_code=404, detail="Order not found")
-        return store.orders[order_id]
+        return order
+
+class DiscountCodeService:
+    # Codes stop being accepted after TTL; used and expired codes stay
+    # listable for RETENTION before compaction folds them into counters
+    TTL = timedelta(days=30)
+    RETENTION = timedelta(days=7)
+    # Codes expired or dropped per compaction step
+    COMPACT_BATCH = 1000
+    
+    @staticmethod
+    def new_code(order_number: int) -> DiscountCode:
+        now = datetime.now()
+        return DiscountCode(
+            code=f"SAVE10-{str(uuid.uuid4())[:8].upper()}",
+            order_number=order_number,
+            is_used=False,
+            created_at=now,
+            expires_at=now + DiscountCodeService.TTL
+        )
+    
+    @staticmethod
+    async def list_codes(status: Optional[str] = None, limit: int = 50,
+                         cursor: Optional[str] = None) -> DiscountCodePage:
+        if cursor is not None and not cursor.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        
+        items, next_cursor = await get_storage().list_discount_codes(limit, cursor, status)
+        return DiscountCodePage(items=items, next_cursor=next_cursor, limit=limit)
+    
+    @staticmethod
+    async def compact() -> dict:
+        storage = get_storage()
+        now = datetime.now()
+        batch = DiscountCodeService.COMPACT_BATCH
+        expired = compacted = 0
+        # Bounded steps, yielding between them, so a large backlog never
+        # holds the event loop (or the SQLite write lock) for long
+        while True:
+            step_expired, step_compacted = await storage.compact_discount_codes(
+                now, DiscountCodeService.RETENTION, batch
+            )
+            expired += step_expired
+            compacted += step_compacted
+            if step_expired < batch and step_compacted < batch:
+                break
+            await asyncio.sleep(0)
+        await storage.commit()
+        return {"expired": expired, "compacted": compacted}
+    
+    @staticmethod
+    async def run_compactor(interval: float = 600.0):
+        while True:
+            await asyncio.sleep(interval)
+            await DiscountCodeService.compact()
 
 class AdminService:
     @staticmethod
     async def generate_discount_code() -> dict:
-        if store.order_counter % store.nth_order == 0:
-            code = f"SAVE10-{str(uuid.uuid4())[:8].upper()}"
-            discount_code = DiscountCode(
-                code=code,
-                order_number=store.order_counter,
-                is_used=False,
-                created_at=datetime.now()
-            )
-            store.discount_codes[code] = discount_code
+        storage = get_storage()
+        order_counter = await storage.get_order_counter()
+        
+        if order_counter % store.nth_order == 0:
+            discount_code = DiscountCodeService.new_code(order_counter)
+            await storage.add_discount_code(discount_code)
             return {"message": "Discount code generated", "discount_code": discount_code}
         else:
-            orders_until_next = store.nth_order - (store.order_counter % store.nth_order)
+            orders_until_next = store.nth_order - (order_counter % store.nth_order)
             return {
                 "message": f"Discount not available yet. {orders_until_next} more orders needed.",
                 "orders_until_next": orders_until_next
             }
     
     @staticmethod
-    @cached_with_ttl(ttl=60, key_prefix="admin_stats")  # Cache for 1 minute
+    async def get_cart_metrics() -> dict:
+        # Limits and eviction counts of whichever backend holds the carts
+        return await get_storage().get_cart_metrics()
+    
+    @staticmethod
     async def get_statistics() -> dict:
-        # Reuse orders collection for efficiency
-        orders = store.orders.values()
-        
-        total_items_purchased = sum(
-            sum(item.quantity for item in order.items)
-            for order in orders
-        )
-        
-        total_purchase_amount = sum(order.total for order in orders)
-        total_discount_amount = sum(order.discount_amount for order in orders)
-        
-        discount_codes_list = [
-            {
-                "code": code.code,
-                "order_number": code.order_number,
-                "is_used": code.is_used,
-                "created_at": code.created_at.isoformat()
-            }
-            for code in store.discount_codes.values()
-        ]
+        storage = get_storage()
+        # Totals are maintained by the backend on checkout - no order or
+        # code scan, so the payload stays the same size as codes pile up
+        # (the codes themselves are paged at /admin/discount-codes)
+        totals = await storage.get_statistics()
         
         return {
-            "total_items_purchased": total_items_purchased,
-            "total_purchase_amount": round(total_purchase_amount, 2),
-            "discount_codes": discount_codes_list,
-            "total_discount_amount": round(total_discount_amount, 2),
-            "total_orders": len(store.orders),
+            "total_items_purchased": totals["total_items_purchased"],
+            "total_purchase_amount": round(totals["total_purchase_amount"], 2),
+            "total_discount_amount": round(totals["total_discount_amount"], 2),
+            "total_orders": totals["total_orders"],
+            "used_discount_codes": totals["used_discount_codes"],
+            "unused_discount_codes": totals["unused_discount_codes"],
+            "expired_discount_codes": totals["expired_discount_codes"],
             "nth_order_value": store.nth_order
         }
+    
+    @staticmethod
+    async def get_analytics(start: Optional[datetime], end: Optional[datetime],
+                            granularity: str, group_by: Optional[str]) -> AnalyticsReport:
+        if start is not None and end is not None and start.timestamp() > end.timestamp():
+            raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+        # Served from hourly counters kept on checkout - no order scan
+        buckets = await get_storage().get_analytics(start, end, granularity, group_by)
+        return AnalyticsReport(granularity=granularity, group_by=group_by, buckets=buckets)
+
+class MetricsService:
+    @staticmethod
+    async def render_metrics() -> str:
+        samples = []
+        caches = (("response", ttl_cache), ("compressed", compressed_cache), ("product", serialized_catalog.products))
+        for name, cache in caches:
+            labels = {"cache": name}
+            samples += [
+                ("cache_hits_total", "counter", "Cache lookups that found a live entry", labels, cache.hits),
+                ("cache_misses_total", "counter", "Cache lookups that found nothing usable", labels, cache.misses),
+                ("cache_evictions_total", "counter", "Entries evicted for size or count", labels, cache.evictions),
+                ("cache_expirations_total", "counter", "Entries dropped after their TTL", labels, cache.expirations),
+                ("cache_entries", "gauge", "Entries currently cached", labels, len(cache)),
+                ("cache_bytes", "gauge", "Estimated size of cached values", labels, cache.current_bytes),
+            ]
+        
+        # O(1) counters from the backend - no scans
+        storage = get_storage()
+        totals = await storage.get_statistics()
+        samples += [
+            ("store_products", "gauge", "Products in the catalog", {}, len(store.products)),
+            ("store_carts", "gauge", "Active carts", {}, await storage.count_carts()),
+            ("store_orders", "gauge", "Orders placed", {}, totals["total_orders"]),
+            ("store_discount_codes", "gauge", "Discount codes by state", {"state": "unused"}, totals["unused_discount_codes"]),
+            ("store_discount_codes", "gauge", "Discount codes by state", {"state": "used"}, totals["used_discount_codes"]),
+            ("store_discount_codes", "gauge", "Discount codes by state", {"state": "expired"}, totals["expired_discount_codes"]),
+        ]
+        
+        samples.append(("event_queue_depth", "gauge", "Events waiting for the post-checkout workers", {}, event_bus.depth))
+        samples.append(("events_published_total", "counter", "Events published to the post-checkout bus", {}, event_bus.published))
+        histograms = []
+        for _, stats in event_bus.handlers:
+            labels = {"handler": stats.name}
+            samples.append(("event_handler_events_total", "counter", "Events handled, by handler", labels, stats.events))
+            samples.append(("event_handler_errors_total", "counter", "Batches a handler failed on", labels, stats.errors))
+            histograms.append(("event_handler_duration_seconds", "Time spent handling one batch, by handler", labels, stats))
+        
+        for name, state in admission.classes.items():
+            labels = {"class": name}
+            for decision, count in (("admitted", state.admitted), ("queued", state.queued),
+                                    ("shed", state.shed), ("rate_limited", state.rate_limited)):
+                samples.append(("admission_decisions_total", "counter", "Admission decisions, by route class",
+                                {**labels, "decision": decision}, count))
+            samples += [
+                ("admission_queue_wait_seconds_total", "counter", "Time admitted requests spent queued", labels, state.wait_seconds),
+                ("admission_queue_depth", "gauge", "Requests waiting for a slot", labels, len(state.waiters)),
+                ("admission_in_flight", "gauge", "Requests holding a slot", labels, state.in_flight),
+            ]
+        return metrics.render(samples, histograms)
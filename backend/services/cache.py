@@ -1,53 +1,268 @@
+from collections import OrderedDict
 from functools import lru_cache, wraps
 from time import time
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from pydantic import BaseModel
+import asyncio
+import heapq
+import inspect
+import sys
 
-# TTL cache - stores results with automatic expiration
+# TTL cache - stores results with automatic expiration, bounded by entry
+# count and estimated bytes with LRU eviction. Keys are tagged by their
+# prefix (text before the first ":") so invalidation only touches one tag.
 class TTLCache:
-    def __init__(self):
-        self._cache = {}
-        self._timestamps = {}
+    def __init__(self, max_entries: int = 10_000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._timestamps: Dict[str, float] = {}
+        self._ttls: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._tags: Dict[str, Set[str]] = {}
+        self._expiry_heap: List[Tuple[float, float, str]] = []
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __len__(self) -> int:
+        return len(self._cache)
     
     def get(self, key: str, ttl: Optional[int] = None) -> Optional[Any]:
         if key not in self._cache:
+            self.misses += 1
             return None
         
         # Check if expired
-        if ttl and key in self._timestamps:
-            if time() - self._timestamps[key] > ttl:
-                del self._cache[key]
-                del self._timestamps[key]
-                return None
+        ttl = ttl or self._ttls.get(key)
+        if ttl and time() - self._timestamps[key] > ttl:
+            self.delete(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
         
+        self._cache.move_to_end(key)
+        self.hits += 1
         return self._cache[key]
     
-    def set(self, key: str, value: Any) -> None:
+    def peek(self, key: str) -> Optional[Tuple[Any, float]]:
+        """Return (value, age in seconds) without expiring the entry"""
+        if key not in self._cache:
+            return None
+        self._cache.move_to_end(key)
+        return self._cache[key], time() - self._timestamps[key]
+    
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        if key in self._cache:
+            self.delete(key)
+        
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        
+        now = time()
         self._cache[key] = value
-        self._timestamps[key] = time()
+        self._timestamps[key] = now
+        self._sizes[key] = size
+        self.current_bytes += size
+        self._tags.setdefault(_tag_of(key), set()).add(key)
+        if ttl:
+            self._ttls[key] = ttl
+            heapq.heappush(self._expiry_heap, (now + ttl, now, key))
+        
+        while len(self._cache) > self.max_entries or self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._cache))
+            self.delete(oldest_key)
+            self.evictions += 1
     
     def clear(self):
         self._cache.clear()
         self._timestamps.clear()
+        self._ttls.clear()
+        self._sizes.clear()
+        self._tags.clear()
+        self._expiry_heap.clear()
+        self.current_bytes = 0
     
     def delete(self, key: str):
-        if key in self._cache:
-            del self._cache[key]
-        if key in self._timestamps:
-            del self._timestamps[key]
+        if key not in self._cache:
+            return
+        del self._cache[key]
+        del self._timestamps[key]
+        self._ttls.pop(key, None)
+        self.current_bytes -= self._sizes.pop(key)
+        tag = _tag_of(key)
+        tagged = self._tags.get(tag)
+        if tagged is not None:
+            tagged.discard(key)
+            if not tagged:
+                del self._tags[tag]
+    
+    def delete_prefix(self, key_prefix: str) -> int:
+        """Delete keys starting with prefix, scanning only the matching tag"""
+        if not key_prefix:
+            removed = len(self._cache)
+            self.clear()
+            return removed
+        
+        if ":" in key_prefix:
+            candidates = list(self._tags.get(_tag_of(key_prefix), ()))
+        else:
+            # Bare tag such as "admin_stats" - walk matching tags, not every key
+            candidates = [k for t, keys in self._tags.items() if t.startswith(key_prefix) for k in keys]
+        keys_to_delete = [k for k in candidates if k.startswith(key_prefix)]
+        for key in keys_to_delete:
+            self.delete(key)
+        return len(keys_to_delete)
+    
+    def sweep_expired(self, max_items: int = 1000) -> int:
+        """Remove up to max_items entries whose TTL has passed"""
+        now = time()
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now and removed < max_items:
+            _, stored_at, key = heapq.heappop(heap)
+            # Skip heap entries left behind by re-set or deleted keys
+            if self._timestamps.get(key) == stored_at:
+                self.delete(key)
+                self.expirations += 1
+                removed += 1
+        
+        # Drop stale heap entries once they dominate
+        if len(heap) > 2 * len(self._cache) + 1024:
+            self._expiry_heap = [
+                entry for entry in heap if self._timestamps.get(entry[2]) == entry[1]
+            ]
+            heapq.heapify(self._expiry_heap)
+        return removed
+    
+    async def run_sweeper(self, interval: float = 30.0, batch_size: int = 1000):
+        """Periodically expire entries in bounded batches"""
+        while True:
+            await asyncio.sleep(interval)
+            while self.sweep_expired(batch_size) == batch_size:
+                await asyncio.sleep(0)
+
+def _tag_of(key: str) -> str:
+    return key.split(":", 1)[0]
+
+def _estimate_size(value: Any, depth: int = 3) -> int:
+    """Approximate retained bytes of a cached value"""
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + _estimate_size(v, depth - 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += _estimate_size(item, depth - 1)
+    elif isinstance(value, BaseModel):
+        size += _estimate_size(value.__dict__, depth - 1)
+    return size
 
 ttl_cache = TTLCache()
 
-def cached_with_ttl(ttl: int = 60, key_prefix: str = ""):
-    """Decorator to cache function results with TTL"""
+# Single-flight state - one in-flight computation per cache key
+_inflight: Dict[str, asyncio.Future] = {}
+_refresh_tasks: set = set()
+# In-flight computations whose key was invalidated after they started -
+# their result still goes to waiters but is not stored
+_invalidated: Set[asyncio.Future] = set()
+
+def _build_cache_key(key_prefix: str, func: Callable, args: tuple, kwargs: dict) -> str:
+    # Build cache key from function name + args
+    cache_key = f"{key_prefix}:{func.__name__}"
+    if args:
+        cache_key += f":{':'.join(str(arg) for arg in args)}"
+    if kwargs:
+        cache_key += f":{':'.join(f'{k}={v}' for k, v in sorted(kwargs.items()))}"
+    return cache_key
+
+async def _compute_single_flight(cache_key: str, func: Callable, args: tuple, kwargs: dict,
+                                 ttl: float, stale_ttl: float = 0) -> Any:
+    """Run func once per key; concurrent callers await the same result"""
+    pending = _inflight.get(cache_key)
+    if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+        return await asyncio.shield(pending)
+    
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    try:
+        result = await func(*args, **kwargs)
+    except BaseException as exc:
+        future.set_exception(exc)
+        # Mark retrieved so an unawaited failure does not log a warning
+        future.exception()
+        raise
+    else:
+        if future not in _invalidated:
+            ttl_cache.set(cache_key, result, ttl + stale_ttl)
+        future.set_result(result)
+        return result
+    finally:
+        _invalidated.discard(future)
+        if _inflight.get(cache_key) is future:
+            del _inflight[cache_key]
+
+def _schedule_refresh(cache_key: str, func: Callable, args: tuple, kwargs: dict,
+                      ttl: float, stale_ttl: float) -> None:
+    if cache_key in _inflight:
+        return
+    
+    async def refresh():
+        try:
+            await _compute_single_flight(cache_key, func, args, kwargs, ttl, stale_ttl)
+        except Exception:
+            # Stale value stays in place; next caller retries
+            pass
+    
+    task = asyncio.get_running_loop().create_task(refresh())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+def cached_with_ttl(ttl: int = 60, key_prefix: str = "", stale_ttl: int = 0):
+    """Decorator to cache function results with TTL
+    
+    Coroutine functions are awaited and their result is cached; concurrent
+    misses for the same key share one computation. With stale_ttl > 0 an
+    expired value younger than ttl + stale_ttl is returned immediately while
+    a background task refreshes it.
+    """
     def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                cache_key = _build_cache_key(key_prefix, func, args, kwargs)
+                
+                if stale_ttl:
+                    entry = ttl_cache.peek(cache_key)
+                    if entry is not None:
+                        value, age = entry
+                        if age <= ttl:
+                            ttl_cache.hits += 1
+                            return value
+                        if age <= ttl + stale_ttl:
+                            # Served from cache, so a hit even while refreshing
+                            ttl_cache.hits += 1
+                            _schedule_refresh(cache_key, func, args, kwargs, ttl, stale_ttl)
+                            return value
+                    ttl_cache.misses += 1
+                else:
+                    cached_value = ttl_cache.get(cache_key, ttl)
+                    if cached_value is not None:
+                        return cached_value
+                
+                # Cache miss - compute once and share with concurrent callers
+                return await _compute_single_flight(cache_key, func, args, kwargs, ttl, stale_ttl)
+            
+            return async_wrapper
+        
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Build cache key from function name + args
-            cache_key = f"{key_prefix}:{func.__name__}"
-            if args:
-                cache_key += f":{':'.join(str(arg) for arg in args)}"
-            if kwargs:
-                cache_key += f":{':'.join(f'{k}={v}' for k, v in sorted(kwargs.items()))}"
+            cache_key = _build_cache_key(key_prefix, func, args, kwargs)
             
             # Check cache first
             cached_value = ttl_cache.get(cache_key, ttl)
@@ -56,14 +271,21 @@ def cached_with_ttl(ttl: int = 60, key_prefix: str = ""):
             
             # Cache miss - call function and store result
             result = func(*args, **kwargs)
-            ttl_cache.set(cache_key, result)
+            ttl_cache.set(cache_key, result, ttl)
             return result
         
         return wrapper
     return decorator
 
 def invalidate_cache(key_prefix: str = ""):
-    """Remove all cached items matching prefix"""
-    keys_to_delete = [k for k in ttl_cache._cache.keys() if k.startswith(key_prefix)]
-    for key in keys_to_delete:
-        ttl_cache.delete(key)
+    """Remove all cached items matching prefix
+
+    The cache is per process; nothing cached here is derived from state
+    shared between workers, so there is nothing to broadcast.
+    """
+    # Only computations for matching keys are discarded; few are ever in
+    # flight. Dropping them from _inflight makes later callers start a fresh
+    # computation instead of joining one that read the old state.
+    for cache_key in [key for key in _inflight if key.startswith(key_prefix)]:
+        _invalidated.add(_inflight.pop(cache_key))
+    ttl_cache.delete_prefix(key_prefix)
@@ -0,0 +1,84 @@
+from typing import Callable, Dict, Optional
+from fastapi import Response
+from services.cache import TTLCache
+from services.serialized import etag_matches
+import gzip
+
+# Optional encoders - used only when their packages are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODERS: Dict[str, Callable[[bytes], bytes]] = {"gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0)}
+if brotli is not None:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=11)
+if zstandard is not None:
+    ENCODERS["zstd"] = zstandard.ZstdCompressor(level=19).compress
+
+# Server preference when the client accepts several encodings equally
+_PREFERENCE = ("zstd", "br", "gzip")
+
+# Same threshold as the GZipMiddleware in main.py
+MINIMUM_SIZE = 1000
+
+# Compressed variants keyed by "<etag>:<encoding>" - each payload version
+# is compressed once per encoding, then served from memory
+compressed_cache = TTLCache(max_entries=2048, max_bytes=32 * 1024 * 1024)
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best available encoding from an Accept-Encoding header"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in _PREFERENCE:
+        if encoding not in ENCODERS:
+            continue
+        q = weights.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def compressed_variant(body: bytes, etag: str, encoding: str) -> bytes:
+    key = f"{etag}:{encoding}"
+    variant = compressed_cache.get(key)
+    if variant is None:
+        variant = ENCODERS[encoding](body)
+        compressed_cache.set(key, variant)
+    return variant
+
+def versioned_response(body: bytes, etag: str, if_none_match: Optional[str],
+                       accept_encoding: Optional[str], cache_control: str = "no-cache") -> Response:
+    """Response for a versioned payload - 304 on a matching ETag, otherwise
+    the cached compressed variant the client prefers"""
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= MINIMUM_SIZE else None
+    # Each representation gets its own strong ETag
+    variant_etag = f'{etag[:-1]}-{encoding}"' if encoding else etag
+    headers = {"ETag": variant_etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    
+    if etag_matches(if_none_match, variant_etag) or etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding is None:
+        return Response(content=body, media_type="application/json", headers=headers)
+    
+    # Content-Encoding set here makes GZipMiddleware pass the body through
+    headers["Content-Encoding"] = encoding
+    return Response(content=compressed_variant(body, etag, encoding), media_type="application/json", headers=headers)
@@ -0,0 +1,133 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Sequence
+from models.schemas import Order
+from services.metrics import LATENCY_BUCKETS
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Side effects of a checkout run here, off the request path. Handlers get
+# a batch of events per call so they can share one commit or round trip.
+
+@dataclass(frozen=True)
+class OrderPlaced:
+    order: Order
+    order_number: int
+
+Handler = Callable[[Sequence[OrderPlaced]], Awaitable[None]]
+
+class HandlerStats:
+    """Batch latency histogram and counters for one handler"""
+    __slots__ = ("name", "buckets", "count", "total", "events", "errors")
+
+    def __init__(self, name: str):
+        self.name = name
+        # Per-bucket counts (not cumulative); the last slot is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.events = 0
+        self.errors = 0
+
+    def observe(self, seconds: float, events: int):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.events += events
+
+class EventBus:
+    """Bounded queue of events drained in batches by worker tasks
+
+    publish() waits while the queue is full, so a backlog slows checkouts
+    down instead of growing without bound. Until start() is called (or
+    after stop()), events are handled inline by publish() - scripts and
+    tests without a lifespan see the same side effects, just synchronously.
+    """
+
+    def __init__(self, max_queue: int = 10_000, max_batch: int = 100, workers: int = 2):
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.workers = workers
+        self.handlers: List[tuple] = []
+        self.published = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def subscribe(self, name: str, handler: Handler):
+        self.handlers.append((handler, HandlerStats(name)))
+
+    @property
+    def running(self) -> bool:
+        return self._queue is not None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def publish(self, event: OrderPlaced):
+        self.published += 1
+        if self._queue is None:
+            await self._dispatch([event])
+            return
+        await self._queue.put(event)
+
+    def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Drain queued events, then stop the workers
+
+        Events still queued after timeout are handled inline before returning.
+        """
+        queue = self._queue
+        if queue is None:
+            return
+        try:
+            await asyncio.wait_for(queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("event bus drain timed out with %d events queued", queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+        leftover = []
+        while not queue.empty():
+            leftover.append(queue.get_nowait())
+        for start in range(0, len(leftover), self.max_batch):
+            await self._dispatch(leftover[start:start + self.max_batch])
+
+    async def _worker(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            # Take whatever else is already waiting, up to max_batch
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await self._dispatch(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _dispatch(self, batch: List[OrderPlaced]):
+        # The orders are already committed, so a failing handler is
+        # counted and logged rather than raised
+        for handler, stats in self.handlers:
+            started = time.perf_counter()
+            try:
+                await handler(batch)
+            except Exception:
+                stats.errors += 1
+                logger.exception("event handler %s failed", stats.name)
+            finally:
+                stats.observe(time.perf_counter() - started, len(batch))
+
+event_bus = EventBus()
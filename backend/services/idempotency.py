@@ -0,0 +1,10 @@
+from services.cache import TTLCache
+
+# Idempotency-Key support - completed results are replayed for retries of
+# the same key within IDEMPOTENCY_TTL seconds
+IDEMPOTENCY_TTL = 24 * 60 * 60
+MAX_KEY_LENGTH = 255
+
+# "<scope>:<key>" -> (request fingerprint, result). Bounded, so a flood of
+# unique keys evicts the oldest results rather than growing memory.
+idempotency_results = TTLCache(max_entries=50_000, max_bytes=32 * 1024 * 1024)
@@ -0,0 +1,35 @@
+from contextlib import asynccontextmanager
+from typing import Dict, List
+import asyncio
+
+# Keyed async locks - one lock per key, created on demand and dropped once
+# nobody holds or waits on it, so memory tracks only contended keys
+class KeyedLock:
+    def __init__(self):
+        # key -> [lock, holders + waiters]
+        self._locks: Dict[str, List] = {}
+    
+    def __len__(self) -> int:
+        return len(self._locks)
+    
+    @asynccontextmanager
+    async def acquire(self, key: str):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+# Lock order is always idempotency key, then cart, then discount code, so
+# checkouts cannot deadlock
+idempotency_locks = KeyedLock()
+cart_locks = KeyedLock()
+discount_code_locks = KeyedLock()
+# Catalog imports, one at a time under a single key
+catalog_locks = KeyedLock()
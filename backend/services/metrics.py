@@ -0,0 +1,149 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+from fastapi import HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from services.profiling import profiler
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RouteStats:
+    """Counters for one method + route template"""
+    __slots__ = ("method", "route", "buckets", "count", "total", "statuses", "in_flight")
+
+    def __init__(self, method: str, route: str):
+        self.method = method
+        self.route = route
+        # Per-bucket counts (not cumulative); the last slot is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.statuses: Dict[int, int] = {}
+        self.in_flight = 0
+
+    def observe(self, seconds: float, status: int):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+def _histogram_lines(name: str, labels: Dict[str, str], buckets: List[int], count: int, total: float) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+        cumulative += bucket_count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {total}")
+    lines.append(f"{name}_count{_labels(**labels)} {count}")
+    return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._routes: Dict[Tuple[str, str], RouteStats] = {}
+
+    def route(self, method: str, route: str) -> RouteStats:
+        stats = self._routes.get((method, route))
+        if stats is None:
+            stats = self._routes[(method, route)] = RouteStats(method, route)
+        return stats
+
+    def reset(self):
+        for stats in self._routes.values():
+            stats.__init__(stats.method, stats.route)
+
+    def render(self, gauges: Iterable[Tuple[str, str, str, Dict[str, str], float]] = (),
+               histograms: Iterable[Tuple[str, str, Dict[str, str], object]] = ()) -> str:
+        """Prometheus text exposition of the route metrics plus extra samples
+
+        gauges are (name, type, help, labels, value) tuples; histograms are
+        (name, help, labels, stats) with stats having LATENCY_BUCKETS-shaped
+        buckets, count and total.
+        """
+        lines: List[str] = []
+        routes = sorted(self._routes.values(), key=lambda stats: (stats.route, stats.method))
+
+        lines.append("# HELP http_request_duration_seconds Time spent handling requests, by route")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for stats in routes:
+            lines += _histogram_lines("http_request_duration_seconds", {"method": stats.method, "route": stats.route},
+                                      stats.buckets, stats.count, stats.total)
+
+        lines.append("# HELP http_requests_total Requests handled, by route and status code")
+        lines.append("# TYPE http_requests_total counter")
+        for stats in routes:
+            for status, count in sorted(stats.statuses.items()):
+                lines.append(f"http_requests_total{_labels(method=stats.method, route=stats.route, status=status)} {count}")
+
+        lines.append("# HELP http_request_errors_total Requests that failed with a 5xx status")
+        lines.append("# TYPE http_request_errors_total counter")
+        for stats in routes:
+            errors = sum(count for status, count in stats.statuses.items() if status >= 500)
+            lines.append(f"http_request_errors_total{_labels(method=stats.method, route=stats.route)} {errors}")
+
+        lines.append("# HELP http_requests_in_flight Requests currently being handled")
+        lines.append("# TYPE http_requests_in_flight gauge")
+        for stats in routes:
+            lines.append(f"http_requests_in_flight{_labels(method=stats.method, route=stats.route)} {stats.in_flight}")
+
+        declared = set()
+        for name, help_text, labels, stats in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+            lines += _histogram_lines(name, labels, stats.buckets, stats.count, stats.total)
+        for name, kind, help_text, labels, value in gauges:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(**labels) if labels else ''} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class InstrumentedRoute(APIRoute):
+    """APIRoute that records latency, status and in-flight count per route
+
+    Timing covers validation, the endpoint and response serialisation, on
+    a monotonic clock. A streamed body is not included.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        # Resolved once here so the request path does no registry lookups
+        by_method = {method: metrics.route(method, self.path) for method in self.methods}
+
+        async def instrumented_handler(request: Request) -> Response:
+            stats = by_method.get(request.method) or metrics.route(request.method, self.path)
+            stats.in_flight += 1
+            status = 500
+            started = time.perf_counter()
+            try:
+                # Opt-in per-request profiling - a single attribute check while disabled
+                if profiler.token is not None and profiler.authorized(request.headers.get("x-profile")):
+                    response = await profiler.profile_request(handler, request)
+                else:
+                    response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as exc:
+                status = exc.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            finally:
+                stats.observe(time.perf_counter() - started, status)
+                stats.in_flight -= 1
+
+        return instrumented_handler
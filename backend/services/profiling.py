@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import Request, Response
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+# On-demand profiling. Nothing here runs until an authorised caller asks:
+# no sampler thread, no tracemalloc and no profile hook otherwise.
+#
+# Output uses the collapsed-stack format ("root;caller;callee weight" per
+# line) that flamegraph.pl, speedscope and inferno read directly.
+
+def _frame_name(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def collapse_stack(frame) -> str:
+    """Root-first frame names of a stack, joined by ';'"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def format_collapsed(stacks: Dict[str, float]) -> str:
+    lines = [f"{stack} {int(weight)}" for stack, weight in sorted(stacks.items()) if int(weight) > 0]
+    return "\n".join(lines) + ("\n" if lines else "")
+
+class _SamplingThread(threading.Thread):
+    """Samples another thread's stack every interval seconds
+
+    The sampler needs the GIL to read frames, so the effective rate is also
+    bounded by sys.getswitchinterval() while the target thread is busy.
+    """
+
+    def __init__(self, target_thread_id: int, interval: float):
+        super().__init__(name="cpu-sampler", daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is not None:
+                stack = collapse_stack(frame)
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def stop(self) -> Dict[str, int]:
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+class _StackTracer:
+    """sys.setprofile hook that charges elapsed time to the active stack
+
+    Exact rather than sampled, so short requests still get a full profile,
+    but every call pays for a stack walk - only used for opted-in requests.
+    Weights are microseconds.
+    """
+
+    def __init__(self):
+        self.stacks: Dict[str, float] = {}
+        self._stack: Optional[str] = None
+        self._last = time.perf_counter()
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        if self._stack is not None:
+            self.stacks[self._stack] = self.stacks.get(self._stack, 0.0) + (now - self._last) * 1e6
+        if event == "call":
+            self._stack = collapse_stack(frame)
+        elif event == "return":
+            self._stack = collapse_stack(frame.f_back) if frame.f_back is not None else None
+        elif event == "c_call":
+            self._stack = f"{collapse_stack(frame)};<{getattr(arg, '__qualname__', arg)}>"
+        else:
+            self._stack = collapse_stack(frame)
+        self._last = time.perf_counter()
+
+class ProfilerBusy(Exception):
+    """Another profiling session is already running"""
+
+class Profiler:
+    def __init__(self, max_request_profiles: int = 50):
+        # Profiling is off until a token is configured (PROFILING_TOKEN)
+        self.token: Optional[str] = None
+        self.max_request_profiles = max_request_profiles
+        self.request_profiles: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._session_running = False
+        self._request_running = False
+
+    def authorized(self, presented: Optional[str]) -> bool:
+        return (self.token is not None and presented is not None
+                and hmac.compare_digest(presented.encode(), self.token.encode()))
+
+    def _begin_session(self):
+        if self._session_running:
+            raise ProfilerBusy()
+        self._session_running = True
+
+    async def sample_cpu(self, seconds: float, interval: float) -> Dict[str, int]:
+        """Sample the event loop thread for seconds; returns stack -> samples"""
+        self._begin_session()
+        sampler = _SamplingThread(threading.get_ident(), interval)
+        try:
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            samples = sampler.stop()
+            self._session_running = False
+        return samples
+
+    async def trace_allocations(self, seconds: float, limit: int, frames: int) -> dict:
+        """Trace allocations for seconds; returns top sites and collapsed stacks"""
+        if tracemalloc.is_tracing():
+            raise ProfilerBusy()
+        self._begin_session()
+        try:
+            tracemalloc.start(frames)
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            self._session_running = False
+
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        top_sites = [
+            {"file": stat.traceback[-1].filename, "line": stat.traceback[-1].lineno,
+             "size_bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:limit]
+        ]
+        # Frames are oldest first, which is the root-first order collapsed stacks use
+        stacks = {
+            ";".join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback): stat.size
+            for stat in snapshot.statistics("traceback")
+        }
+        return {"top_sites": top_sites, "collapsed_stacks": format_collapsed(stacks)}
+
+    async def profile_request(self, handler: Callable[[Request], Awaitable[Response]], request: Request) -> Response:
+        """Run handler under a stack tracer; the profile id goes in X-Profile-Id
+
+        One request at a time - others arriving meanwhile run unprofiled.
+        Everything else the event loop runs meanwhile is traced too.
+        """
+        if self._request_running:
+            return await handler(request)
+        self._request_running = True
+        tracer = _StackTracer()
+        sys.setprofile(tracer)
+        try:
+            response = await handler(request)
+        finally:
+            sys.setprofile(None)
+            self._request_running = False
+            profile_id = uuid.uuid4().hex[:12]
+            self.request_profiles[profile_id] = tracer.stacks
+            while len(self.request_profiles) > self.max_request_profiles:
+                self.request_profiles.popitem(last=False)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+profiler = Profiler()
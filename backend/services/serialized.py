@@ -0,0 +1,76 @@
+from typing import Dict, List, Optional, Tuple
+from hashlib import blake2b
+from pydantic import TypeAdapter
+from models.schemas import Product, ProductListing
+from services.cache import TTLCache
+from store.memory_store import InMemoryStore, store
+
+_product_list = TypeAdapter(List[Product])
+_listing = TypeAdapter(List[ProductListing])
+
+def make_etag(body: bytes) -> str:
+    # Content hash, so every worker derives the same tag for the same catalog
+    return '"' + blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison as RFC 9110 requires for If-None-Match"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+# Pre-serialised catalog responses - JSON bytes plus strong ETag, rebuilt
+# only after store.catalog_version changes
+class SerializedCatalog:
+    def __init__(self, memory_store: InMemoryStore):
+        self.store = memory_store
+        self._version = -1
+        self._catalog: Optional[Tuple[bytes, str]] = None
+        # Single products as requested - bounded, since a large catalog
+        # would otherwise end up encoded twice in memory
+        self.products = TTLCache(max_entries=10_000, max_bytes=16 * 1024 * 1024)
+        self.rebuilds = 0
+    
+    def _check_version(self):
+        if self._version != self.store.catalog_version:
+            self._version = self.store.catalog_version
+            self._catalog = None
+            self.products.clear()
+    
+    def catalog(self) -> Tuple[bytes, str]:
+        self._check_version()
+        if self._catalog is None:
+            body = _product_list.dump_json(list(self.store.products.values()))
+            self._catalog = (body, make_etag(body))
+            self.rebuilds += 1
+        return self._catalog
+    
+    def product(self, product_id: str) -> Optional[Tuple[bytes, str]]:
+        self._check_version()
+        key = f"product:{product_id}"
+        entry = self.products.get(key)
+        if entry is None:
+            product = self.store.products.get(product_id)
+            if product is None:
+                return None
+            body = product.model_dump_json().encode()
+            entry = (body, make_etag(body))
+            self.products.set(key, entry)
+        return entry
+    
+    def with_availability(self, available: Dict[str, int]) -> bytes:
+        """The listing with free units per product - stock moves with every
+        cart, so this is encoded per call rather than cached"""
+        return _listing.dump_json([
+            ProductListing.model_construct(**vars(product), available=available.get(product.id))
+            for product in self.store.products.values()
+        ])
+
+serialized_catalog = SerializedCatalog(store)
@@ -0,0 +1,210 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from models.schemas import Order
+
+# NumPy vectorises range queries when installed; plain loops otherwise
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOUR = 3600
+# Granularity -> hours per bucket
+GRANULARITIES = {"hour": 1, "day": 24}
+
+# (bucket, product id or None) -> [revenue, units, discount, orders]
+Groups = Dict[Tuple[int, Optional[str]], List[float]]
+
+def hour_of(value: datetime) -> int:
+    """Hours since the epoch (UTC) for a timestamp"""
+    return int(value.timestamp() // HOUR)
+
+def allocate_lines(order: Order, price_of: Callable[[str], Optional[float]]) -> Iterator[Tuple[str, int, float, float]]:
+    """Split an order's total and discount across its lines by list price
+
+    Yields (product id, units, revenue, discount); revenue and discount sum
+    to the order's total and discount_amount.
+    """
+    weights = [(price_of(item.product_id) or 0.0) * item.quantity for item in order.items]
+    if sum(weights) <= 0:
+        weights = [float(item.quantity) for item in order.items]
+    total_weight = sum(weights)
+    for item, weight in zip(order.items, weights):
+        share = weight / total_weight
+        yield item.product_id, item.quantity, order.total * share, order.discount_amount * share
+
+def format_buckets(groups: Groups, step: int) -> List[dict]:
+    rows = []
+    # Products in the same bucket share one start datetime
+    starts: Dict[int, datetime] = {}
+    for (bucket, product_id), (revenue, units, discount, orders) in sorted(
+            groups.items(), key=lambda entry: (entry[0][0], entry[0][1] or "")):
+        start = starts.get(bucket)
+        if start is None:
+            start = starts[bucket] = datetime.fromtimestamp(bucket * step * HOUR, tz=timezone.utc)
+        row = {"start": start}
+        if product_id is not None:
+            row["product_id"] = product_id
+        row.update(revenue=round(revenue, 2), units=int(units),
+                   discount=round(discount, 2), orders=int(orders))
+        rows.append(row)
+    return rows
+
+class _Series:
+    """Typed columns of (hour[, product], revenue, units, discount, orders) rows"""
+
+    def __init__(self, by_product: bool):
+        self.by_product = by_product
+        self.index: Dict[object, int] = {}
+        self.hours = array("q")
+        self.products = array("q")
+        self.metrics = (array("d"), array("q"), array("d"), array("q"))
+        # Cleared if a late order lands in an earlier hour than the last row
+        self.sorted = True
+
+    def __len__(self) -> int:
+        return len(self.hours)
+
+    def add(self, key, hour: int, product: int, revenue: float, units: int, discount: float):
+        row = self.index.get(key)
+        if row is None:
+            if self.hours and hour < self.hours[-1]:
+                self.sorted = False
+            row = self.index[key] = len(self.hours)
+            self.hours.append(hour)
+            if self.by_product:
+                self.products.append(product)
+            for column in self.metrics:
+                column.append(0)
+        revenue_col, units_col, discount_col, orders_col = self.metrics
+        revenue_col[row] += revenue
+        units_col[row] += units
+        discount_col[row] += discount
+        orders_col[row] += 1
+
+    def export_state(self) -> tuple:
+        return (self.hours.tobytes(), self.products.tobytes(),
+                [column.tobytes() for column in self.metrics], self.sorted)
+
+    def import_state(self, state: tuple):
+        hours, products, metrics, self.sorted = state
+        for column, data in zip((self.hours, self.products) + self.metrics, [hours, products] + list(metrics)):
+            del column[:]
+            column.frombytes(data)
+        if self.by_product:
+            self.index = {key: row for row, key in enumerate(zip(self.hours, self.products))}
+        else:
+            self.index = {hour: row for row, hour in enumerate(self.hours)}
+
+    def span(self, first: int, last: int) -> Tuple[int, int]:
+        if not self.sorted:
+            return 0, len(self.hours)
+        return bisect_left(self.hours, first), bisect_right(self.hours, last)
+
+class SalesAnalytics:
+    """Hourly sales counters, updated as orders are recorded
+
+    Two series of typed columns: one row per (hour, product) and one row of
+    order totals per hour. Rows are appended in time order, so a range
+    query is a bisect followed by a grouped sum over the slice - it never
+    touches the orders themselves, and the ungrouped view reads only one
+    row per hour.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.by_product = _Series(by_product=True)
+        self.totals = _Series(by_product=False)
+        self.product_ids: List[str] = []
+        self._product_index: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_product)
+
+    def _product(self, product_id: str) -> int:
+        index = self._product_index.get(product_id)
+        if index is None:
+            index = self._product_index[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+        return index
+
+    def export_state(self) -> tuple:
+        """Raw column bytes for a snapshot - restoring them needs no prices"""
+        return self.by_product.export_state(), self.totals.export_state(), list(self.product_ids)
+
+    def import_state(self, state: tuple):
+        by_product, totals, product_ids = state
+        self.clear()
+        self.by_product.import_state(by_product)
+        self.totals.import_state(totals)
+        self.product_ids = list(product_ids)
+        self._product_index = {product_id: index for index, product_id in enumerate(self.product_ids)}
+
+    def record(self, order: Order, price_of: Callable[[str], Optional[float]]):
+        hour = hour_of(order.created_at)
+        for product_id, units, revenue, discount in allocate_lines(order, price_of):
+            product = self._product(product_id)
+            self.by_product.add((hour, product), hour, product, revenue, units, discount)
+        self.totals.add(hour, hour, 0, order.total, sum(item.quantity for item in order.items),
+                        order.discount_amount)
+
+    def query(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+              granularity: str = "day", group_by: Optional[str] = None) -> List[dict]:
+        """Bucketed revenue, units, discount and orders between start and end
+
+        Bounds are inclusive and resolved to whole hours; buckets are UTC.
+        """
+        step = GRANULARITIES[granularity]
+        first = hour_of(start) if start else -(1 << 62)
+        last = hour_of(end) if end else 1 << 62
+        series = self.by_product if group_by == "product" else self.totals
+        group = self._group_numpy if np is not None else self._group_python
+        return format_buckets(group(series, first, last, step), step)
+
+    def _group_python(self, series: _Series, first: int, last: int, step: int) -> Groups:
+        groups: Groups = {}
+        lo, hi = series.span(first, last)
+        revenue, units, discounts, orders = series.metrics
+        for row in range(lo, hi):
+            hour = series.hours[row]
+            if not first <= hour <= last:
+                continue
+            product_id = self.product_ids[series.products[row]] if series.by_product else None
+            totals = groups.setdefault((hour // step, product_id), [0.0, 0, 0.0, 0])
+            totals[0] += revenue[row]
+            totals[1] += units[row]
+            totals[2] += discounts[row]
+            totals[3] += orders[row]
+        return groups
+
+    def _group_numpy(self, series: _Series, first: int, last: int, step: int) -> Groups:
+        lo, hi = series.span(first, last)
+        # Slicing the array.array copies, so no buffer stays exported and
+        # record() can keep growing the columns
+        hours = np.frombuffer(series.hours[lo:hi], dtype=np.int64)
+        keep = (hours >= first) & (hours <= last)
+        keys = hours[keep] // step
+        width = max(len(self.product_ids), 1)
+        if series.by_product:
+            keys = keys * width + np.frombuffer(series.products[lo:hi], dtype=np.int64)[keep]
+
+        unique, inverse = np.unique(keys, return_inverse=True)
+        # tolist() hands back Python numbers - far cheaper to format than NumPy scalars
+        sums = [
+            np.bincount(inverse, weights=np.frombuffer(column[lo:hi], dtype=column.typecode)[keep],
+                        minlength=len(unique)).tolist()
+            for column in series.metrics
+        ]
+        groups: Groups = {}
+        for i, key in enumerate(unique.tolist()):
+            if series.by_product:
+                bucket, product = divmod(key, width)
+                group_key = (bucket, self.product_ids[product])
+            else:
+                group_key = (key, None)
+            groups[group_key] = [sums[0][i], sums[1][i], sums[2][i], sums[3][i]]
+        return groups
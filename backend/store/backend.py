@@ -0,0 +1,376 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from models.schemas import Cart, Order, DiscountCode
+from store.inventory import OutOfStock
+from store.memory_store import InMemoryStore, discount_code_status, store
+
+class CartNotFound(Exception):
+    pass
+
+class CartChanged(Exception):
+    """The cart was modified after it was read for checkout"""
+
+class DiscountCodeUnavailable(Exception):
+    """The discount code does not exist or was spent concurrently"""
+
+class IdempotencyKeyUsed(Exception):
+    """Another checkout already recorded this Idempotency-Key"""
+
+# Storage interface - what the services need from a backend, all async so
+# implementations can do I/O without blocking the event loop. The catalog
+# is not part of it: every worker serves products from its own
+# InMemoryStore (store.products and its search index).
+class StorageBackend(ABC):
+    # Carts
+    @abstractmethod
+    async def get_cart(self, cart_id: str) -> Optional[Cart]: ...
+
+    @abstractmethod
+    async def create_cart(self, cart: Cart) -> None:
+        """Store a new cart"""
+
+    @abstractmethod
+    async def save_cart(self, cart: Cart) -> None:
+        """Write back a cart read with get_cart, if storage still holds what
+        was read - another worker may have changed or checked it out since
+
+        Raises CartNotFound or CartChanged without writing.
+        """
+
+    @abstractmethod
+    async def delete_cart(self, cart_id: str) -> None:
+        """Delete the cart and release its stock holds"""
+
+    @abstractmethod
+    async def count_carts(self) -> int:
+        """Carts currently stored, across every worker sharing the backend"""
+
+    @abstractmethod
+    async def reap_idle_carts(self, max_batch: int = 1000) -> int:
+        """Delete up to max_batch carts (and their holds) left alone longer
+        than the idle TTL or past the cart cap, least recently used first;
+        returns how many"""
+
+    @abstractmethod
+    async def get_cart_metrics(self) -> dict:
+        """Active carts, the idle TTL and cap, and eviction counts"""
+
+    # Inventory - products without a stock level are untracked
+    @abstractmethod
+    async def set_stock(self, product_id: str, on_hand: Optional[int]) -> None:
+        """Set units on hand; None stops tracking the product"""
+
+    @abstractmethod
+    async def reserve_stock(self, cart_id: str, quantities: Dict[str, int]) -> None:
+        """Set the cart's holds on these products to the given quantities
+        (0 releases) and restart its hold timeout
+
+        Raises OutOfStock without applying anything.
+        """
+
+    @abstractmethod
+    async def get_availability(self) -> List[Tuple[str, int, int]]:
+        """(product id, on hand, reserved) for every tracked product"""
+
+    @abstractmethod
+    async def expire_reservations(self) -> int:
+        """Release holds that outlived their timeout; returns how many"""
+
+    # Orders
+    @abstractmethod
+    async def get_order_counter(self) -> int: ...
+
+    @abstractmethod
+    async def complete_checkout(self, cart: Cart, order: Order, discount_code: Optional[str],
+                                idempotency: Optional[Tuple[str, str]] = None, nth_order: int = 0) -> int:
+        """Atomically delete the cart (if unchanged since read), spend the
+        discount code, sell the cart's held stock, allocate an order number,
+        store the order and record idempotency's (key, request fingerprint)
+        against it. An order number that is a multiple of nth_order is
+        queued for a discount code in the same step (see issue_nth_order_code).
+
+        Returns the order number. Raises IdempotencyKeyUsed, CartNotFound,
+        CartChanged, DiscountCodeUnavailable or OutOfStock without applying
+        anything.
+        """
+
+    @abstractmethod
+    async def issue_nth_order_code(self, order_number: int, discount_code: DiscountCode) -> bool:
+        """Store the code if order_number is still queued for one, and
+        dequeue it; False if it was already issued"""
+
+    @abstractmethod
+    async def pending_nth_order_codes(self) -> List[int]:
+        """Order numbers queued by complete_checkout whose code is not issued yet"""
+
+    @abstractmethod
+    async def get_idempotent_checkout(self, key: str) -> Optional[Tuple[str, str, datetime]]:
+        """(request fingerprint, order id, recorded at) of the checkout that
+        used this Idempotency-Key, if any"""
+
+    @abstractmethod
+    async def purge_idempotency_keys(self, before: datetime, max_batch: int = 1000) -> int:
+        """Forget up to max_batch keys recorded before the cutoff; returns how many"""
+
+    @abstractmethod
+    async def get_order(self, order_id: str) -> Optional[Order]: ...
+
+    @abstractmethod
+    async def list_orders(self, limit: int = 50, cursor: Optional[str] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          cart_id: Optional[str] = None,
+                          product_id: Optional[str] = None) -> Tuple[List[Order], Optional[str]]:
+        """A page of orders in creation order, optionally only those for a
+        cart and/or containing a product; returns (orders, next cursor)"""
+
+    # Discount codes
+    @abstractmethod
+    async def get_discount_code(self, code: str) -> Optional[DiscountCode]: ...
+
+    @abstractmethod
+    async def add_discount_code(self, discount_code: DiscountCode) -> None: ...
+
+    @abstractmethod
+    async def list_discount_codes(self, limit: int = 50, cursor: Optional[str] = None,
+                                  status: Optional[str] = None) -> Tuple[List[DiscountCode], Optional[str]]:
+        """A page of codes in creation order, optionally only 'used',
+        'unused' or 'expired' ones; returns (codes, next cursor)"""
+
+    @abstractmethod
+    async def compact_discount_codes(self, now: datetime, retention: timedelta,
+                                     max_batch: int = 1000) -> Tuple[int, int]:
+        """Move up to max_batch codes that expired into the expired counter,
+        then delete up to max_batch used and expired codes older than
+        retention; returns (expired, compacted). Call again while either
+        count reaches max_batch."""
+
+    # Running totals for the admin dashboard
+    @abstractmethod
+    async def get_statistics(self) -> dict:
+        """total_items_purchased, total_purchase_amount, total_discount_amount,
+        total_orders, used_discount_codes, unused_discount_codes,
+        expired_discount_codes and compacted_discount_codes"""
+
+    @abstractmethod
+    async def get_analytics(self, start: Optional[datetime], end: Optional[datetime],
+                            granularity: str, group_by: Optional[str]) -> List[dict]:
+        """Sales buckets from counters maintained on checkout - see store.analytics"""
+
+    # Seeding and tests only - the services place orders and spend codes
+    # through complete_checkout, which does all of it in one step
+    @abstractmethod
+    async def next_order_number(self) -> int:
+        """Take the next order number on its own (benchmarks/load.py seeding)"""
+
+    @abstractmethod
+    async def add_order(self, order: Order) -> None:
+        """Store an order without a cart, stock or code (benchmarks/load.py seeding)"""
+
+    @abstractmethod
+    async def mark_discount_code_used(self, code: str) -> bool:
+        """Atomically flip an unused code to used; False if missing, already used or expired"""
+
+    async def commit(self) -> None:
+        """Wait until preceding writes are durable"""
+
+    async def close(self) -> None:
+        pass
+
+class InMemoryBackend(StorageBackend):
+    """StorageBackend over an InMemoryStore"""
+
+    def __init__(self, memory_store: InMemoryStore):
+        self.store = memory_store
+
+    async def get_cart(self, cart_id: str) -> Optional[Cart]:
+        cart = self.store.carts.get(cart_id)
+        if cart is None:
+            return None
+        self.store.touch_cart(cart_id)
+        return cart.sync_items()
+
+    async def create_cart(self, cart: Cart) -> None:
+        self.store.add_cart(cart)
+
+    async def save_cart(self, cart: Cart) -> None:
+        # get_cart hands out the stored object, so it is unchanged while
+        # it is still the one stored
+        current = self.store.carts.get(cart.id)
+        if current is None:
+            raise CartNotFound(cart.id)
+        if current is not cart:
+            raise CartChanged(cart.id)
+        self.store.touch_cart(cart.id)
+        self.store.save_cart(cart)
+
+    async def delete_cart(self, cart_id: str) -> None:
+        self.store.remove_cart(cart_id)
+
+    async def count_carts(self) -> int:
+        return len(self.store.carts)
+
+    async def reap_idle_carts(self, max_batch: int = 1000) -> int:
+        # The cap is enforced as carts are added, so only idle ones remain
+        return self.store.reap_idle_carts(max_batch)
+
+    async def get_cart_metrics(self) -> dict:
+        return {
+            "active_carts": len(self.store.carts),
+            "max_carts": self.store.max_carts,
+            "cart_idle_ttl_seconds": self.store.cart_idle_ttl,
+            "evicted_idle": self.store.carts_evicted_idle,
+            "evicted_capacity": self.store.carts_evicted_capacity
+        }
+
+    async def set_stock(self, product_id: str, on_hand: Optional[int]) -> None:
+        self.store.set_stock(product_id, on_hand)
+
+    async def reserve_stock(self, cart_id: str, quantities: Dict[str, int]) -> None:
+        self.store.inventory.reserve(cart_id, quantities)
+
+    async def get_availability(self) -> List[Tuple[str, int, int]]:
+        inventory = self.store.inventory
+        return [(product_id, on_hand, inventory.reserved[product_id])
+                for product_id, on_hand in inventory.on_hand.items()]
+
+    async def expire_reservations(self) -> int:
+        return self.store.inventory.expire()
+
+    async def next_order_number(self) -> int:
+        return self.store.allocate_order_number()
+
+    async def get_order_counter(self) -> int:
+        return self.store.order_counter
+
+    async def complete_checkout(self, cart: Cart, order: Order, discount_code: Optional[str],
+                                idempotency: Optional[Tuple[str, str]] = None, nth_order: int = 0) -> int:
+        # No awaits below - the event loop makes this block atomic
+        if idempotency is not None and idempotency[0] in self.store.idempotency_keys:
+            raise IdempotencyKeyUsed(idempotency[0])
+        current = self.store.carts.get(cart.id)
+        if current is None:
+            raise CartNotFound(cart.id)
+        if current is not cart:
+            raise CartChanged(cart.id)
+        code = None
+        if discount_code is not None:
+            code = self.store.discount_codes.get(discount_code)
+            if code is None or discount_code_status(code, datetime.now()) != "unused":
+                raise DiscountCodeUnavailable(discount_code)
+        # An order the archive cannot take (a duplicate id, a value that
+        # does not fit its columns) is refused before anything is applied
+        self.store.orders.check(order)
+        # Also checked before anything is applied, so a sold-out line changes nothing
+        self.store.commit_stock(cart.id, [(item.product_id, item.quantity) for item in order.items])
+        if code is not None:
+            self.store.mark_discount_code_used(code)
+        order_number = self.store.allocate_order_number()
+        self.store.add_order(order)
+        if idempotency is not None:
+            self.store.record_idempotency_key(*idempotency, order.id, order.created_at)
+        if nth_order and order_number % nth_order == 0:
+            self.store.queue_nth_order_code(order_number)
+        self.store.remove_cart(cart.id)
+        return order_number
+
+    async def issue_nth_order_code(self, order_number: int, discount_code: DiscountCode) -> bool:
+        return self.store.issue_nth_order_code(order_number, discount_code)
+
+    async def pending_nth_order_codes(self) -> List[int]:
+        return sorted(self.store.nth_order_codes_due)
+
+    async def get_idempotent_checkout(self, key: str) -> Optional[Tuple[str, str, datetime]]:
+        return self.store.idempotency_keys.get(key)
+
+    async def purge_idempotency_keys(self, before: datetime, max_batch: int = 1000) -> int:
+        return self.store.purge_idempotency_keys(before, max_batch)
+
+    async def add_order(self, order: Order) -> None:
+        self.store.add_order(order)
+
+    async def get_order(self, order_id: str) -> Optional[Order]:
+        return self.store.orders.get(order_id)
+
+    async def list_orders(self, limit: int = 50, cursor: Optional[str] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          cart_id: Optional[str] = None,
+                          product_id: Optional[str] = None) -> Tuple[List[Order], Optional[str]]:
+        archive = self.store.orders
+        start, end = archive.row_range(created_from, created_to)
+        if cursor is not None:
+            start = max(start, int(cursor))
+        if cart_id is None and product_id is None:
+            stop = min(start + limit, end)
+            orders = archive.slice(start, stop)
+            return orders, (str(stop) if stop < end else None)
+        
+        # Cursor is the row after the last one returned
+        rows = archive.select(start, end, limit + 1, cart_id, product_id)
+        orders = [archive.order_at(row) for row in rows[:limit]]
+        return orders, (str(rows[limit - 1] + 1) if len(rows) > limit else None)
+
+    async def get_discount_code(self, code: str) -> Optional[DiscountCode]:
+        return self.store.discount_codes.get(code)
+
+    async def add_discount_code(self, discount_code: DiscountCode) -> None:
+        self.store.add_discount_code(discount_code)
+
+    async def mark_discount_code_used(self, code: str) -> bool:
+        discount_code = self.store.discount_codes.get(code)
+        if discount_code is None or discount_code_status(discount_code, datetime.now()) != "unused":
+            return False
+        self.store.mark_discount_code_used(discount_code)
+        return True
+
+    async def list_discount_codes(self, limit: int = 50, cursor: Optional[str] = None,
+                                  status: Optional[str] = None) -> Tuple[List[DiscountCode], Optional[str]]:
+        return self.store.discount_code_page(limit, int(cursor) if cursor else None, status, datetime.now())
+
+    async def compact_discount_codes(self, now: datetime, retention: timedelta,
+                                     max_batch: int = 1000) -> Tuple[int, int]:
+        return self.store.compact_discount_codes(now, retention, max_batch)
+
+    async def get_statistics(self) -> dict:
+        return {
+            "total_items_purchased": self.store.total_items_purchased,
+            "total_purchase_amount": self.store.total_purchase_amount,
+            "total_discount_amount": self.store.total_discount_amount,
+            "total_orders": len(self.store.orders),
+            "used_discount_codes": self.store.used_discount_codes,
+            "unused_discount_codes": self.store.unused_discount_codes,
+            "expired_discount_codes": self.store.expired_discount_codes,
+            "compacted_discount_codes": self.store.compacted_discount_codes
+        }
+
+    async def get_analytics(self, start: Optional[datetime], end: Optional[datetime],
+                            granularity: str, group_by: Optional[str]) -> List[dict]:
+        return self.store.analytics.query(start, end, granularity, group_by)
+
+    async def commit(self) -> None:
+        await self.store.commit()
+
+def create_backend(url: Optional[str] = None) -> StorageBackend:
+    """Build a backend from a URL - 'memory' (default) or 'sqlite:///path/to.db'"""
+    if not url or url == "memory":
+        return InMemoryBackend(store)
+    if url.startswith("sqlite:///"):
+        from store.sqlite_store import SQLiteBackend
+        return SQLiteBackend(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported storage backend: {url}")
+
+# Backend used by the services - the in-memory store unless configured
+# otherwise at startup (multi-worker deployments need a shared backend)
+_storage: Optional[StorageBackend] = None
+
+def get_storage() -> StorageBackend:
+    global _storage
+    if _storage is None:
+        _storage = InMemoryBackend(store)
+    return _storage
+
+def configure_storage(backend: Optional[StorageBackend]):
+    global _storage
+    _storage = backend
@@ -0,0 +1,253 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from models.schemas import Product
+from sys import intern
+import heapq
+import re
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# Vocabulary terms the last query token may expand to as a prefix
+MAX_PREFIX_TERMS = 64
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+# Search indexes over the product catalog - kept in sync by InMemoryStore
+class CatalogIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # token -> product ids whose name or description contains it. Most
+        # tokens of a large catalog (model numbers, SKUs) occur in a single
+        # product, so a lone id is stored bare rather than in a set
+        self._postings: Dict[str, Union[str, Set[str]]] = {}
+        # Sorted vocabulary for prefix matching on the last query token
+        self._vocabulary: List[str] = []
+        # Name tokens weigh more than description tokens for relevance;
+        # tuples, as they are only scanned and are far smaller than sets
+        self._name_tokens: Dict[str, Tuple[str, ...]] = {}
+        self._doc_tokens: Dict[str, Tuple[str, ...]] = {}
+        self._by_price: List[Tuple[float, str]] = []
+        self._by_name: List[Tuple[str, str]] = []
+        self._entries: Dict[str, Tuple[float, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, product: Product):
+        if product.id in self._entries:
+            self.remove(product.id)
+
+        # Interned, so every product's token tuples share one string per token
+        name_tokens = set(map(intern, tokenize(product.name)))
+        doc_tokens = name_tokens.union(map(intern, tokenize(product.description)))
+        for token in doc_tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                self._postings[token] = product.id
+                insort(self._vocabulary, token)
+            elif ids.__class__ is str:
+                self._postings[token] = {ids, product.id}
+            else:
+                ids.add(product.id)
+        self._name_tokens[product.id] = tuple(name_tokens)
+        self._doc_tokens[product.id] = tuple(doc_tokens)
+
+        name_key = product.name.lower()
+        insort(self._by_price, (product.price, product.id))
+        insort(self._by_name, (name_key, product.id))
+        self._entries[product.id] = (product.price, name_key)
+
+    def remove(self, product_id: str):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        price, name_key = entry
+
+        for token in self._doc_tokens.pop(product_id):
+            ids = self._postings[token]
+            if ids.__class__ is str:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+            else:
+                ids.discard(product_id)
+                if len(ids) == 1:
+                    self._postings[token] = next(iter(ids))
+        del self._name_tokens[product_id]
+
+        del self._by_price[bisect_left(self._by_price, (price, product_id))]
+        del self._by_name[bisect_left(self._by_name, (name_key, product_id))]
+
+    def _ids(self, token: str) -> Set[str]:
+        ids = self._postings.get(token)
+        if ids is None:
+            return set()
+        return {ids} if ids.__class__ is str else ids
+
+    def _terms(self, tokens: List[str]) -> List[str]:
+        """Vocabulary terms the last query token matches as a prefix, capped
+        so a one-letter token does not pull in half the vocabulary"""
+        last = tokens[-1]
+        start = bisect_left(self._vocabulary, last)
+        end = min(bisect_left(self._vocabulary, last + "\uffff"), start + MAX_PREFIX_TERMS)
+        return self._vocabulary[start:end]
+
+    def _match(self, tokens: List[str], prefix_terms: List[str]) -> Set[str]:
+        """Ids containing every token but the last, and one of prefix_terms
+
+        The result may be an index set itself - callers must not change it.
+        """
+        term_sets = [self._ids(token) for token in tokens[:-1]]
+        if len(prefix_terms) == 1:
+            term_sets.append(self._ids(prefix_terms[0]))
+        else:
+            term_sets.append(set().union(*(self._ids(t) for t in prefix_terms)))
+
+        # Intersect smallest first so the work is bounded by the rarest term
+        term_sets.sort(key=len)
+        result = term_sets[0]
+        for term_set in term_sets[1:]:
+            if not result:
+                break
+            result = result & term_set
+        return result
+
+    def _match_in(self, candidates: Iterable[str], tokens: List[str], prefix_terms: List[str]) -> List[str]:
+        """The candidates matching the query, tested against their own tokens"""
+        required = tokens[:-1]
+        prefixes = set(prefix_terms)
+        doc_tokens = self._doc_tokens
+        matched = []
+        for product_id in candidates:
+            tokens_of = doc_tokens[product_id]
+            if all(token in tokens_of for token in required) and not prefixes.isdisjoint(tokens_of):
+                matched.append(product_id)
+        return matched
+
+    def _score(self, product_id: str, tokens: List[str]) -> int:
+        name_tokens = self._name_tokens[product_id]
+        return sum(2 if token in name_tokens else 1 for token in tokens)
+
+    def search(self, query: Optional[str] = None, min_price: Optional[float] = None,
+               max_price: Optional[float] = None, sort: str = "relevance",
+               offset: int = 0, limit: int = 20) -> Tuple[List[str], int]:
+        """Return (ids for the requested page, total matches)
+
+        Work is bounded by the smaller of the price range and the rarest
+        query term, not by the catalog size.
+        """
+        lo = bisect_left(self._by_price, (min_price, "")) if min_price is not None else 0
+        hi = bisect_right(self._by_price, (max_price, "\uffff")) if max_price is not None else len(self._by_price)
+        hi = max(hi, lo)
+        priced = min_price is not None or max_price is not None
+        entries = self._entries
+
+        tokens = tokenize(query) if query else []
+        if not tokens:
+            # No text query - walk a sorted index directly
+            if sort == "name":
+                if not priced:
+                    page = self._by_name[offset:offset + limit]
+                    return [product_id for _, product_id in page], len(self._by_name)
+                return self._name_page_in_price_range(lo, hi, offset, limit), hi - lo
+
+            if sort == "price_desc":
+                start, stop = max(hi - offset - limit, lo), hi - offset
+                page = self._by_price[start:max(stop, start)][::-1]
+            else:
+                page = self._by_price[lo + offset:min(lo + offset + limit, hi)]
+            return [product_id for _, product_id in page], hi - lo
+
+        prefix_terms = self._terms(tokens)
+        if not prefix_terms or any(token not in self._postings for token in tokens[:-1]):
+            return [], 0
+        # The rarest term bounds a posting-driven query (a prefix by its
+        # summed postings, an upper bound on their union)
+        rarest = min([len(self._ids(token)) for token in tokens[:-1]]
+                     + [sum(len(self._ids(term)) for term in prefix_terms)])
+        if priced and hi - lo < rarest:
+            # Fewer products in the price range than carry the rarest term -
+            # test those against the query instead
+            matched = self._match_in((product_id for _, product_id in self._by_price[lo:hi]),
+                                     tokens, prefix_terms)
+            if sort == "price_asc":
+                return matched[offset:offset + limit], len(matched)
+        else:
+            matched = self._match(tokens, prefix_terms)
+            if priced:
+                low = min_price if min_price is not None else float("-inf")
+                high = max_price if max_price is not None else float("inf")
+                matched = [pid for pid in matched if low <= entries[pid][0] <= high]
+
+        if sort == "name" and (offset + limit) * len(self._by_name) < len(matched) ** 2:
+            # Matches are common enough that walking names finds a page sooner
+            wanted, matched_ids, page = offset + limit, set(matched), []
+            for _, product_id in self._by_name:
+                if product_id in matched_ids:
+                    page.append(product_id)
+                    if len(page) == wanted:
+                        break
+            return page[offset:], len(matched)
+
+        if sort == "price_asc":
+            key = lambda pid: (entries[pid][0], pid)
+        elif sort == "price_desc":
+            key = lambda pid: (-entries[pid][0], pid)
+        elif sort == "name":
+            key = lambda pid: (entries[pid][1], pid)
+        else:
+            key = lambda pid: (-self._score(pid, tokens), entries[pid][1], pid)
+        # Only the top offset + limit need ordering, not every match
+        top = heapq.nsmallest(offset + limit, matched, key=key)
+        return top[offset:], len(matched)
+
+    def _name_page_in_price_range(self, lo: int, hi: int, offset: int, limit: int) -> List[str]:
+        """A page of the products in _by_price[lo:hi], in name order"""
+        wanted = offset + limit
+        in_range = hi - lo
+        if not in_range or offset >= in_range:
+            return []
+        # Walking names reaches wanted matches after about wanted * n /
+        # in_range entries; selecting from the price range costs in_range
+        if wanted * len(self._by_name) // in_range < in_range:
+            low, high = self._by_price[lo][0], self._by_price[hi - 1][0]
+            entries = self._entries
+            page = []
+            for _, product_id in self._by_name:
+                if low <= entries[product_id][0] <= high:
+                    page.append(product_id)
+                    if len(page) == wanted:
+                        break
+            return page[offset:]
+        entries = self._entries
+        top = heapq.nsmallest(wanted, (product_id for _, product_id in self._by_price[lo:hi]),
+                              key=lambda product_id: (entries[product_id][1], product_id))
+        return top[offset:]
+
+    def rebuild(self, products: Iterable[Product]):
+        """Index a whole catalog at once - sorts each index a single time"""
+        self.clear()
+        postings = self._postings
+        get_ids = postings.get
+        for product in products:
+            product_id = product.id
+            name_tokens = set(map(intern, tokenize(product.name)))
+            doc_tokens = name_tokens.union(map(intern, tokenize(product.description)))
+            for token in doc_tokens:
+                ids = get_ids(token)
+                if ids is None:
+                    postings[token] = product_id
+                elif ids.__class__ is str:
+                    postings[token] = {ids, product_id}
+                else:
+                    ids.add(product_id)
+            self._name_tokens[product_id] = tuple(name_tokens)
+            self._doc_tokens[product_id] = tuple(doc_tokens)
+            name_key = product.name.lower()
+            self._by_price.append((product.price, product_id))
+            self._by_name.append((name_key, product_id))
+            self._entries[product_id] = (product.price, name_key)
+        self._vocabulary = sorted(postings)
+        self._by_price.sort()
+        self._by_name.sort()
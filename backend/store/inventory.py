@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import time
+
+# How long a cart's holds last without the cart being changed
+RESERVATION_TTL = 15 * 60
+
+class OutOfStock(Exception):
+    """Not enough unreserved stock of a product"""
+
+    def __init__(self, product_id: str, available: int):
+        super().__init__(product_id)
+        self.product_id = product_id
+        # What this cart could have - free stock plus its own hold
+        self.available = available
+
+class Inventory:
+    """Stock levels and per-cart holds for tracked products
+
+    reserved is a running total per product, so reserving, committing and
+    reading availability cost O(1) per product however many carts hold
+    the same SKU - nothing ever scans the carts. Each call runs without
+    awaiting, which makes it atomic on the event loop without a lock.
+    Products with no stock level are untracked and never run out.
+    """
+
+    def __init__(self, reservation_ttl: float = RESERVATION_TTL):
+        self.reservation_ttl = reservation_ttl
+        self.clear()
+
+    def clear(self):
+        self.on_hand: Dict[str, int] = {}
+        self.reserved: Dict[str, int] = {}
+        # cart id -> product id -> units held
+        self.holds: Dict[str, Dict[str, int]] = {}
+        # cart id -> monotonic expiry; a fixed TTL keeps this in expiry order
+        self.deadlines: "OrderedDict[str, float]" = OrderedDict()
+        self.expired = 0
+
+    def available(self, product_id: str) -> Optional[int]:
+        on_hand = self.on_hand.get(product_id)
+        return None if on_hand is None else on_hand - self.reserved.get(product_id, 0)
+
+    def set_stock(self, product_id: str, on_hand: Optional[int]):
+        if on_hand is not None:
+            self.on_hand[product_id] = on_hand
+            self.reserved.setdefault(product_id, 0)
+            return
+        # Untracking is a rare admin action - dropping its holds may scan
+        if self.on_hand.pop(product_id, None) is not None:
+            self.reserved.pop(product_id, None)
+            for holds in self.holds.values():
+                holds.pop(product_id, None)
+
+    def _shortfall(self, product_id: str, needed: int, held: int) -> None:
+        free = self.on_hand[product_id] - self.reserved[product_id]
+        if needed - held > free:
+            raise OutOfStock(product_id, max(0, free + held))
+
+    def reserve(self, cart_id: str, quantities: Dict[str, int]):
+        """Set the cart's holds to these quantities (0 releases)
+
+        Raises OutOfStock without changing anything.
+        """
+        holds = self.holds.get(cart_id) or {}
+        tracked = [(product_id, quantity) for product_id, quantity in quantities.items()
+                   if product_id in self.on_hand]
+        for product_id, quantity in tracked:
+            self._shortfall(product_id, quantity, holds.get(product_id, 0))
+        for product_id, quantity in tracked:
+            self.reserved[product_id] += quantity - holds.get(product_id, 0)
+            if quantity > 0:
+                holds[product_id] = quantity
+            else:
+                holds.pop(product_id, None)
+
+        if holds:
+            self.holds[cart_id] = holds
+            self.deadlines[cart_id] = time.monotonic() + self.reservation_ttl
+            self.deadlines.move_to_end(cart_id)
+        else:
+            self.release(cart_id)
+
+    def release(self, cart_id: str):
+        for product_id, quantity in (self.holds.pop(cart_id, None) or {}).items():
+            self.reserved[product_id] -= quantity
+        self.deadlines.pop(cart_id, None)
+
+    def commit(self, cart_id: str, items: Iterable[Tuple[str, int]]) -> List[Tuple[str, int]]:
+        """Turn the cart's holds into sales of items
+
+        Lines whose hold lapsed are re-checked against free stock. Raises
+        OutOfStock without changing anything; returns the new on-hand
+        level of every product sold.
+        """
+        holds = self.holds.get(cart_id) or {}
+        tracked = [(product_id, quantity) for product_id, quantity in items if product_id in self.on_hand]
+        for product_id, quantity in tracked:
+            self._shortfall(product_id, quantity, holds.get(product_id, 0))
+
+        levels = []
+        for product_id, quantity in tracked:
+            self.reserved[product_id] -= holds.pop(product_id, 0)
+            self.on_hand[product_id] -= quantity
+            levels.append((product_id, self.on_hand[product_id]))
+        self.release(cart_id)
+        return levels
+
+    def expire(self, max_batch: int = 1000) -> int:
+        """Release up to max_batch carts' holds that outlived the TTL"""
+        now = time.monotonic()
+        released = 0
+        while self.deadlines and released < max_batch:
+            cart_id, deadline = next(iter(self.deadlines.items()))
+            if deadline > now:
+                break
+            self.release(cart_id)
+            released += 1
+        self.expired += released
+        return released
@@ -1,18 +1,581 @@
-from typing import Dict
-from models.schemas import Product, Cart, Order, DiscountCode
-from datetime import datetime
+from bisect import bisect_right, insort
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Set, Tuple
+from models.schemas import Product, Cart, CartItem, Order, DiscountCode
+from datetime import datetime, timedelta
+from store.analytics import SalesAnalytics
+from store.catalog_index import CatalogIndex
+from store.inventory import Inventory
+from store.order_archive import OrderArchive
+from store import persistence
+import asyncio
+import heapq
+import os
+import threading
+import time
+
+def _timestamp(value: Optional[datetime]) -> float:
+    # Codes used before used_at was recorded sort first
+    return value.timestamp() if value is not None else float("-inf")
+
+def discount_code_status(code: DiscountCode, now: datetime) -> str:
+    if code.is_used:
+        return "used"
+    if code.expires_at is not None and code.expires_at <= now:
+        return "expired"
+    return "unused"
 
 class InMemoryStore:
-    def __init__(self):
+    def __init__(self, cart_idle_ttl: float = 24 * 60 * 60, max_carts: int = 100_000):
         self.products: Dict[str, Product] = {}
-        self.carts: Dict[str, Cart] = {}
-        self.orders: Dict[str, Order] = {}
+        self.catalog_index = CatalogIndex()
+        # Bumped on every product change - lets readers cache derived data
+        self.catalog_version = 0
+        # Carts in least-recently-touched order, with monotonic touch times
+        self.carts: "OrderedDict[str, Cart]" = OrderedDict()
+        self.cart_touched: Dict[str, float] = {}
+        self.cart_idle_ttl = cart_idle_ttl
+        self.max_carts = max_carts
+        self.carts_evicted_idle = 0
+        self.carts_evicted_capacity = 0
+        # Completed orders in creation order, stored column-wise
+        self.orders = OrderArchive()
         self.discount_codes: Dict[str, DiscountCode] = {}
+        # Creation sequence numbers (ascending) for stable paging cursors
+        self.discount_code_seqs: List[int] = []
+        self._code_by_seq: Dict[int, str] = {}
+        self._last_code_seq = 0
+        self._code_seq: Dict[str, int] = {}
+        # The same per status, so a filtered page skips other codes;
+        # entries of codes that moved on are counted in _stale_seqs
+        self._status_seqs: Dict[str, List[int]] = {"unused": [], "used": [], "expired": []}
+        self._stale_seqs: Dict[str, int] = {"all": 0, "unused": 0, "used": 0, "expired": 0}
+        # Heaps of (timestamp, seq): unused codes by expiry, used codes by
+        # use time and expired codes by expiry - what compaction pops
+        self._expiry_queue: List[Tuple[float, int]] = []
+        self._used_queue: List[Tuple[float, int]] = []
+        self._lapsed_queue: List[Tuple[float, int]] = []
+        # Unused codes past their expiry (in the expired list)
+        self._lapsed: Set[str] = set()
+        self._uncounted_expired: "deque[str]" = deque()
+        # Unused codes already moved to the expired counter
+        self.expired_codes: Set[str] = set()
+        # Stock levels and cart holds - holds are not logged, they lapse anyway
+        self.inventory = Inventory()
         self.order_counter = 0
+        self._order_counter_lock = threading.Lock()
+        # Idempotency-Key -> (request fingerprint, order id, recorded at),
+        # oldest first so expiry pops from the front
+        self.idempotency_keys: "OrderedDict[str, Tuple[str, str, datetime]]" = OrderedDict()
         self.nth_order = 3
+        # Order numbers owed an nth-order code - queued with the order, so a
+        # crash before the code is issued leaves it here to be retried
+        self.nth_order_codes_due: Set[int] = set()
+        # Write-ahead log - None keeps the store purely in memory
+        self.wal: Optional[persistence.WriteAheadLog] = None
+        # Product records of a catalog replacement being replayed
+        self._replayed_catalog: Optional[List[tuple]] = None
+        # Held from catalog_begin to catalog_commit, so a snapshot never
+        # splits a replacement across the segment it deletes
+        self._catalog_log_lock = asyncio.Lock()
         
+        self.reset_aggregates()
         self._initialize_products()
     
+    def _log(self, *record):
+        if self.wal is not None:
+            self.wal.append(record)
+    
+    # Running totals maintained on write so statistics are O(1) to read
+    def reset_aggregates(self):
+        self.total_items_purchased = 0
+        self.total_purchase_amount = 0.0
+        self.total_discount_amount = 0.0
+        self.used_discount_codes = 0
+        self.unused_discount_codes = 0
+        self.expired_discount_codes = 0
+        # Used and expired codes dropped by compaction - they stay in the counters above
+        self.compacted_discount_codes = 0
+        # Hourly per-product sales for the analytics dashboard
+        self.analytics = SalesAnalytics()
+    
+    def price_of(self, product_id: str) -> Optional[float]:
+        product = self.products.get(product_id)
+        return product.price if product is not None else None
+    
+    # Product writes go through here so the search indexes stay in sync
+    def upsert_product(self, product: Product):
+        self.products[product.id] = product
+        self.catalog_index.add(product)
+        self.catalog_version += 1
+        self._log("product", product.id, product.name, product.price, product.description, product.image_url)
+    
+    def remove_product(self, product_id: str):
+        if self.products.pop(product_id, None) is not None:
+            self.catalog_index.remove(product_id)
+            self.catalog_version += 1
+            self._log("product_del", product_id)
+    
+    async def replace_catalog(self, products: Dict[str, Product], index: CatalogIndex, log_batch: int = 5000):
+        """Swap in a whole catalog built elsewhere, with its search index
+        
+        Both attributes change together with no await in between, so
+        readers see the old catalog or the new one. The log gets the
+        products in batches between begin and commit records, and replay
+        only swaps once it reaches the commit. Batches are written out as
+        they are logged, with one fsync once the commit record is in.
+        """
+        async with self._catalog_log_lock:
+            if self.wal is not None:
+                self._log("catalog_begin")
+                records = [(p.id, p.name, p.price, p.description, p.image_url) for p in products.values()]
+                for start in range(0, len(records), log_batch):
+                    self._log("catalog_batch", records[start:start + log_batch])
+                    # Written as we go so a large catalog never sits whole in the buffer
+                    await self.wal.write_out()
+            # The swap and its commit record go together, after every batch -
+            # a mutation logged meanwhile replays before the swap, as it ran
+            self.products = products
+            self.catalog_index = index
+            self.catalog_version += 1
+            if self.wal is not None:
+                self._log("catalog_commit")
+        if self.wal is not None:
+            await self.wal.sync()
+    
+    def set_stock(self, product_id: str, on_hand: Optional[int]):
+        self.inventory.set_stock(product_id, on_hand)
+        self._log("stock", product_id, on_hand)
+    
+    def commit_stock(self, cart_id: str, items):
+        """Sell the cart's held stock - raises OutOfStock before changing anything"""
+        for product_id, on_hand in self.inventory.commit(cart_id, items):
+            self._log("stock", product_id, on_hand)
+    
+    def add_cart(self, cart: Cart):
+        self.carts[cart.id] = cart
+        self.cart_touched[cart.id] = time.monotonic()
+        self.save_cart(cart)
+        # Hard cap - drop the least recently touched carts
+        while len(self.carts) > self.max_carts:
+            cart_id, _ = self.carts.popitem(last=False)
+            self.cart_touched.pop(cart_id, None)
+            self.inventory.release(cart_id)
+            self._log("cart_del", cart_id)
+            self.carts_evicted_capacity += 1
+    
+    def save_cart(self, cart: Cart):
+        """Record the cart's current lines after a mutation"""
+        if self.wal is not None:
+            lines = [(item.product_id, item.quantity) for item in cart.lines.values()]
+            self._log("cart", cart.id, cart.created_at, lines)
+    
+    def touch_cart(self, cart_id: str):
+        self.carts.move_to_end(cart_id)
+        self.cart_touched[cart_id] = time.monotonic()
+    
+    def remove_cart(self, cart_id: str):
+        if self.carts.pop(cart_id, None) is not None:
+            self._log("cart_del", cart_id)
+        self.cart_touched.pop(cart_id, None)
+        self.inventory.release(cart_id)
+    
+    def reap_idle_carts(self, max_batch: int = 1000) -> int:
+        """Evict up to max_batch carts idle longer than cart_idle_ttl"""
+        deadline = time.monotonic() - self.cart_idle_ttl
+        reaped = 0
+        # Oldest carts sit at the front, so stop at the first live one
+        while self.carts and reaped < max_batch:
+            cart_id = next(iter(self.carts))
+            if self.cart_touched.get(cart_id, 0) > deadline:
+                break
+            self.remove_cart(cart_id)
+            reaped += 1
+        self.carts_evicted_idle += reaped
+        return reaped
+    
+    def allocate_order_number(self) -> int:
+        """Atomically take the next order number"""
+        with self._order_counter_lock:
+            self.order_counter += 1
+            return self.order_counter
+    
+    def add_order(self, order: Order):
+        self.orders.append(order)
+        self.total_items_purchased += sum(item.quantity for item in order.items)
+        self.total_purchase_amount += order.total
+        self.total_discount_amount += order.discount_amount
+        self.analytics.record(order, self.price_of)
+        if self.wal is not None:
+            items = [(item.product_id, item.quantity) for item in order.items]
+            self._log("order", order.id, order.cart_id, items, order.subtotal, order.discount_amount,
+                      order.total, order.discount_code_used, order.created_at, self.order_counter)
+    
+    def queue_nth_order_code(self, order_number: int):
+        self.nth_order_codes_due.add(order_number)
+        self._log("nth_code_due", order_number)
+    
+    def issue_nth_order_code(self, order_number: int, discount_code: DiscountCode) -> bool:
+        if order_number not in self.nth_order_codes_due:
+            return False
+        self.nth_order_codes_due.discard(order_number)
+        self.add_discount_code(discount_code)
+        self._log("nth_code_issued", order_number)
+        return True
+    
+    def record_idempotency_key(self, key: str, fingerprint: str, order_id: str, recorded_at: datetime):
+        self.idempotency_keys[key] = (fingerprint, order_id, recorded_at)
+        self._log("idempotency", key, fingerprint, order_id, recorded_at)
+    
+    def purge_idempotency_keys(self, before: datetime, max_batch: int = 1000) -> int:
+        """Forget up to max_batch keys recorded before the cutoff"""
+        purged = 0
+        while self.idempotency_keys and purged < max_batch:
+            key, (_, _, recorded_at) = next(iter(self.idempotency_keys.items()))
+            if recorded_at >= before:
+                break
+            del self.idempotency_keys[key]
+            self._log("idempotency_del", key)
+            purged += 1
+        return purged
+    
+    def add_discount_code(self, discount_code: DiscountCode):
+        code = discount_code.code
+        self.discount_codes[code] = discount_code
+        self._last_code_seq += 1
+        seq = self._last_code_seq
+        self.discount_code_seqs.append(seq)
+        self._code_by_seq[seq] = code
+        self._code_seq[code] = seq
+        self._lapsed.discard(code)
+        if discount_code.is_used:
+            self.used_discount_codes += 1
+            self._status_seqs["used"].append(seq)
+            heapq.heappush(self._used_queue, (_timestamp(discount_code.used_at), seq))
+        else:
+            self.unused_discount_codes += 1
+            self._status_seqs["unused"].append(seq)
+            if discount_code.expires_at is not None:
+                heapq.heappush(self._expiry_queue, (discount_code.expires_at.timestamp(), seq))
+        self._log("code", discount_code.code, discount_code.order_number, discount_code.is_used,
+                  discount_code.created_at, discount_code.expires_at, discount_code.used_at)
+    
+    def mark_discount_code_used(self, discount_code: DiscountCode, used_at: Optional[datetime] = None):
+        if not discount_code.is_used:
+            left = self._code_list(discount_code)
+            discount_code.is_used = True
+            discount_code.used_at = used_at or datetime.now()
+            self.used_discount_codes += 1
+            self.unused_discount_codes -= 1
+            seq = self._code_seq[discount_code.code]
+            self._leave_code_list(left)
+            insort(self._status_seqs["used"], seq)
+            heapq.heappush(self._used_queue, (_timestamp(discount_code.used_at), seq))
+            self._log("code_used", discount_code.code, discount_code.used_at)
+    
+    def _code_list(self, discount_code: DiscountCode) -> str:
+        """The status list the code's sequence number currently sits in"""
+        if discount_code.is_used:
+            return "used"
+        return "expired" if discount_code.code in self._lapsed else "unused"
+    
+    def _leave_code_list(self, status: str):
+        # Entries are left in place and skipped; a list is rewritten once
+        # more than half of it is stale, so removal is O(1) amortised
+        self._stale_seqs[status] += 1
+        if self._stale_seqs[status] * 2 > len(self._status_seqs[status]):
+            self._compact_code_seqs(status)
+    
+    def _lapse_due_codes(self, now: datetime):
+        """Move unused codes whose expiry has passed into the expired list"""
+        deadline = now.timestamp()
+        lapsed: List[int] = []
+        while self._expiry_queue and self._expiry_queue[0][0] <= deadline:
+            expires_at, seq = heapq.heappop(self._expiry_queue)
+            code = self._live_code(seq)
+            if code is None or code.is_used or code.code in self._lapsed:
+                continue
+            self._lapse(code.code, seq, expires_at)
+            lapsed.append(seq)
+        if lapsed:
+            lapsed.sort()
+            expired = self._status_seqs["expired"]
+            unordered = bool(expired) and lapsed[0] < expired[-1]
+            expired.extend(lapsed)
+            if unordered:
+                # Two sorted runs - timsort merges them in one pass
+                expired.sort()
+            for _ in lapsed:
+                self._leave_code_list("unused")
+    
+    def _lapse(self, code: str, seq: int, expires_at: float):
+        self._lapsed.add(code)
+        heapq.heappush(self._lapsed_queue, (expires_at, seq))
+        if code not in self.expired_codes:
+            self._uncounted_expired.append(code)
+    
+    def _live_code(self, seq: int) -> Optional[DiscountCode]:
+        code = self._code_by_seq.get(seq)
+        if code is None or self._code_seq.get(code) != seq:
+            return None
+        return self.discount_codes.get(code)
+    
+    def _expire_discount_code(self, code: str):
+        self.expired_codes.add(code)
+        if code not in self._lapsed:
+            # Replayed from the log before the code's expiry was seen here
+            seq = self._code_seq[code]
+            expires_at = self.discount_codes[code].expires_at
+            self._lapse(code, seq, expires_at.timestamp() if expires_at is not None else float("-inf"))
+            insort(self._status_seqs["expired"], seq)
+            self._leave_code_list("unused")
+        self.unused_discount_codes -= 1
+        self.expired_discount_codes += 1
+        self._log("code_expired", code)
+    
+    def _drop_discount_code(self, code: str):
+        discount_code = self.discount_codes.get(code)
+        if discount_code is not None:
+            self._leave_code_list(self._code_list(discount_code))
+            self._stale_seqs["all"] += 1
+        self.discount_codes.pop(code, None)
+        self.expired_codes.discard(code)
+        self._lapsed.discard(code)
+        self.compacted_discount_codes += 1
+        self._log("code_compacted", code)
+        if self._stale_seqs["all"] * 2 > len(self.discount_code_seqs):
+            self._compact_code_seqs("all")
+    
+    def compact_discount_codes(self, now: datetime, retention: timedelta,
+                               max_batch: int = 1000) -> Tuple[int, int]:
+        """Count up to max_batch codes that expired since the last run, then
+        drop up to max_batch used and expired codes older than retention;
+        returns (expired, compacted)
+
+        Codes are taken from queues ordered by expiry and use time, so a
+        call does work in proportion to what it changes, not to the number
+        of codes held. Call again while either count reaches max_batch.
+        """
+        self._lapse_due_codes(now)
+        expired = compacted = 0
+        while self._uncounted_expired and expired < max_batch:
+            code = self._uncounted_expired.popleft()
+            discount_code = self.discount_codes.get(code)
+            if discount_code is None or discount_code.is_used or code in self.expired_codes:
+                continue
+            self._expire_discount_code(code)
+            expired += 1
+        
+        cutoff = (now - retention).timestamp()
+        for queue, status in ((self._used_queue, "used"), (self._lapsed_queue, "expired")):
+            while queue and queue[0][0] <= cutoff and compacted < max_batch:
+                _, seq = heapq.heappop(queue)
+                code = self._live_code(seq)
+                if code is None or self._code_list(code) != status:
+                    continue
+                if status == "expired" and code.code not in self.expired_codes:
+                    # Dropped before a counting pass reached it
+                    self._expire_discount_code(code.code)
+                    expired += 1
+                self._drop_discount_code(code.code)
+                compacted += 1
+        return expired, compacted
+    
+    def _compact_code_seqs(self, status: Optional[str] = None):
+        """Rewrite a sequence list (every list by default) without the
+        entries of codes that left it"""
+        for name in ([status] if status else ["all", *self._status_seqs]):
+            if name == "all":
+                self.discount_code_seqs = [seq for seq in self.discount_code_seqs if self._live_code(seq) is not None]
+                self._code_by_seq = {seq: self._code_by_seq[seq] for seq in self.discount_code_seqs}
+            else:
+                self._status_seqs[name] = [
+                    seq for seq in self._status_seqs[name]
+                    if (code := self._live_code(seq)) is not None and self._code_list(code) == name
+                ]
+            self._stale_seqs[name] = 0
+    
+    def discount_code_page(self, limit: int, cursor: Optional[int], status: Optional[str],
+                           now: datetime) -> Tuple[List[DiscountCode], Optional[str]]:
+        """Codes in creation order after cursor (a sequence number), optionally
+        only those that are 'used', 'unused' or 'expired' as of now
+        
+        Each status has its own sequence list, so a filtered page reads
+        only codes in that status (plus entries not yet compacted away).
+        """
+        if status is not None:
+            self._lapse_due_codes(now)
+            seqs = self._status_seqs[status]
+        else:
+            seqs = self.discount_code_seqs
+        page: List[DiscountCode] = []
+        last_seq = None
+        for index in range(bisect_right(seqs, cursor or 0), len(seqs)):
+            code = self._live_code(seqs[index])
+            if code is None or (status is not None and discount_code_status(code, now) != status):
+                continue
+            if len(page) == limit:
+                return page, str(last_seq)
+            page.append(code)
+            last_seq = seqs[index]
+        return page, None
+    
+    async def commit(self):
+        """Wait until logged mutations are durable (no-op without a WAL)"""
+        if self.wal is not None:
+            await self.wal.sync()
+    
+    # Recovery - the same records serve for WAL replay and snapshots
+    def _apply(self, record: tuple):
+        kind = record[0]
+        if kind == "product":
+            _, product_id, name, price, description, image_url = record
+            self.upsert_product(Product(id=product_id, name=name, price=price,
+                                        description=description, image_url=image_url))
+        elif kind == "product_del":
+            self.remove_product(record[1])
+        elif kind == "catalog_begin":
+            self._replayed_catalog = []
+        elif kind == "catalog_batch":
+            if self._replayed_catalog is not None:
+                self._replayed_catalog.extend(record[1])
+        elif kind == "catalog_commit":
+            # A replacement torn before its commit is ignored as a whole
+            if self._replayed_catalog is not None:
+                self._restore_products(self._replayed_catalog)
+                self._replayed_catalog = None
+        elif kind == "cart":
+            _, cart_id, created_at, lines = record
+            items = [CartItem(product_id=product_id, quantity=quantity) for product_id, quantity in lines]
+            self.carts[cart_id] = Cart(id=cart_id, items=items, created_at=created_at)
+            self.carts.move_to_end(cart_id)
+            self.cart_touched[cart_id] = time.monotonic()
+        elif kind == "cart_del":
+            self.remove_cart(record[1])
+        elif kind == "order":
+            _, order_id, cart_id, items, subtotal, discount_amount, total, code, created_at, counter = record
+            self.add_order(Order(
+                id=order_id, cart_id=cart_id,
+                items=[CartItem(product_id=product_id, quantity=quantity) for product_id, quantity in items],
+                subtotal=subtotal, discount_amount=discount_amount, total=total,
+                discount_code_used=code, created_at=created_at
+            ))
+            self.order_counter = counter
+        elif kind == "nth_code_due":
+            self.nth_order_codes_due.add(record[1])
+        elif kind == "nth_code_issued":
+            self.nth_order_codes_due.discard(record[1])
+        elif kind == "idempotency":
+            self.record_idempotency_key(*record[1:])
+        elif kind == "idempotency_del":
+            self.idempotency_keys.pop(record[1], None)
+        elif kind == "code":
+            # Logs written before expiry support have no expires_at/used_at
+            _, code, order_number, is_used, created_at, expires_at, used_at = record + (None,) * (7 - len(record))
+            self.add_discount_code(DiscountCode(code=code, order_number=order_number, is_used=is_used,
+                                                created_at=created_at, expires_at=expires_at, used_at=used_at))
+        elif kind == "code_used":
+            self.mark_discount_code_used(self.discount_codes[record[1]], record[2] if len(record) > 2 else None)
+        elif kind == "code_expired":
+            self._expire_discount_code(record[1])
+        elif kind == "code_compacted":
+            # Paging skips dropped codes; recover() tidies the sequence list once
+            self._drop_discount_code(record[1])
+        elif kind == "code_totals":
+            _, self.used_discount_codes, self.unused_discount_codes, \
+                self.expired_discount_codes, self.compacted_discount_codes = record
+        elif kind == "stock":
+            self.set_stock(record[1], record[2])
+        elif kind == "counter":
+            self.order_counter = record[1]
+    
+    def snapshot_state(self) -> dict:
+        products = [
+            ("product", p.id, p.name, p.price, p.description, p.image_url)
+            for p in self.products.values()
+        ]
+        records = [
+            ("cart", cart.id, cart.created_at, [(i.product_id, i.quantity) for i in cart.lines.values()])
+            for cart in self.carts.values()
+        ]
+        # Orders go as raw columns - building an Order per row is the slow part
+        orders = (self.orders.export_state(), self.analytics.export_state(),
+                  self.total_items_purchased, self.total_purchase_amount, self.total_discount_amount)
+        records.extend(
+            ("code", c.code, c.order_number, c.is_used, c.created_at, c.expires_at, c.used_at)
+            for c in self.discount_codes.values()
+        )
+        records.extend(("code_expired", code) for code in self.expired_codes)
+        records.extend(("nth_code_due", order_number) for order_number in self.nth_order_codes_due)
+        records.extend(
+            ("idempotency", key, fingerprint, order_id, recorded_at)
+            for key, (fingerprint, order_id, recorded_at) in self.idempotency_keys.items()
+        )
+        # Compacted codes are gone, so the counters are restored as they were
+        records.append(("code_totals", self.used_discount_codes, self.unused_discount_codes,
+                        self.expired_discount_codes, self.compacted_discount_codes))
+        records.extend(("stock", product_id, on_hand) for product_id, on_hand in self.inventory.on_hand.items())
+        records.append(("counter", self.order_counter))
+        return {"products": products, "orders": orders, "records": records}
+    
+    def _restore_products(self, records: List[tuple]):
+        products = [
+            Product(id=product_id, name=name, price=price, description=description, image_url=image_url)
+            for product_id, name, price, description, image_url in records
+        ]
+        self.products = {product.id: product for product in products}
+        # One bulk index build instead of an insert per product
+        self.catalog_index.rebuild(products)
+        self.catalog_version += 1
+    
+    def _restore_snapshot(self, state: dict):
+        self._restore_products([record[1:] for record in state["products"]])
+        # Older snapshots carry orders as "order" records instead
+        if "orders" in state:
+            orders, analytics, self.total_items_purchased, self.total_purchase_amount, \
+                self.total_discount_amount = state["orders"]
+            self.orders.import_state(orders)
+            self.analytics.import_state(analytics)
+        for record in state["records"]:
+            self._apply(record)
+    
+    def recover(self, data_dir: str) -> int:
+        """Load the newest snapshot and replay the WAL tail; returns records replayed"""
+        wal, self.wal = self.wal, None
+        try:
+            state, first_segment = persistence.load_snapshot(data_dir)
+            if state is not None:
+                self._restore_snapshot(state)
+            replayed = persistence.replay_segments(data_dir, first_segment, self._apply)
+            self._replayed_catalog = None
+            self._compact_code_seqs()
+            return replayed
+        finally:
+            self.wal = wal
+    
+    def open_wal(self, data_dir: str, commit_delay: float = 0.002):
+        """Recover from data_dir, then log every further mutation to it"""
+        os.makedirs(data_dir, exist_ok=True)
+        self.recover(data_dir)
+        self.wal = persistence.WriteAheadLog(data_dir, commit_delay=commit_delay)
+    
+    async def snapshot(self):
+        """Write a snapshot and drop the WAL segments it covers"""
+        if self.wal is None:
+            return
+        # Not in the middle of a catalog replacement - its begin record
+        # would go with the old segment and its commit would replay alone
+        async with self._catalog_log_lock:
+            segment = await self.wal.rotate()
+            # No await between rotate and capture - the state matches the segment boundary
+            state = self.snapshot_state()
+        await asyncio.to_thread(persistence.write_snapshot, self.wal.data_dir, segment, state)
+    
+    async def run_snapshotter(self, interval: float = 300.0):
+        while True:
+            await asyncio.sleep(interval)
+            await self.snapshot()
+    
     def _initialize_products(self):
         sample_products = [
             Product(id="1", name="Wireless Headphones", price=99.99, 
@@ -35,6 +598,6 @@ class InMemoryStore:
                    image_url="https://images.unsplash.com/photo-1527443224154-c4a3942d3acf?w=500&q=80"),
         ]
         for product in sample_products:
-            self.products[product.id] = product
+            self.upsert_product(product)
 
 store = InMemoryStore()
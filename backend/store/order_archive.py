@@ -0,0 +1,269 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from models.schemas import CartItem, Order
+
+def _to_micros(value: datetime) -> int:
+    """Exact epoch microseconds (naive datetimes are local time, as in timestamp())"""
+    return int(value.replace(microsecond=0).timestamp()) * 1_000_000 + value.microsecond
+
+def _from_micros(micros: int) -> datetime:
+    seconds, microsecond = divmod(micros, 1_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=microsecond)
+
+def _uuid_bytes(value: str) -> Optional[bytes]:
+    """16 raw bytes for a canonical lowercase UUID string, else None"""
+    if len(value) != 36 or value[8] != "-" or value[13] != "-" or value[18] != "-" or value[23] != "-":
+        return None
+    try:
+        packed = bytes.fromhex(value.replace("-", ""))
+    except ValueError:
+        return None
+    # fromhex also takes upper case and spaces - only exact round trips qualify
+    return packed if len(packed) == 16 and _format_uuid(packed) == value else None
+
+def _format_uuid(packed: bytes) -> str:
+    h = packed.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+class _IdColumn:
+    """Fixed 16-byte slots for UUID ids, with other ids kept aside"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.other: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.data) // 16
+
+    def append(self, value: str, packed: Optional[bytes]):
+        if packed is None:
+            self.other[len(self)] = value
+            self.data += bytes(16)
+        else:
+            self.data += packed
+
+    def get(self, row: int) -> str:
+        value = self.other.get(row)
+        if value is None:
+            value = _format_uuid(self.data[row * 16:row * 16 + 16])
+        return value
+
+class OrderArchive:
+    """Append-only columnar storage for completed orders
+
+    Each order is one row across typed arrays instead of a pydantic model
+    tree - UUIDs packed to 16 bytes, product ids interned, amounts as
+    doubles and creation times as epoch microseconds. Order objects are
+    rebuilt on demand. Rows stay in insertion (creation) order, so
+    created_us is sorted and date ranges are a bisect.
+
+    Secondary indexes map a cart id to its rows and a product to the
+    sorted rows of orders containing it, so filtered lookups cost
+    O(log n + k) rather than a scan.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._rows: Dict[object, int] = {}
+        self._ids = _IdColumn()
+        self._cart_ids = _IdColumn()
+        # Discounted orders are a minority - only those carry a code
+        self._codes: Dict[int, str] = {}
+        self.subtotals = array("d")
+        self.discounts = array("d")
+        self.totals = array("d")
+        self.created_us = array("q")
+        # Row i's items are item_products/item_quantities[item_offsets[i]:item_offsets[i + 1]]
+        self.item_offsets = array("I", [0])
+        self.item_products = array("I")
+        # Quantities are only bounded below, so they get the widest column
+        self.item_quantities = array("q")
+        # Interned product ids - item_products holds indexes into this list
+        self.product_ids: List[str] = []
+        self._product_index: Dict[str, int] = {}
+        # Interned product -> ascending rows of orders containing it
+        self._product_rows: List[array] = []
+        # Cart id -> first row; a cart rarely has more than one order, so
+        # any further rows live in a side table
+        self._cart_rows: Dict[object, int] = {}
+        self._more_cart_rows: Dict[object, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.totals)
+
+    def __contains__(self, order_id: str) -> bool:
+        return self._row_of(order_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._ids.get(row) for row in range(len(self)))
+
+    def __getitem__(self, order_id: str) -> Order:
+        row = self._row_of(order_id)
+        if row is None:
+            raise KeyError(order_id)
+        return self.order_at(row)
+
+    def get(self, order_id: str, default=None) -> Optional[Order]:
+        row = self._row_of(order_id)
+        return default if row is None else self.order_at(row)
+
+    def values(self) -> Iterator[Order]:
+        return (self.order_at(row) for row in range(len(self)))
+
+    def _row_of(self, order_id: str) -> Optional[int]:
+        return self._rows.get(_uuid_bytes(order_id) or order_id)
+
+    def _intern_product(self, product_id: str) -> int:
+        index = self._product_index.get(product_id)
+        if index is None:
+            index = self._product_index[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+            self._product_rows.append(array("I"))
+        return index
+
+    def _pack(self, order: Order):
+        """The order's values in their column types; raises if any does not fit"""
+        packed = _uuid_bytes(order.id)
+        key = packed or order.id
+        if key in self._rows:
+            raise ValueError(f"Duplicate order id: {order.id}")
+        packed_cart = _uuid_bytes(order.cart_id)
+        quantities = array("q", [item.quantity for item in order.items])
+        amounts = array("d", [order.subtotal, order.discount_amount, order.total])
+        created = array("q", [_to_micros(order.created_at)])
+        offset = array("I", [len(self.item_products) + len(quantities)])
+        return key, packed, packed_cart, quantities, amounts, created, offset
+
+    def check(self, order: Order):
+        """Raise whatever append would, without writing anything"""
+        self._pack(order)
+
+    def append(self, order: Order):
+        """Add one row - all or nothing
+
+        Every value is packed into its column type first, so an order that
+        does not fit (a quantity past 64 bits, an unrepresentable date)
+        raises before any column or index is touched.
+        """
+        key, packed, packed_cart, quantities, amounts, created, offset = self._pack(order)
+        cart_key = packed_cart or order.cart_id
+        row = len(self)
+        self._rows[key] = row
+        self._ids.append(order.id, packed)
+        self._cart_ids.append(order.cart_id, packed_cart)
+        if cart_key in self._cart_rows:
+            self._more_cart_rows.setdefault(cart_key, []).append(row)
+        else:
+            self._cart_rows[cart_key] = row
+        if order.discount_code_used is not None:
+            self._codes[row] = order.discount_code_used
+        for item in order.items:
+            product = self._intern_product(item.product_id)
+            self.item_products.append(product)
+            product_rows = self._product_rows[product]
+            if not product_rows or product_rows[-1] != row:
+                product_rows.append(row)
+        self.item_quantities.extend(quantities)
+        self.item_offsets.extend(offset)
+        self.subtotals.append(amounts[0])
+        self.discounts.append(amounts[1])
+        self.created_us.extend(created)
+        # Appended last - len() counts only fully written rows
+        self.totals.append(amounts[2])
+
+    def order_at(self, row: int) -> Order:
+        # Rows were validated on the way in, so skip re-validation
+        start, end = self.item_offsets[row], self.item_offsets[row + 1]
+        items = [
+            CartItem.model_construct(product_id=self.product_ids[product], quantity=quantity)
+            for product, quantity in zip(self.item_products[start:end], self.item_quantities[start:end])
+        ]
+        return Order.model_construct(
+            id=self._ids.get(row), cart_id=self._cart_ids.get(row), items=items,
+            subtotal=self.subtotals[row], discount_amount=self.discounts[row], total=self.totals[row],
+            discount_code_used=self._codes.get(row), created_at=_from_micros(self.created_us[row])
+        )
+
+    def slice(self, start: int, stop: int) -> List[Order]:
+        return [self.order_at(row) for row in range(start, min(stop, len(self)))]
+
+    def row_range(self, created_from: Optional[datetime] = None,
+                  created_to: Optional[datetime] = None) -> Tuple[int, int]:
+        """[start, end) rows created within the inclusive bounds"""
+        start = bisect_left(self.created_us, _to_micros(created_from)) if created_from else 0
+        end = bisect_right(self.created_us, _to_micros(created_to)) if created_to else len(self)
+        return start, end
+
+    def rows_for_cart(self, cart_id: str) -> List[int]:
+        key = _uuid_bytes(cart_id) or cart_id
+        first = self._cart_rows.get(key)
+        if first is None:
+            return []
+        return [first] + self._more_cart_rows.get(key, [])
+
+    def _contains_product(self, row: int, product: int) -> bool:
+        return product in self.item_products[self.item_offsets[row]:self.item_offsets[row + 1]]
+
+    def select(self, start: int, end: int, limit: int, cart_id: Optional[str] = None,
+               product_id: Optional[str] = None) -> List[int]:
+        """Up to limit rows in [start, end), ascending, for cart_id and/or
+        containing product_id - at least one of the two must be given"""
+        product = self._product_index.get(product_id) if product_id is not None else None
+        if product_id is not None and product is None:
+            return []
+        if cart_id is not None:
+            rows = [row for row in self.rows_for_cart(cart_id)
+                    if start <= row < end and (product is None or self._contains_product(row, product))]
+            return rows[:limit]
+        rows = self._product_rows[product]
+        lo = bisect_left(rows, start)
+        return rows[lo:min(bisect_left(rows, end), lo + limit)].tolist()
+
+    def _columns(self) -> tuple:
+        return (self.subtotals, self.discounts, self.totals, self.created_us,
+                self.item_offsets, self.item_products, self.item_quantities)
+
+    def export_state(self) -> tuple:
+        """The columns as raw bytes, for a snapshot - no Order is built"""
+        return (bytes(self._ids.data), dict(self._ids.other), bytes(self._cart_ids.data),
+                dict(self._cart_ids.other), dict(self._codes), [column.tobytes() for column in self._columns()],
+                list(self.product_ids), [rows.tobytes() for rows in self._product_rows])
+
+    def import_state(self, state: tuple):
+        """Replace the contents with an export_state() result and rebuild the id indexes"""
+        ids, other_ids, cart_ids, other_cart_ids, codes, columns, product_ids, product_rows = state
+        self.clear()
+        self._ids.data[:], self._ids.other = ids, dict(other_ids)
+        self._cart_ids.data[:], self._cart_ids.other = cart_ids, dict(other_cart_ids)
+        self._codes = dict(codes)
+        for column, data in zip(self._columns(), columns):
+            del column[:]
+            column.frombytes(data)
+        self.product_ids = list(product_ids)
+        self._product_index = {product_id: index for index, product_id in enumerate(self.product_ids)}
+        for data in product_rows:
+            rows = array("I")
+            rows.frombytes(data)
+            self._product_rows.append(rows)
+        # Packed slots are keyed by their bytes, the rest by the id itself
+        for row in range(len(self._ids)):
+            key = self._ids.other.get(row)
+            self._rows[ids[row * 16:row * 16 + 16] if key is None else key] = row
+        for row in range(len(self._cart_ids)):
+            key = self._cart_ids.other.get(row)
+            if key is None:
+                key = cart_ids[row * 16:row * 16 + 16]
+            if key in self._cart_rows:
+                self._more_cart_rows.setdefault(key, []).append(row)
+            else:
+                self._cart_rows[key] = row
+
+    def nbytes(self) -> int:
+        """Approximate size of the column buffers (excluding the id index)"""
+        return (len(self._ids.data) + len(self._cart_ids.data)
+                + sum(column.itemsize * len(column) for column in self._columns())
+                + sum(rows.itemsize * len(rows) for rows in self._product_rows))
@@ -0,0 +1,262 @@
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+import asyncio
+import io
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+# Write-ahead log + snapshots for InMemoryStore.
+#
+# data_dir holds numbered WAL segments (wal-000001.log, ...) and snapshots
+# (snapshot-000002.snap). A snapshot numbered N contains every mutation from
+# segments < N, so recovery loads the newest snapshot and replays only
+# segments >= N. Records are framed as <length><crc32><pickled tuple>.
+
+_RECORD_HEADER = struct.Struct("<II")
+_SNAPSHOT_MAGIC = b"ECSNAP01"
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    """Only plain containers, scalars and datetimes may be loaded"""
+    _ALLOWED = {("datetime", "datetime")}
+
+    def find_class(self, module: str, name: str):
+        if (module, name) in self._ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name}")
+
+def _loads(data) -> Any:
+    return _RestrictedUnpickler(io.BytesIO(data)).load()
+
+def _segment_path(data_dir: str, number: int) -> str:
+    return os.path.join(data_dir, f"wal-{number:06d}.log")
+
+def _snapshot_path(data_dir: str, number: int) -> str:
+    return os.path.join(data_dir, f"snapshot-{number:06d}.snap")
+
+def _numbered(data_dir: str, prefix: str, suffix: str) -> List[int]:
+    numbers = []
+    for name in os.listdir(data_dir):
+        if name.startswith(prefix) and name.endswith(suffix):
+            numbers.append(int(name[len(prefix):-len(suffix)]))
+    return sorted(numbers)
+
+def read_segment(path: str) -> Iterator[Tuple[tuple, int]]:
+    """Yield (record, end offset) until the end or the first torn record"""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, crc = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield _loads(payload), offset
+
+class WriteAheadLog:
+    """Append-only log with group commit
+
+    append() only buffers the record. A flusher task writes the buffer and
+    fsyncs once per commit window, so concurrent writers share one fsync;
+    callers that need durability await sync() for their record's LSN.
+    """
+
+    def __init__(self, data_dir: str, commit_delay: float = 0.002, max_buffer_bytes: int = 1 << 20):
+        self.data_dir = data_dir
+        self.commit_delay = commit_delay
+        self.max_buffer_bytes = max_buffer_bytes
+        os.makedirs(data_dir, exist_ok=True)
+        segments = _numbered(data_dir, "wal-", ".log")
+        self.segment = segments[-1] if segments else 1
+        self._file = open(_segment_path(data_dir, self.segment), "ab")
+        self._buffer: List[bytes] = []
+        self._buffer_bytes = 0
+        self._next_lsn = 0
+        self._durable_lsn = 0
+        self._waiters: List[Tuple[int, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Bytes written by write_out() that no fsync has covered yet
+        self._unsynced = False
+        self.fsync_count = 0
+
+    def append(self, record: tuple) -> int:
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self._buffer.append(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._buffer_bytes += len(payload) + _RECORD_HEADER.size
+        self._next_lsn += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._buffer_bytes >= self.max_buffer_bytes and self._flusher is None:
+            self.flush()
+        return self._next_lsn
+
+    def _take_buffer(self) -> Tuple[bytes, int]:
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        return data, self._next_lsn
+
+    def _write(self, data: bytes):
+        if data:
+            self._file.write(data)
+            self._file.flush()
+        if data or self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+            self.fsync_count += 1
+    
+    def _write_unsynced(self, data: bytes):
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            self._unsynced = True
+
+    def _mark_durable(self, lsn: int):
+        self._durable_lsn = max(self._durable_lsn, lsn)
+        still_waiting = []
+        for target, future in self._waiters:
+            if target <= self._durable_lsn:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                still_waiting.append((target, future))
+        self._waiters = still_waiting
+
+    def flush(self):
+        """Synchronously write and fsync everything buffered"""
+        data, lsn = self._take_buffer()
+        self._write(data)
+        self._mark_durable(lsn)
+
+    async def write_out(self):
+        """Write everything buffered without fsync - keeps the buffer small
+        during a bulk append; records are durable only after sync()"""
+        if self._flusher is None:
+            data, _ = self._take_buffer()
+            self._write_unsynced(data)
+            return
+        # Under the flusher's lock, so writes reach the file in LSN order
+        async with self._write_lock:
+            data, _ = self._take_buffer()
+            await asyncio.to_thread(self._write_unsynced, data)
+    
+    async def sync(self, lsn: Optional[int] = None):
+        """Wait until the record with this LSN (default: latest) is durable"""
+        lsn = self._next_lsn if lsn is None else lsn
+        if lsn <= self._durable_lsn:
+            return
+        if self._flusher is None:
+            self.flush()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((lsn, future))
+        self._wakeup.set()
+        await future
+
+    async def _run_flusher(self):
+        while not self._stopping:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Let concurrent writers join this commit group
+            await asyncio.sleep(self.commit_delay)
+            async with self._write_lock:
+                data, lsn = self._take_buffer()
+                if data or self._unsynced:
+                    await asyncio.to_thread(self._write, data)
+                self._mark_durable(lsn)
+
+    def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        if self._flusher is not None:
+            # Let the in-flight commit finish rather than cancelling its write
+            self._stopping = True
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        self.flush()
+
+    async def rotate(self) -> int:
+        """Flush, then start a new segment; returns the new segment number"""
+        if self._flusher is None:
+            return self._rotate()
+        async with self._write_lock:
+            return self._rotate()
+
+    def _rotate(self) -> int:
+        self.flush()
+        self._file.close()
+        self.segment += 1
+        self._file = open(_segment_path(self.data_dir, self.segment), "ab")
+        return self.segment
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def write_snapshot(data_dir: str, number: int, state: dict):
+    """Atomically write a snapshot covering every segment below number"""
+    path = _snapshot_path(data_dir, number)
+    tmp_path = path + ".tmp"
+    payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(tmp_path, "wb") as f:
+        f.write(_SNAPSHOT_MAGIC)
+        f.write(struct.pack("<I", zlib.crc32(payload)))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Older snapshots and the segments they cover are no longer needed
+    for old in _numbered(data_dir, "snapshot-", ".snap"):
+        if old < number:
+            os.remove(_snapshot_path(data_dir, old))
+    for old in _numbered(data_dir, "wal-", ".log"):
+        if old < number:
+            os.remove(_segment_path(data_dir, old))
+
+def load_snapshot(data_dir: str) -> Tuple[Optional[dict], int]:
+    """Return (state, first segment to replay) from the newest valid snapshot"""
+    header = len(_SNAPSHOT_MAGIC) + 4
+    for number in reversed(_numbered(data_dir, "snapshot-", ".snap")):
+        with open(_snapshot_path(data_dir, number), "rb") as f:
+            # Memory-mapped so the payload is checked and unpickled in place
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) < header or mm[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+                    continue
+                (crc,) = struct.unpack("<I", mm[len(_SNAPSHOT_MAGIC):header])
+                with memoryview(mm) as view:
+                    valid = zlib.crc32(view[header:]) == crc
+                if not valid:
+                    continue
+                mm.seek(header)
+                return _RestrictedUnpickler(mm).load(), number
+    return None, 1
+
+def replay_segments(data_dir: str, first_segment: int, apply: Callable[[tuple], None]) -> int:
+    """Apply WAL records from first_segment onwards; returns records applied"""
+    applied = 0
+    for number in _numbered(data_dir, "wal-", ".log"):
+        if number < first_segment:
+            continue
+        path = _segment_path(data_dir, number)
+        valid_end = 0
+        for record, end in read_segment(path):
+            apply(record)
+            valid_end = end
+            applied += 1
+        # Drop a torn tail left by a crash mid-write
+        if valid_end < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid_end)
+    return applied
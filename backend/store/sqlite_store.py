@@ -0,0 +1,692 @@
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from models.schemas import Cart, CartItem, Order, DiscountCode
+from store.analytics import GRANULARITIES, allocate_lines, format_buckets, hour_of
+from store.backend import StorageBackend, CartNotFound, CartChanged, DiscountCodeUnavailable, IdempotencyKeyUsed
+from store.inventory import RESERVATION_TTL, OutOfStock
+from store.memory_store import store
+import asyncio
+import json
+import sqlite3
+import time
+
+# No products table - every worker serves the catalog from its own
+# InMemoryStore, and prices for analytics come from there too
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS carts (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    items TEXT NOT NULL,
+    -- Epoch seconds of the last use, for the idle cart reaper
+    touched_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    cart_id TEXT NOT NULL,
+    items TEXT NOT NULL,
+    subtotal REAL NOT NULL,
+    discount_amount REAL NOT NULL,
+    total REAL NOT NULL,
+    discount_code_used TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_cart_id ON orders (cart_id);
+-- Orders containing each product, in seq order
+CREATE TABLE IF NOT EXISTS order_items (
+    product_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (product_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS discount_codes (
+    code TEXT PRIMARY KEY,
+    order_number INTEGER NOT NULL,
+    is_used INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    expires_at REAL,
+    used_at REAL,
+    -- Set once the code has been moved to the expired counter
+    is_expired INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value NUMERIC NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sales_buckets (
+    hour INTEGER NOT NULL,
+    product_id TEXT NOT NULL,
+    revenue REAL NOT NULL,
+    units INTEGER NOT NULL,
+    discount REAL NOT NULL,
+    orders INTEGER NOT NULL,
+    PRIMARY KEY (hour, product_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sales_hours (
+    hour INTEGER PRIMARY KEY,
+    revenue REAL NOT NULL,
+    units INTEGER NOT NULL,
+    discount REAL NOT NULL,
+    orders INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inventory (
+    product_id TEXT PRIMARY KEY,
+    on_hand INTEGER NOT NULL,
+    reserved INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reservations (
+    cart_id TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (cart_id, product_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_reservations_expires_at ON reservations (expires_at);
+-- Idempotency-Key of each keyed checkout, written with its order
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+-- Order numbers owed an nth-order discount code, queued with the order
+CREATE TABLE IF NOT EXISTS nth_order_codes_due (
+    order_number INTEGER PRIMARY KEY
+);
+"""
+
+# Columns added after a table was first created - (table, column, definition)
+_ADDED_COLUMNS = (
+    ("discount_codes", "expires_at", "REAL"),
+    ("discount_codes", "used_at", "REAL"),
+    ("discount_codes", "is_expired", "INTEGER NOT NULL DEFAULT 0"),
+    ("carts", "touched_at", "REAL NOT NULL DEFAULT 0"),
+)
+
+def _migrate(conn: sqlite3.Connection):
+    for table, column, definition in _ADDED_COLUMNS:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    # Indexes on added columns can only be created once the columns exist
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_discount_codes_expires_at ON discount_codes (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_carts_touched_at ON carts (touched_at)")
+    # Carts stored before touched_at existed count as used now, not idle forever
+    conn.execute("UPDATE carts SET touched_at = ? WHERE touched_at = 0", (time.time(),))
+    # Index orders written before order_items existed
+    if (conn.execute("SELECT 1 FROM orders LIMIT 1").fetchone()
+            and not conn.execute("SELECT 1 FROM order_items LIMIT 1").fetchone()):
+        conn.execute(
+            "INSERT OR IGNORE INTO order_items (product_id, seq) "
+            "SELECT json_extract(line.value, '$[0]'), orders.seq FROM orders, json_each(orders.items) AS line"
+        )
+
+# Statements are module constants so sqlite3's per-connection statement
+# cache reuses the prepared form on every call
+_GET_CART = "SELECT id, created_at, items, touched_at FROM carts WHERE id = ?"
+_INSERT_CART = "INSERT INTO carts (id, created_at, items, touched_at) VALUES (?, ?, ?, ?)"
+# Compare-and-set on the lines read - a cart another worker changed or
+# checked out since is not overwritten or brought back
+_UPDATE_UNCHANGED_CART = "UPDATE carts SET items = ?, touched_at = ? WHERE id = ? AND items = ?"
+_TOUCH_CART = "UPDATE carts SET touched_at = ? WHERE id = ?"
+_DELETE_CART = "DELETE FROM carts WHERE id = ?"
+_COUNT_CARTS = "SELECT COUNT(*) FROM carts"
+# Least recently used first, on the touched_at index
+_IDLE_CARTS = "SELECT id FROM carts WHERE touched_at <= ? ORDER BY touched_at LIMIT ?"
+_OLDEST_CARTS = "SELECT id FROM carts ORDER BY touched_at LIMIT ?"
+_NEXT_ORDER_NUMBER = (
+    "INSERT INTO counters (name, value) VALUES ('order_counter', 1) "
+    "ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value"
+)
+_GET_COUNTER = "SELECT value FROM counters WHERE name = ?"
+_ADD_TO_COUNTER = (
+    "INSERT INTO counters (name, value) VALUES (?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value"
+)
+_LIST_COUNTERS = "SELECT name, value FROM counters"
+_DELETE_UNCHANGED_CART = "DELETE FROM carts WHERE id = ? AND items = ?"
+_CART_EXISTS = "SELECT 1 FROM carts WHERE id = ?"
+_ORDER_COLUMNS = "id, cart_id, items, subtotal, discount_amount, total, discount_code_used, created_at"
+_ADD_ORDER = f"INSERT INTO orders ({_ORDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+_GET_ORDER = f"SELECT {_ORDER_COLUMNS} FROM orders WHERE id = ?"
+_LIST_ORDERS = (
+    f"SELECT seq, {_ORDER_COLUMNS} FROM orders "
+    "WHERE seq > ? AND created_at >= ? AND created_at <= ? ORDER BY seq LIMIT ?"
+)
+_LIST_CART_ORDERS = (
+    f"SELECT seq, {_ORDER_COLUMNS} FROM orders "
+    "WHERE cart_id = ? AND seq > ? AND created_at >= ? AND created_at <= ? ORDER BY seq LIMIT ?"
+)
+# A range scan of order_items' primary key, then a seq lookup per order
+_LIST_PRODUCT_ORDERS = (
+    f"SELECT orders.seq, {_ORDER_COLUMNS} FROM order_items JOIN orders ON orders.seq = order_items.seq "
+    "WHERE order_items.product_id = ? AND order_items.seq > ? AND created_at >= ? AND created_at <= ? "
+    "AND cart_id = coalesce(?, cart_id) ORDER BY order_items.seq LIMIT ?"
+)
+_ADD_ORDER_ITEM = "INSERT OR IGNORE INTO order_items (product_id, seq) VALUES (?, ?)"
+_ADD_SALES = (
+    "INSERT INTO sales_buckets (hour, product_id, revenue, units, discount, orders) VALUES (?, ?, ?, ?, ?, 1) "
+    "ON CONFLICT(hour, product_id) DO UPDATE SET revenue = revenue + excluded.revenue, "
+    "units = units + excluded.units, discount = discount + excluded.discount, orders = orders + 1"
+)
+_ADD_SALES_HOUR = (
+    "INSERT INTO sales_hours (hour, revenue, units, discount, orders) VALUES (?, ?, ?, ?, 1) "
+    "ON CONFLICT(hour) DO UPDATE SET revenue = revenue + excluded.revenue, "
+    "units = units + excluded.units, discount = discount + excluded.discount, orders = orders + 1"
+)
+_SALES_BY_PRODUCT = (
+    "SELECT hour / ?, product_id, SUM(revenue), SUM(units), SUM(discount), SUM(orders) "
+    "FROM sales_buckets WHERE hour BETWEEN ? AND ? GROUP BY 1, 2"
+)
+_SALES_TOTALS = (
+    "SELECT hour / ?, NULL, SUM(revenue), SUM(units), SUM(discount), SUM(orders) "
+    "FROM sales_hours WHERE hour BETWEEN ? AND ? GROUP BY 1"
+)
+_SET_STOCK = (
+    "INSERT INTO inventory (product_id, on_hand) VALUES (?, ?) "
+    "ON CONFLICT(product_id) DO UPDATE SET on_hand = excluded.on_hand"
+)
+_UNTRACK_STOCK = "DELETE FROM inventory WHERE product_id = ?"
+_UNTRACK_HOLDS = "DELETE FROM reservations WHERE product_id = ?"
+_GET_STOCK = "SELECT on_hand, reserved FROM inventory WHERE product_id = ?"
+_LIST_STOCK = "SELECT product_id, on_hand, reserved FROM inventory ORDER BY product_id"
+# Conditional updates - the availability check and the change are one
+# statement, so racing writers cannot both take the last unit. A release
+# (change <= 0) always applies.
+_HOLD_STOCK = (
+    "UPDATE inventory SET reserved = reserved + ? "
+    "WHERE product_id = ? AND (? <= 0 OR on_hand - reserved >= ?)"
+)
+_SELL_STOCK = (
+    "UPDATE inventory SET on_hand = on_hand - ?, reserved = reserved - ? "
+    "WHERE product_id = ? AND (? <= 0 OR on_hand - reserved >= ?)"
+)
+_RELEASE_STOCK = "UPDATE inventory SET reserved = reserved - ? WHERE product_id = ?"
+_CART_HOLDS = "SELECT product_id, quantity FROM reservations WHERE cart_id = ?"
+_SAVE_HOLD = (
+    "INSERT INTO reservations (cart_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(cart_id, product_id) DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at"
+)
+_DELETE_HOLD = "DELETE FROM reservations WHERE cart_id = ? AND product_id = ?"
+_DELETE_CART_HOLDS = "DELETE FROM reservations WHERE cart_id = ?"
+_REFRESH_HOLDS = "UPDATE reservations SET expires_at = ? WHERE cart_id = ?"
+_EXPIRED_HOLDS = "SELECT cart_id, product_id, quantity FROM reservations WHERE expires_at <= ? LIMIT ?"
+_GET_IDEMPOTENCY_KEY = "SELECT fingerprint, order_id, created_at FROM idempotency_keys WHERE key = ?"
+_ADD_IDEMPOTENCY_KEY = "INSERT INTO idempotency_keys (key, fingerprint, order_id, created_at) VALUES (?, ?, ?, ?)"
+_PURGE_IDEMPOTENCY_KEYS = (
+    "DELETE FROM idempotency_keys WHERE key IN (SELECT key FROM idempotency_keys "
+    "WHERE created_at < ? ORDER BY created_at LIMIT ?)"
+)
+_QUEUE_NTH_ORDER_CODE = "INSERT OR IGNORE INTO nth_order_codes_due (order_number) VALUES (?)"
+_DEQUEUE_NTH_ORDER_CODE = "DELETE FROM nth_order_codes_due WHERE order_number = ?"
+_LIST_NTH_ORDER_CODES_DUE = "SELECT order_number FROM nth_order_codes_due ORDER BY order_number"
+_CODE_COLUMNS = "code, order_number, is_used, created_at, expires_at, used_at"
+_GET_CODE = f"SELECT {_CODE_COLUMNS} FROM discount_codes WHERE code = ?"
+_ADD_CODE = f"INSERT INTO discount_codes ({_CODE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)"
+# Keyset pages on rowid (creation order); status filters are evaluated as of a given time
+_LIST_CODES = {
+    None: f"SELECT rowid, {_CODE_COLUMNS} FROM discount_codes WHERE rowid > ? ORDER BY rowid LIMIT ?",
+    "used": f"SELECT rowid, {_CODE_COLUMNS} FROM discount_codes WHERE rowid > ? AND is_used = 1 ORDER BY rowid LIMIT ?",
+    "unused": (f"SELECT rowid, {_CODE_COLUMNS} FROM discount_codes WHERE rowid > ? AND is_used = 0 "
+               "AND (expires_at IS NULL OR expires_at > ?) ORDER BY rowid LIMIT ?"),
+    "expired": (f"SELECT rowid, {_CODE_COLUMNS} FROM discount_codes WHERE rowid > ? AND is_used = 0 "
+                "AND expires_at <= ? ORDER BY rowid LIMIT ?"),
+}
+_USE_CODE = (
+    "UPDATE discount_codes SET is_used = 1, used_at = ? "
+    "WHERE code = ? AND is_used = 0 AND (expires_at IS NULL OR expires_at > ?)"
+)
+# Both take a batch size - a backlog is worked off in short transactions.
+# Unused codes are only deleted once counted as expired.
+_EXPIRE_CODES = (
+    "UPDATE discount_codes SET is_expired = 1 WHERE rowid IN (SELECT rowid FROM discount_codes "
+    "WHERE is_used = 0 AND is_expired = 0 AND expires_at <= ? LIMIT ?)"
+)
+_COMPACT_CODES = (
+    "DELETE FROM discount_codes WHERE rowid IN (SELECT rowid FROM discount_codes "
+    "WHERE (is_used = 1 AND (used_at IS NULL OR used_at <= ?)) "
+    "OR (is_used = 0 AND is_expired = 1 AND expires_at <= ?) LIMIT ?)"
+)
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=128)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+class SQLitePool:
+    """Async pool of SQLite connections
+
+    Reads take any pooled connection; writes go through a single writer
+    connection guarded by a lock, since SQLite allows one writer at a time.
+    Every call runs in a worker thread so the event loop never blocks.
+    """
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self._writer = _connect(path)
+        self._writer.executescript(_SCHEMA)
+        _migrate(self._writer)
+        self._readers: "asyncio.Queue[sqlite3.Connection]" = asyncio.Queue()
+        self._all = [self._writer]
+        for _ in range(size):
+            conn = _connect(path)
+            self._readers.put_nowait(conn)
+            self._all.append(conn)
+        self._write_lock = asyncio.Lock()
+
+    async def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = await self._readers.get()
+        try:
+            return await asyncio.to_thread(fn, conn)
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        async with self._write_lock:
+            return await asyncio.to_thread(fn, self._writer)
+
+    async def transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run fn inside BEGIN IMMEDIATE ... COMMIT, rolling back on error"""
+        def run(conn: sqlite3.Connection):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        return await self.write(run)
+
+    def close(self):
+        for conn in self._all:
+            conn.close()
+
+def _items_json(items) -> str:
+    return json.dumps([[item.product_id, item.quantity] for item in items])
+
+def _items(data: str) -> List[CartItem]:
+    return [CartItem(product_id=product_id, quantity=quantity) for product_id, quantity in json.loads(data)]
+
+def _order(row) -> Order:
+    return Order(
+        id=row[0], cart_id=row[1], items=_items(row[2]), subtotal=row[3],
+        discount_amount=row[4], total=row[5], discount_code_used=row[6],
+        created_at=datetime.fromtimestamp(row[7])
+    )
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+def _from_timestamp(value: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value is not None else None
+
+def _discount_code(row) -> DiscountCode:
+    return DiscountCode(code=row[0], order_number=row[1], is_used=bool(row[2]),
+                        created_at=datetime.fromisoformat(row[3]),
+                        expires_at=_from_timestamp(row[4]), used_at=_from_timestamp(row[5]))
+
+# Reads only rewrite touched_at once it is this many seconds old
+_TOUCH_INTERVAL = 60.0
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path: str, pool_size: int = 4, reservation_ttl: float = RESERVATION_TTL,
+                 price_of: Optional[Callable[[str], Optional[float]]] = None,
+                 cart_idle_ttl: float = 24 * 60 * 60, max_carts: int = 100_000):
+        self.pool = SQLitePool(path, pool_size)
+        self.reservation_ttl = reservation_ttl
+        # Shared by every worker, so the cap is enforced by the reaper
+        # rather than on each insert
+        self.cart_idle_ttl = cart_idle_ttl
+        self.max_carts = max_carts
+        # List prices for splitting order totals in analytics - this worker's catalog
+        self.price_of = price_of or store.price_of
+
+    def _prices(self, order: Order) -> Dict[str, Optional[float]]:
+        # Read on the event loop, before the transaction's thread starts
+        return {item.product_id: self.price_of(item.product_id) for item in order.items}
+
+    async def get_cart(self, cart_id: str) -> Optional[Cart]:
+        row = await self.pool.read(lambda c: c.execute(_GET_CART, (cart_id,)).fetchone())
+        if row is None:
+            return None
+        cart = Cart(id=row[0], created_at=datetime.fromisoformat(row[1]), items=_items(row[2]))
+        cart._revision = row[2]
+        now = time.time()
+        if row[3] < now - _TOUCH_INTERVAL:
+            await self.pool.write(lambda c: c.execute(_TOUCH_CART, (now, cart_id)))
+        return cart
+
+    async def create_cart(self, cart: Cart) -> None:
+        items = _items_json(cart.lines.values())
+        params = (cart.id, cart.created_at.isoformat(), items, time.time())
+        await self.pool.write(lambda c: c.execute(_INSERT_CART, params))
+        cart._revision = items
+
+    async def save_cart(self, cart: Cart) -> None:
+        items = _items_json(cart.lines.values())
+
+        def run(conn: sqlite3.Connection):
+            if conn.execute(_UPDATE_UNCHANGED_CART, (items, time.time(), cart.id, cart._revision)).rowcount != 1:
+                if conn.execute(_CART_EXISTS, (cart.id,)).fetchone():
+                    raise CartChanged(cart.id)
+                raise CartNotFound(cart.id)
+
+        await self.pool.transaction(run)
+        cart._revision = items
+
+    async def delete_cart(self, cart_id: str) -> None:
+        def run(conn: sqlite3.Connection):
+            self._release_holds(conn, cart_id)
+            conn.execute(_DELETE_CART, (cart_id,))
+
+        await self.pool.transaction(run)
+
+    async def count_carts(self) -> int:
+        return await self.pool.read(lambda c: c.execute(_COUNT_CARTS).fetchone()[0])
+
+    async def reap_idle_carts(self, max_batch: int = 1000) -> int:
+        deadline = time.time() - self.cart_idle_ttl
+
+        def run(conn: sqlite3.Connection) -> int:
+            idle = [row[0] for row in conn.execute(_IDLE_CARTS, (deadline, max_batch))]
+            for cart_id in idle:
+                self._release_holds(conn, cart_id)
+                conn.execute(_DELETE_CART, (cart_id,))
+            # Then trim whatever is still over the cap
+            over = []
+            excess = conn.execute(_COUNT_CARTS).fetchone()[0] - self.max_carts
+            if excess > 0 and len(idle) < max_batch:
+                over = [row[0] for row in conn.execute(_OLDEST_CARTS, (min(excess, max_batch - len(idle)),))]
+            for cart_id in over:
+                self._release_holds(conn, cart_id)
+                conn.execute(_DELETE_CART, (cart_id,))
+            if idle:
+                conn.execute(_ADD_TO_COUNTER, ("carts_evicted_idle", len(idle)))
+            if over:
+                conn.execute(_ADD_TO_COUNTER, ("carts_evicted_capacity", len(over)))
+            return len(idle) + len(over)
+
+        return await self.pool.transaction(run)
+
+    async def get_cart_metrics(self) -> dict:
+        def run(conn: sqlite3.Connection) -> dict:
+            counters = dict(conn.execute(_LIST_COUNTERS).fetchall())
+            return {
+                "active_carts": conn.execute(_COUNT_CARTS).fetchone()[0],
+                "max_carts": self.max_carts,
+                "cart_idle_ttl_seconds": self.cart_idle_ttl,
+                "evicted_idle": int(counters.get("carts_evicted_idle", 0)),
+                "evicted_capacity": int(counters.get("carts_evicted_capacity", 0))
+            }
+
+        return await self.pool.read(run)
+
+    @staticmethod
+    def _release_holds(conn: sqlite3.Connection, cart_id: str, keep: Optional[Dict[str, int]] = None):
+        for product_id, quantity in conn.execute(_CART_HOLDS, (cart_id,)).fetchall():
+            if keep is None or product_id not in keep:
+                conn.execute(_RELEASE_STOCK, (quantity, product_id))
+        conn.execute(_DELETE_CART_HOLDS, (cart_id,))
+
+    async def set_stock(self, product_id: str, on_hand: Optional[int]) -> None:
+        def run(conn: sqlite3.Connection):
+            if on_hand is not None:
+                conn.execute(_SET_STOCK, (product_id, on_hand))
+            else:
+                conn.execute(_UNTRACK_STOCK, (product_id,))
+                conn.execute(_UNTRACK_HOLDS, (product_id,))
+
+        await self.pool.transaction(run)
+
+    async def reserve_stock(self, cart_id: str, quantities: Dict[str, int]) -> None:
+        expires_at = time.time() + self.reservation_ttl
+
+        def run(conn: sqlite3.Connection):
+            holds = dict(conn.execute(_CART_HOLDS, (cart_id,)).fetchall())
+            for product_id, quantity in quantities.items():
+                held = holds.get(product_id, 0)
+                change = quantity - held
+                if change and conn.execute(_HOLD_STOCK, (change, product_id, change, change)).rowcount != 1:
+                    stock = conn.execute(_GET_STOCK, (product_id,)).fetchone()
+                    if stock is None:
+                        continue  # untracked
+                    raise OutOfStock(product_id, max(0, stock[0] - stock[1] + held))
+                if quantity > 0:
+                    conn.execute(_SAVE_HOLD, (cart_id, product_id, quantity, expires_at))
+                elif product_id in holds:
+                    conn.execute(_DELETE_HOLD, (cart_id, product_id))
+            conn.execute(_REFRESH_HOLDS, (expires_at, cart_id))
+
+        # Carts holding nothing tracked skip the write transaction
+        tracked = await self.pool.read(lambda c: [
+            product_id for product_id in quantities if c.execute(_GET_STOCK, (product_id,)).fetchone()
+        ])
+        if tracked:
+            await self.pool.transaction(run)
+
+    async def get_availability(self) -> List[Tuple[str, int, int]]:
+        rows = await self.pool.read(lambda c: c.execute(_LIST_STOCK).fetchall())
+        return [tuple(row) for row in rows]
+
+    async def expire_reservations(self, max_batch: int = 1000) -> int:
+        def run(conn: sqlite3.Connection) -> int:
+            expired = conn.execute(_EXPIRED_HOLDS, (time.time(), max_batch)).fetchall()
+            for cart_id, product_id, quantity in expired:
+                conn.execute(_RELEASE_STOCK, (quantity, product_id))
+                conn.execute(_DELETE_HOLD, (cart_id, product_id))
+            return len(expired)
+
+        return await self.pool.transaction(run)
+
+    async def next_order_number(self) -> int:
+        return await self.pool.write(lambda c: c.execute(_NEXT_ORDER_NUMBER).fetchone()[0])
+
+    async def get_order_counter(self) -> int:
+        row = await self.pool.read(lambda c: c.execute(_GET_COUNTER, ("order_counter",)).fetchone())
+        return int(row[0]) if row else 0
+
+    @staticmethod
+    def _insert_order(conn: sqlite3.Connection, order: Order, prices: Dict[str, Optional[float]]):
+        seq = conn.execute(_ADD_ORDER, (
+            order.id, order.cart_id, _items_json(order.items), order.subtotal,
+            order.discount_amount, order.total, order.discount_code_used,
+            order.created_at.timestamp()
+        )).lastrowid
+        conn.executemany(_ADD_ORDER_ITEM, [(item.product_id, seq) for item in order.items])
+        # Running totals live next to the data so statistics stay O(1)
+        items = sum(item.quantity for item in order.items)
+        conn.execute(_ADD_TO_COUNTER, ("total_items_purchased", items))
+        conn.execute(_ADD_TO_COUNTER, ("total_purchase_amount", order.total))
+        conn.execute(_ADD_TO_COUNTER, ("total_discount_amount", order.discount_amount))
+        conn.execute(_ADD_TO_COUNTER, ("total_orders", 1))
+
+        # Hourly sales buckets for analytics, in the same transaction
+        hour = hour_of(order.created_at)
+        for product_id, units, revenue, discount in allocate_lines(order, prices.get):
+            conn.execute(_ADD_SALES, (hour, product_id, revenue, units, discount))
+        conn.execute(_ADD_SALES_HOUR, (hour, order.total, items, order.discount_amount))
+
+    @staticmethod
+    def _spend_code(conn: sqlite3.Connection, code: str) -> bool:
+        # Conditional update - only one writer can flip the flag
+        now = time.time()
+        if conn.execute(_USE_CODE, (now, code, now)).rowcount != 1:
+            return False
+        conn.execute(_ADD_TO_COUNTER, ("used_discount_codes", 1))
+        conn.execute(_ADD_TO_COUNTER, ("unused_discount_codes", -1))
+        return True
+
+    @staticmethod
+    def _sell_stock(conn: sqlite3.Connection, cart_id: str, items: List[CartItem]):
+        # A lapsed hold is re-checked against free stock; raising rolls back the checkout
+        holds = dict(conn.execute(_CART_HOLDS, (cart_id,)).fetchall())
+        sold = {}
+        for item in items:
+            held = holds.get(item.product_id, 0)
+            shortfall = item.quantity - held
+            params = (item.quantity, held, item.product_id, shortfall, shortfall)
+            if conn.execute(_SELL_STOCK, params).rowcount == 1:
+                sold[item.product_id] = item.quantity
+            else:
+                stock = conn.execute(_GET_STOCK, (item.product_id,)).fetchone()
+                if stock is not None:
+                    raise OutOfStock(item.product_id, max(0, stock[0] - stock[1] + held))
+        SQLiteBackend._release_holds(conn, cart_id, keep=sold)
+
+    async def add_order(self, order: Order) -> None:
+        prices = self._prices(order)
+        await self.pool.transaction(lambda c: self._insert_order(c, order, prices))
+
+    async def complete_checkout(self, cart: Cart, order: Order, discount_code: Optional[str],
+                                idempotency: Optional[Tuple[str, str]] = None, nth_order: int = 0) -> int:
+        items = _items_json(cart.lines.values())
+        prices = self._prices(order)
+
+        def run(conn: sqlite3.Connection) -> int:
+            # Checked first - a retry on another worker that lost the race
+            # replays this order rather than failing on the deleted cart
+            if idempotency is not None and conn.execute(_GET_IDEMPOTENCY_KEY, (idempotency[0],)).fetchone():
+                raise IdempotencyKeyUsed(idempotency[0])
+            # Deleting only an unchanged cart makes concurrent workers race
+            # safely - exactly one of them removes it
+            if conn.execute(_DELETE_UNCHANGED_CART, (cart.id, items)).rowcount != 1:
+                if conn.execute(_CART_EXISTS, (cart.id,)).fetchone():
+                    raise CartChanged(cart.id)
+                raise CartNotFound(cart.id)
+            if discount_code is not None and not self._spend_code(conn, discount_code):
+                raise DiscountCodeUnavailable(discount_code)
+            self._sell_stock(conn, cart.id, order.items)
+            order_number = conn.execute(_NEXT_ORDER_NUMBER).fetchone()[0]
+            self._insert_order(conn, order, prices)
+            if idempotency is not None:
+                conn.execute(_ADD_IDEMPOTENCY_KEY, (*idempotency, order.id, order.created_at.timestamp()))
+            if nth_order and order_number % nth_order == 0:
+                conn.execute(_QUEUE_NTH_ORDER_CODE, (order_number,))
+            return order_number
+
+        return await self.pool.transaction(run)
+
+    async def get_idempotent_checkout(self, key: str) -> Optional[Tuple[str, str, datetime]]:
+        row = await self.pool.read(lambda c: c.execute(_GET_IDEMPOTENCY_KEY, (key,)).fetchone())
+        return (row[0], row[1], datetime.fromtimestamp(row[2])) if row else None
+
+    async def purge_idempotency_keys(self, before: datetime, max_batch: int = 1000) -> int:
+        return await self.pool.write(
+            lambda c: c.execute(_PURGE_IDEMPOTENCY_KEYS, (before.timestamp(), max_batch)).rowcount
+        )
+
+    async def get_order(self, order_id: str) -> Optional[Order]:
+        row = await self.pool.read(lambda c: c.execute(_GET_ORDER, (order_id,)).fetchone())
+        return _order(row) if row else None
+
+    async def list_orders(self, limit: int = 50, cursor: Optional[str] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          cart_id: Optional[str] = None,
+                          product_id: Optional[str] = None) -> Tuple[List[Order], Optional[str]]:
+        # Cursor is the last seen seq - a keyset scan on the primary key,
+        # or on the cart / product index when filtering by one
+        params = (
+            int(cursor) if cursor else 0,
+            created_from.timestamp() if created_from else float("-inf"),
+            created_to.timestamp() if created_to else float("inf"),
+        )
+        if product_id is not None:
+            statement, params = _LIST_PRODUCT_ORDERS, (product_id, *params, cart_id, limit + 1)
+        elif cart_id is not None:
+            statement, params = _LIST_CART_ORDERS, (cart_id, *params, limit + 1)
+        else:
+            statement, params = _LIST_ORDERS, (*params, limit + 1)
+        rows = await self.pool.read(lambda c: c.execute(statement, params).fetchall())
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        return [_order(row[1:]) for row in rows[:limit]], next_cursor
+
+    async def get_discount_code(self, code: str) -> Optional[DiscountCode]:
+        row = await self.pool.read(lambda c: c.execute(_GET_CODE, (code,)).fetchone())
+        return _discount_code(row) if row else None
+
+    @staticmethod
+    def _insert_code(conn: sqlite3.Connection, discount_code: DiscountCode):
+        params = (discount_code.code, discount_code.order_number, int(discount_code.is_used),
+                  discount_code.created_at.isoformat(), _timestamp(discount_code.expires_at),
+                  _timestamp(discount_code.used_at))
+        counter = "used_discount_codes" if discount_code.is_used else "unused_discount_codes"
+        conn.execute(_ADD_CODE, params)
+        conn.execute(_ADD_TO_COUNTER, (counter, 1))
+
+    async def add_discount_code(self, discount_code: DiscountCode) -> None:
+        await self.pool.transaction(lambda c: self._insert_code(c, discount_code))
+
+    async def issue_nth_order_code(self, order_number: int, discount_code: DiscountCode) -> bool:
+        def run(conn: sqlite3.Connection) -> bool:
+            # Dequeue and insert together - exactly one worker issues the code
+            if conn.execute(_DEQUEUE_NTH_ORDER_CODE, (order_number,)).rowcount != 1:
+                return False
+            self._insert_code(conn, discount_code)
+            return True
+
+        return await self.pool.transaction(run)
+
+    async def pending_nth_order_codes(self) -> List[int]:
+        rows = await self.pool.read(lambda c: c.execute(_LIST_NTH_ORDER_CODES_DUE).fetchall())
+        return [row[0] for row in rows]
+
+    async def mark_discount_code_used(self, code: str) -> bool:
+        return await self.pool.transaction(lambda c: self._spend_code(c, code))
+
+    async def list_discount_codes(self, limit: int = 50, cursor: Optional[str] = None,
+                                  status: Optional[str] = None) -> Tuple[List[DiscountCode], Optional[str]]:
+        after = int(cursor) if cursor else 0
+        params = (after, limit + 1) if status in (None, "used") else (after, time.time(), limit + 1)
+        rows = await self.pool.read(lambda c: c.execute(_LIST_CODES[status], params).fetchall())
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        return [_discount_code(row[1:]) for row in rows[:limit]], next_cursor
+
+    async def compact_discount_codes(self, now: datetime, retention: timedelta,
+                                     max_batch: int = 1000) -> Tuple[int, int]:
+        cutoff = (now - retention).timestamp()
+
+        def run(conn: sqlite3.Connection) -> Tuple[int, int]:
+            expired = conn.execute(_EXPIRE_CODES, (now.timestamp(), max_batch)).rowcount
+            if expired:
+                conn.execute(_ADD_TO_COUNTER, ("unused_discount_codes", -expired))
+                conn.execute(_ADD_TO_COUNTER, ("expired_discount_codes", expired))
+            compacted = conn.execute(_COMPACT_CODES, (cutoff, cutoff, max_batch)).rowcount
+            if compacted:
+                conn.execute(_ADD_TO_COUNTER, ("compacted_discount_codes", compacted))
+            return expired, compacted
+
+        return await self.pool.transaction(run)
+
+    async def get_statistics(self) -> dict:
+        rows = await self.pool.read(lambda c: c.execute(_LIST_COUNTERS).fetchall())
+        counters = dict(rows)
+        return {
+            "total_items_purchased": int(counters.get("total_items_purchased", 0)),
+            "total_purchase_amount": float(counters.get("total_purchase_amount", 0.0)),
+            "total_discount_amount": float(counters.get("total_discount_amount", 0.0)),
+            "total_orders": int(counters.get("total_orders", 0)),
+            "used_discount_codes": int(counters.get("used_discount_codes", 0)),
+            "unused_discount_codes": int(counters.get("unused_discount_codes", 0)),
+            "expired_discount_codes": int(counters.get("expired_discount_codes", 0)),
+            "compacted_discount_codes": int(counters.get("compacted_discount_codes", 0))
+        }
+
+    async def get_analytics(self, start: Optional[datetime], end: Optional[datetime],
+                            granularity: str, group_by: Optional[str]) -> List[dict]:
+        step = GRANULARITIES[granularity]
+        params = (step, hour_of(start) if start else -(1 << 62), hour_of(end) if end else 1 << 62)
+
+        query = _SALES_BY_PRODUCT if group_by == "product" else _SALES_TOTALS
+
+        def run(conn: sqlite3.Connection) -> dict:
+            return {(row[0], row[1]): list(row[2:]) for row in conn.execute(query, params)}
+
+        return format_buckets(await self.pool.read(run), step)
+
+    async def close(self) -> None:
+        self.pool.close()
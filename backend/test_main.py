@@ -1,16 +1,30 @@
+import asyncio
+import json
+import time
+import uuid
 import pytest
 from fastapi.testclient import TestClient
 from main import app
-from store.memory_store import store
+from store.memory_store import InMemoryStore, store
+from models.schemas import DiscountCode
+from services.cache import TTLCache, cached_with_ttl, invalidate_cache, ttl_cache
+from services.idempotency import idempotency_results
 
 client = TestClient(app)
 
 @pytest.fixture(autouse=True)
 def reset_store():
     store.carts.clear()
+    store.cart_touched.clear()
     store.orders.clear()
     store.discount_codes.clear()
+    store.inventory.clear()
     store.order_counter = 0
+    store.reset_aggregates()
+    ttl_cache.clear()
+    idempotency_results.clear()
+    store.idempotency_keys.clear()
+    store.nth_order_codes_due.clear()
     yield
 
 def test_get_products():
@@ -100,9 +114,9 @@ def test_nth_order_discount_generation():
         client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
         client.post("/checkout", json={"cart_id": cart_id})
     
-    stats = client.get("/admin/statistics").json()
-    assert len(stats["discount_codes"]) == 1
-    assert stats["discount_codes"][0]["order_number"] == 3
+    codes = client.get("/admin/discount-codes").json()["items"]
+    assert len(codes) == 1
+    assert codes[0]["order_number"] == 3
 
 def test_checkout_with_valid_discount():
     for i in range(3):
@@ -111,8 +125,7 @@ def test_checkout_with_valid_discount():
         client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
         client.post("/checkout", json={"cart_id": cart_id})
     
-    stats = client.get("/admin/statistics").json()
-    discount_code = stats["discount_codes"][0]["code"]
+    discount_code = client.get("/admin/discount-codes").json()["items"][0]["code"]
     
     cart_response = client.post("/cart")
     cart_id = cart_response.json()["id"]
@@ -141,8 +154,7 @@ def test_checkout_with_used_discount():
         client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
         client.post("/checkout", json={"cart_id": cart_id})
     
-    stats = client.get("/admin/statistics").json()
-    discount_code = stats["discount_codes"][0]["code"]
+    discount_code = client.get("/admin/discount-codes").json()["items"][0]["code"]
     
     cart_response = client.post("/cart")
     cart_id = cart_response.json()["id"]
@@ -181,3 +193,1459 @@ def test_generate_discount_admin():
     response = client.post("/admin/generate-discount")
     assert response.status_code == 200
     assert "Discount not available yet" in response.json()["message"]
+
+def test_cached_products_repeat_requests():
+    first = client.get("/products")
+    second = client.get("/products")
+    assert second.status_code == 200
+    assert first.json() == second.json()
+
+def test_cached_statistics_repeat_requests():
+    assert client.get("/admin/statistics").status_code == 200
+    response = client.get("/admin/statistics")
+    assert response.status_code == 200
+    assert response.json()["total_orders"] == 0
+
+def test_cache_single_flight_coalesces_concurrent_misses():
+    calls = []
+
+    @cached_with_ttl(ttl=60, key_prefix="test_single_flight")
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"value": 42}
+
+    async def run():
+        return await asyncio.gather(*(compute() for _ in range(50)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r == {"value": 42} for r in results)
+    assert asyncio.run(compute()) == {"value": 42}
+    assert len(calls) == 1
+
+    invalidate_cache("test_single_flight")
+    asyncio.run(compute())
+    assert len(calls) == 2
+
+def test_cache_invalidation_only_discards_matching_inflight_results():
+    calls = []
+
+    @cached_with_ttl(ttl=60, key_prefix="test_inflight_a")
+    async def compute_a():
+        calls.append("a")
+        await asyncio.sleep(0.01)
+        return {"value": len(calls)}
+
+    @cached_with_ttl(ttl=60, key_prefix="test_inflight_b")
+    async def compute_b():
+        calls.append("b")
+        call = len(calls)
+        await asyncio.sleep(0.01)
+        return {"value": call}
+
+    async def run():
+        task_a = asyncio.create_task(compute_a())
+        task_b = asyncio.create_task(compute_b())
+        await asyncio.sleep(0)
+        # Unrelated prefix - compute_a's result is still stored
+        invalidate_cache("test_inflight_b")
+        # A caller after the invalidation does not join the discarded
+        # computation - it starts its own, whose result is kept
+        late_b = await compute_b()
+        first_a, first_b = await asyncio.gather(task_a, task_b)
+        return late_b, first_b
+
+    late_b, first_b = asyncio.run(run())
+    assert late_b != first_b
+    asyncio.run(compute_a())
+    assert asyncio.run(compute_b()) == late_b
+    assert calls == ["a", "b", "b"]
+
+def test_cache_serves_stale_while_refreshing():
+    calls = []
+
+    @cached_with_ttl(ttl=0.01, key_prefix="test_stale", stale_ttl=60)
+    async def compute():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        assert await compute() == 1
+        await asyncio.sleep(0.02)
+        # Expired but within the stale window - old value, refresh in background
+        assert await compute() == 1
+        await asyncio.sleep(0.01)
+        return await compute()
+
+    hits, misses = ttl_cache.hits, ttl_cache.misses
+    assert asyncio.run(run()) == 2
+    # One miss, then a stale hit and a fresh hit
+    assert (ttl_cache.hits - hits, ttl_cache.misses - misses) == (2, 1)
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_entries=3)
+    for key in ("a:1", "a:2", "a:3"):
+        cache.set(key, key)
+    cache.get("a:1")
+    cache.set("a:4", "a:4")
+    assert len(cache) == 3
+    assert cache.get("a:2") is None
+    assert cache.get("a:1") == "a:1"
+    assert cache.evictions == 1
+
+def test_ttl_cache_respects_byte_budget():
+    cache = TTLCache(max_bytes=4096)
+    for i in range(100):
+        cache.set(f"blob:{i}", "x" * 500)
+    assert cache.current_bytes <= 4096
+    assert cache.get("blob:99") is not None
+    assert cache.get("blob:0") is None
+
+def test_ttl_cache_sweeper_and_tag_invalidation():
+    cache = TTLCache()
+    cache.set("admin_stats:get_statistics", {"total": 1}, ttl=0.001)
+    cache.set("products:get_all_products", [1, 2, 3], ttl=300)
+    cache.set("products:get_product_by_id:1", 1, ttl=300)
+    time.sleep(0.01)
+    assert cache.sweep_expired() == 1
+    assert len(cache) == 2
+    assert cache.delete_prefix("products") == 2
+    assert len(cache) == 0 and cache.current_bytes == 0
+
+def test_statistics_track_running_totals():
+    for i in range(3):
+        cart_id = client.post("/cart").json()["id"]
+        client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 2})
+        client.post("/checkout", json={"cart_id": cart_id})
+
+    stats = client.get("/admin/statistics").json()
+    assert stats["total_items_purchased"] == 6
+    assert stats["total_purchase_amount"] == round(99.99 * 6, 2)
+    assert stats["unused_discount_codes"] == 1
+    assert stats["used_discount_codes"] == 0
+
+    code = client.get("/admin/discount-codes").json()["items"][0]["code"]
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+    client.post("/checkout", json={"cart_id": cart_id, "discount_code": code})
+
+    stats = client.get("/admin/statistics").json()
+    assert stats["total_orders"] == 4
+    assert stats["total_items_purchased"] == 7
+    assert stats["total_discount_amount"] == round(99.99 * 0.10, 2)
+    assert stats["used_discount_codes"] == 1
+    assert stats["unused_discount_codes"] == 0
+
+def _place_orders(count):
+    order_ids = []
+    for i in range(count):
+        cart_id = client.post("/cart").json()["id"]
+        client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+        order_ids.append(client.post("/checkout", json={"cart_id": cart_id}).json()["id"])
+    return order_ids
+
+def test_orders_cursor_pagination():
+    order_ids = _place_orders(5)
+
+    page = client.get("/orders", params={"limit": 2}).json()
+    seen = [o["id"] for o in page["items"]]
+    while page["next_cursor"]:
+        page = client.get("/orders", params={"limit": 2, "cursor": page["next_cursor"]}).json()
+        seen += [o["id"] for o in page["items"]]
+    assert seen == order_ids
+
+    assert client.get("/orders", params={"cursor": "abc"}).status_code == 400
+
+def test_orders_created_at_filter():
+    order_ids = _place_orders(3)
+    middle = client.get(f"/orders/{order_ids[1]}").json()["created_at"]
+
+    page = client.get("/orders", params={"created_from": middle}).json()
+    assert [o["id"] for o in page["items"]] == order_ids[1:]
+    page = client.get("/orders", params={"created_to": middle}).json()
+    assert [o["id"] for o in page["items"]] == order_ids[:2]
+
+def test_orders_filtered_by_cart_and_product():
+    order_ids = _place_orders(3)
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "2", "quantity": 1})
+    other = client.post("/checkout", json={"cart_id": cart_id}).json()
+
+    page = client.get("/orders", params={"cart_id": other["cart_id"]}).json()
+    assert [o["id"] for o in page["items"]] == [other["id"]]
+    page = client.get("/orders", params={"product_id": "1", "limit": 2}).json()
+    seen = [o["id"] for o in page["items"]]
+    page = client.get("/orders", params={"product_id": "1", "cursor": page["next_cursor"]}).json()
+    assert seen + [o["id"] for o in page["items"]] == order_ids
+    assert page["next_cursor"] is None
+    assert client.get("/orders", params={"product_id": "1", "cart_id": other["cart_id"]}).json()["items"] == []
+    assert client.get("/orders", params={"product_id": "missing"}).json()["items"] == []
+
+def test_orders_ndjson_export():
+    order_ids = _place_orders(4)
+    response = client.get("/orders/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [line for line in response.text.split("\n") if line]
+    assert [json.loads(line)["id"] for line in lines] == order_ids
+
+def test_search_products_by_text():
+    result = client.get("/products/search", params={"q": "wireless"}).json()
+    ids = {p["id"] for p in result["items"]}
+    assert ids == {"1", "3", "5"}
+    assert result["total"] == 3
+    # Name matches rank above description-only matches
+    assert result["items"][-1]["id"] == "3"
+
+    result = client.get("/products/search", params={"q": "noise wire"}).json()
+    assert {p["id"] for p in result["items"]} == {"1", "3"}
+
+def test_search_products_price_range_and_sort():
+    result = client.get("/products/search", params={"min_price": 100, "max_price": 300, "sort": "price_desc"}).json()
+    assert [p["id"] for p in result["items"]] == ["2", "3", "4"]
+
+    page = client.get("/products/search", params={"sort": "price_asc", "offset": 2, "limit": 2}).json()
+    assert [p["id"] for p in page["items"]] == ["4", "3"]
+    assert page["total"] == 6
+
+    result = client.get("/products/search", params={"q": "wireless", "sort": "price_asc", "max_price": 100}).json()
+    assert [p["id"] for p in result["items"]] == ["5", "1"]
+
+def test_catalog_index_tracks_product_changes():
+    from models.schemas import Product
+    product = Product(id="test-7", name="USB Hub", price=19.99,
+                      description="Seven port hub", image_url="https://example.com/hub.jpg")
+    store.upsert_product(product)
+    try:
+        result = client.get("/products/search", params={"q": "hub"}).json()
+        assert [p["id"] for p in result["items"]] == ["test-7"]
+        store.upsert_product(product.model_copy(update={"name": "USB Dock"}))
+        assert client.get("/products/search", params={"q": "dock"}).json()["total"] == 1
+    finally:
+        store.remove_product("test-7")
+    assert client.get("/products/search", params={"q": "hub"}).json()["total"] == 0
+
+def test_catalog_index_query_paths_agree():
+    from models.schemas import Product
+    from store.catalog_index import MAX_PREFIX_TERMS, CatalogIndex
+    products = [Product(id=f"p{i}", name=f"{('Lamp', 'Desk', 'Gear')[i % 3]} {i}", price=float(i % 50 + 1),
+                        description=f"tag{i}", image_url="https://example.com/p.jpg") for i in range(300)]
+    index = CatalogIndex()
+    index.rebuild(products)
+
+    def expected(query, lo, hi, key):
+        hits = [p for p in products if lo <= p.price <= hi and (not query or query in p.name.lower())]
+        return [p.id for p in sorted(hits, key=key)]
+
+    by_name = lambda p: (p.name.lower(), p.id)
+    by_price = lambda p: (p.price, p.id)
+    # A narrow price range drives the query; a wide one falls back to postings
+    for lo, hi in ((10, 11), (0, 49), (5, 40)):
+        ids, total = index.search(query="lamp", min_price=lo, max_price=hi, sort="price_asc", limit=5)
+        assert ids == expected("lamp", lo, hi, by_price)[:5]
+        assert total == len(expected("lamp", lo, hi, by_price))
+        ids, total = index.search(query="gear", min_price=lo, max_price=hi, sort="name", offset=3, limit=4)
+        assert ids == expected("gear", lo, hi, by_name)[3:7]
+        ids, total = index.search(min_price=lo, sort="name", offset=2, limit=3)
+        assert ids == expected("", lo, 1e9, by_name)[2:5]
+
+    # A prefix expands to a bounded number of vocabulary terms
+    ids, total = index.search(query="tag", limit=1000)
+    assert total == MAX_PREFIX_TERMS
+
+def test_update_cart_item_keeps_line_order():
+    cart_id = client.post("/cart").json()["id"]
+    for product_id in ("1", "2", "3"):
+        client.post(f"/cart/{cart_id}/items", json={"product_id": product_id, "quantity": 1})
+    client.put(f"/cart/{cart_id}/items/1", params={"quantity": 5})
+    client.put(f"/cart/{cart_id}/items/2", params={"quantity": 0})
+
+    cart = client.get(f"/cart/{cart_id}").json()
+    assert cart["items"] == [{"product_id": "1", "quantity": 5}, {"product_id": "3", "quantity": 1}]
+
+def test_cart_batch_operations():
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+
+    response = client.post(f"/cart/{cart_id}/items:batch", json={"operations": [
+        {"op": "add", "product_id": "1", "quantity": 2},
+        {"op": "add", "product_id": "2", "quantity": 1},
+        {"op": "add", "product_id": "4", "quantity": 1},
+        {"op": "update", "product_id": "2", "quantity": 4},
+        {"op": "remove", "product_id": "4"},
+    ]})
+    assert response.status_code == 200
+    assert response.json()["cart"]["items"] == [
+        {"product_id": "1", "quantity": 3},
+        {"product_id": "2", "quantity": 4},
+    ]
+
+    order = client.post("/checkout", json={"cart_id": cart_id}).json()
+    assert order["subtotal"] == round(99.99 * 3 + 299.99 * 4, 2)
+
+def test_cart_batch_is_atomic():
+    cart_id = client.post("/cart").json()["id"]
+    response = client.post(f"/cart/{cart_id}/items:batch", json={"operations": [
+        {"op": "add", "product_id": "1", "quantity": 1},
+        {"op": "add", "product_id": "does-not-exist", "quantity": 1},
+    ]})
+    assert response.status_code == 404
+    assert client.get(f"/cart/{cart_id}").json()["items"] == []
+
+    response = client.post(f"/cart/{cart_id}/items:batch", json={"operations": [
+        {"op": "update", "product_id": "1", "quantity": 2},
+    ]})
+    assert response.status_code == 404
+
+def test_idle_carts_are_reaped_in_batches():
+    cart_ids = [client.post("/cart").json()["id"] for _ in range(5)]
+    # Touching a cart moves it to the back of the idle queue
+    client.get(f"/cart/{cart_ids[0]}")
+    for cart_id in cart_ids[1:]:
+        store.cart_touched[cart_id] -= store.cart_idle_ttl + 1
+
+    evicted_before = store.carts_evicted_idle
+    assert store.reap_idle_carts(max_batch=3) == 3
+    assert store.reap_idle_carts(max_batch=3) == 1
+    assert list(store.carts) == [cart_ids[0]]
+    assert store.carts_evicted_idle - evicted_before == 4
+    assert client.get(f"/cart/{cart_ids[1]}").status_code == 404
+
+def test_cart_cap_evicts_least_recently_used():
+    original_cap = store.max_carts
+    store.max_carts = 3
+    try:
+        cart_ids = [client.post("/cart").json()["id"] for _ in range(3)]
+        client.post(f"/cart/{cart_ids[0]}/items", json={"product_id": "1", "quantity": 1})
+        client.post("/cart")
+        assert cart_ids[1] not in store.carts
+        assert cart_ids[0] in store.carts
+        metrics = client.get("/admin/carts").json()
+        assert metrics["active_carts"] == 3
+        assert metrics["evicted_capacity"] >= 1
+    finally:
+        store.max_carts = original_cap
+
+def test_sqlite_backend_reaps_idle_and_over_cap_carts(tmp_path):
+    from datetime import datetime
+    from models.schemas import Cart
+    from store.backend import configure_storage
+    from store.sqlite_store import SQLiteBackend
+
+    backend = SQLiteBackend(str(tmp_path / "carts.db"), cart_idle_ttl=60, max_carts=2)
+
+    async def run():
+        for cart_id in ("a", "b", "c", "d"):
+            await backend.create_cart(Cart(id=cart_id, items=[], created_at=datetime.now()))
+        # "a" went idle; of the rest, "b" is the least recently used
+        await backend.pool.write(lambda c: c.execute("UPDATE carts SET touched_at = touched_at - 120 WHERE id = 'a'"))
+        await backend.pool.write(lambda c: c.execute("UPDATE carts SET touched_at = touched_at - 30 WHERE id = 'b'"))
+        assert await backend.reap_idle_carts(max_batch=10) == 2
+        assert await backend.get_cart("a") is None and await backend.get_cart("b") is None
+        configure_storage(backend)
+        try:
+            metrics = client.get("/admin/carts").json()
+        finally:
+            configure_storage(None)
+        assert metrics == {"active_carts": 2, "max_carts": 2, "cart_idle_ttl_seconds": 60,
+                           "evicted_idle": 1, "evicted_capacity": 1}
+        await backend.close()
+
+    asyncio.run(run())
+
+def _populate(durable_store):
+    from models.schemas import Cart, CartItem, Order, DiscountCode
+    from datetime import datetime
+    cart = Cart(id="c1", items=[], created_at=datetime.now())
+    durable_store.add_cart(cart)
+    cart.set_quantity("1", 2)
+    durable_store.save_cart(cart)
+    durable_store.order_counter += 1
+    durable_store.add_order(Order(id="o1", cart_id="c0", items=[CartItem(product_id="2", quantity=1)],
+                                  subtotal=299.99, discount_amount=0, total=299.99, created_at=datetime.now()))
+    code = DiscountCode(code="SAVE10-TEST", order_number=1, is_used=False, created_at=datetime.now())
+    durable_store.add_discount_code(code)
+    durable_store.mark_discount_code_used(code)
+
+def test_store_recovers_from_wal(tmp_path):
+    durable_store = InMemoryStore()
+    durable_store.open_wal(str(tmp_path))
+    _populate(durable_store)
+    durable_store.wal.close()
+
+    recovered = InMemoryStore()
+    assert recovered.recover(str(tmp_path)) > 0
+    assert recovered.carts["c1"].lines["1"].quantity == 2
+    assert recovered.orders["o1"].total == 299.99
+    assert recovered.order_counter == 1
+    assert recovered.discount_codes["SAVE10-TEST"].is_used
+    assert recovered.used_discount_codes == 1 and recovered.unused_discount_codes == 0
+
+def test_store_snapshot_then_replays_only_tail(tmp_path):
+    from models.schemas import Product
+
+    async def run():
+        durable_store = InMemoryStore()
+        durable_store.open_wal(str(tmp_path))
+        _populate(durable_store)
+        await durable_store.snapshot()
+        durable_store.upsert_product(Product(id="p9", name="Cable", price=5.0,
+                                             description="USB cable", image_url="https://example.com/c.jpg"))
+        durable_store.remove_cart("c1")
+        durable_store.wal.close()
+
+    asyncio.run(run())
+    assert len(list(tmp_path.glob("snapshot-*.snap"))) == 1
+
+    recovered = InMemoryStore()
+    assert recovered.recover(str(tmp_path)) == 2
+    assert "c1" not in recovered.carts
+    assert recovered.orders["o1"].items[0].product_id == "2"
+    assert recovered.catalog_index.search("cable")[1] == 1
+    assert recovered.order_counter == 1
+
+def test_snapshot_restores_order_columns(tmp_path):
+    from models.schemas import CartItem, Order
+    from datetime import datetime, timedelta
+
+    async def run():
+        durable_store = InMemoryStore()
+        durable_store.open_wal(str(tmp_path))
+        start = datetime(2024, 5, 1, 9, 30)
+        for i in range(5):
+            durable_store.add_order(Order(
+                id=str(uuid.uuid4()) if i % 2 else f"legacy-{i}", cart_id="shared" if i < 3 else str(uuid.uuid4()),
+                items=[CartItem(product_id="1", quantity=i + 1), CartItem(product_id="2", quantity=1)],
+                subtotal=100.0 + i, discount_amount=10.0 if i == 4 else 0, total=90.0 + i if i == 4 else 100.0 + i,
+                discount_code_used="SAVE10-X" if i == 4 else None, created_at=start + timedelta(hours=i)))
+        await durable_store.snapshot()
+        durable_store.wal.close()
+        return durable_store
+
+    original = asyncio.run(run())
+    recovered = InMemoryStore()
+    assert recovered.recover(str(tmp_path)) == 0
+    assert list(recovered.orders.values()) == list(original.orders.values())
+    assert recovered.orders.rows_for_cart("shared") == [0, 1, 2]
+    assert recovered.orders.select(0, 5, 10, product_id="2") == [0, 1, 2, 3, 4]
+    assert recovered.total_purchase_amount == original.total_purchase_amount
+    assert recovered.analytics.query(group_by="product") == original.analytics.query(group_by="product")
+    assert recovered.analytics.query(granularity="hour") == original.analytics.query(granularity="hour")
+
+def test_several_workers_refuse_a_shared_wal_directory(tmp_path, monkeypatch):
+    from main import worker_config_error
+    monkeypatch.setenv("STORE_BACKEND", f"sqlite:///{tmp_path / 'store.db'}")
+    assert worker_config_error(4) is None
+    monkeypatch.setenv("STORE_DATA_DIR", str(tmp_path))
+    assert worker_config_error(1) is None
+    assert "STORE_DATA_DIR" in worker_config_error(4)
+
+def test_catalog_upload_refused_with_several_workers(tmp_path, monkeypatch):
+    from services.business_logic import CatalogService
+    monkeypatch.setenv("WEB_CONCURRENCY", "2")
+    monkeypatch.setenv("STORE_BACKEND", f"sqlite:///{tmp_path / 'store.db'}")
+    with TestClient(app) as workers_client:
+        response = workers_client.post("/admin/catalog/import", content="{}")
+        assert response.status_code == 409 and "CATALOG_FILE" in response.json()["detail"]
+    assert CatalogService.accept_uploads
+
+def test_wal_group_commit_and_torn_tail(tmp_path):
+    from store.persistence import WriteAheadLog, read_segment
+
+    async def run():
+        wal = WriteAheadLog(str(tmp_path), commit_delay=0.01)
+        wal.start()
+
+        async def writer(i):
+            await wal.sync(wal.append(("counter", i)))
+
+        await asyncio.gather(*(writer(i) for i in range(100)))
+        await wal.stop()
+        wal.close()
+        return wal.fsync_count
+
+    assert asyncio.run(run()) < 10
+
+    segment = next(tmp_path.glob("wal-*.log"))
+    with open(segment, "ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+    assert len(list(read_segment(str(segment)))) == 100
+
+    recovered = InMemoryStore()
+    assert recovered.recover(str(tmp_path)) == 100
+    assert recovered.order_counter == 99
+
+@pytest.fixture
+def catalog():
+    """An empty per-process catalog for the backend under test"""
+    memory_store = InMemoryStore()
+    memory_store.products.clear()
+    memory_store.catalog_index.clear()
+    return memory_store
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path, catalog):
+    from store.backend import InMemoryBackend
+    from store.sqlite_store import SQLiteBackend
+    if request.param == "memory":
+        yield InMemoryBackend(catalog)
+    else:
+        sqlite_backend = SQLiteBackend(str(tmp_path / "store.db"), price_of=catalog.price_of)
+        yield sqlite_backend
+        asyncio.run(sqlite_backend.close())
+
+def test_storage_backend_contract(backend):
+    from models.schemas import Product, Cart, CartItem, Order, DiscountCode
+    from datetime import datetime, timedelta
+
+    async def run():
+        cart = Cart(id="c1", items=[CartItem(product_id="p1", quantity=2)], created_at=datetime.now())
+        await backend.create_cart(cart)
+        cart.set_quantity("p1", 5)
+        await backend.save_cart(cart)
+        assert (await backend.get_cart("c1")).items[0].quantity == 5
+        assert await backend.count_carts() == 1
+        await backend.delete_cart("c1")
+        assert await backend.get_cart("c1") is None
+        assert await backend.count_carts() == 0
+
+        base = datetime.now()
+        for i in range(5):
+            number = await backend.next_order_number()
+            assert number == i + 1
+            await backend.add_order(Order(
+                id=f"o{i}", cart_id=f"c{i}", items=[CartItem(product_id="p1", quantity=1)],
+                subtotal=20.0, discount_amount=0, total=20.0, created_at=base + timedelta(minutes=i)
+            ))
+        assert (await backend.get_order("o3")).cart_id == "c3"
+
+        orders, cursor = await backend.list_orders(limit=2)
+        seen = [o.id for o in orders]
+        while cursor:
+            orders, cursor = await backend.list_orders(limit=2, cursor=cursor)
+            seen += [o.id for o in orders]
+        assert seen == ["o0", "o1", "o2", "o3", "o4"]
+        orders, _ = await backend.list_orders(created_from=base + timedelta(minutes=1),
+                                              created_to=base + timedelta(minutes=3))
+        assert [o.id for o in orders] == ["o1", "o2", "o3"]
+
+        # Secondary indexes: by cart, by product, combined with the time range
+        await backend.add_order(Order(
+            id="o5", cart_id="c1", items=[CartItem(product_id="p2", quantity=1), CartItem(product_id="p1", quantity=1)],
+            subtotal=20.0, discount_amount=0, total=20.0, created_at=base + timedelta(minutes=5)
+        ))
+        orders, _ = await backend.list_orders(cart_id="c1")
+        assert [o.id for o in orders] == ["o1", "o5"]
+        orders, _ = await backend.list_orders(product_id="p2")
+        assert [o.id for o in orders] == ["o5"]
+        orders, cursor = await backend.list_orders(limit=2, product_id="p1", created_from=base + timedelta(minutes=2))
+        assert [o.id for o in orders] == ["o2", "o3"]
+        orders, cursor = await backend.list_orders(limit=2, cursor=cursor, product_id="p1",
+                                                   created_from=base + timedelta(minutes=2))
+        assert [o.id for o in orders] == ["o4", "o5"] and cursor is None
+        orders, _ = await backend.list_orders(cart_id="c1", product_id="p2")
+        assert [o.id for o in orders] == ["o5"]
+
+        await backend.add_discount_code(DiscountCode(code="SAVE10-X", order_number=3,
+                                                     is_used=False, created_at=datetime.now()))
+        assert await backend.mark_discount_code_used("SAVE10-X")
+        assert not await backend.mark_discount_code_used("SAVE10-X")
+        assert (await backend.get_discount_code("SAVE10-X")).is_used
+
+    asyncio.run(run())
+
+def test_concurrent_checkouts_never_double_spend(monkeypatch):
+    from fastapi import HTTPException
+    from models.schemas import Cart, CheckoutRequest
+    from services.business_logic import CheckoutService
+    from services.locks import cart_locks, discount_code_locks
+    from datetime import datetime
+
+    code = "SAVE10-STRESS"
+    store.add_discount_code(DiscountCode(code=code, order_number=0, is_used=False, created_at=datetime.now()))
+
+    # Yield to the event loop inside the critical section to force interleaving
+    async def slow_commit():
+        await asyncio.sleep(0)
+    monkeypatch.setattr(store, "commit", slow_commit)
+
+    def make_cart():
+        cart = Cart(id=str(uuid.uuid4()), items=[], created_at=datetime.now())
+        store.add_cart(cart)
+        cart.set_quantity("1", 1)
+        return cart.id
+
+    async def checkout(cart_id, discount_code=None):
+        try:
+            return await CheckoutService.process_checkout(CheckoutRequest(cart_id=cart_id, discount_code=discount_code))
+        except HTTPException as exc:
+            return exc
+
+    async def run():
+        with_code = [checkout(make_cart(), code) for _ in range(500)]
+        without_code = [checkout(make_cart()) for _ in range(1500)]
+        # The same cart submitted twice must produce one order
+        duplicate_cart = make_cart()
+        duplicates = [checkout(duplicate_cart) for _ in range(10)]
+        return await asyncio.gather(*with_code, *without_code, *duplicates)
+
+    results = asyncio.run(run())
+    orders = [r for r in results if not isinstance(r, Exception)]
+    spent = [o for o in orders if o.discount_code_used == code]
+    assert len(spent) == 1
+    assert sum(1 for r in results if isinstance(r, HTTPException) and "already used" in r.detail) == 499
+    assert sum(1 for r in results if isinstance(r, HTTPException) and r.detail == "Cart not found") == 9
+
+    assert len(orders) == 1502
+    assert len({o.id for o in orders}) == len(orders)
+    assert store.order_counter == len(orders)
+    # Every nth order number minted exactly one code
+    minted = sorted(c.order_number for c in store.discount_codes.values() if c.code != code)
+    assert minted == list(range(store.nth_order, len(orders) + 1, store.nth_order))
+    assert len(cart_locks) == 0 and len(discount_code_locks) == 0
+
+def test_nth_order_code_survives_a_crash_before_its_handler(tmp_path):
+    from datetime import datetime
+    from models.schemas import Cart, CartItem, Order
+    from services.business_logic import CheckoutService
+    from store.backend import InMemoryBackend, configure_storage
+    from store.sqlite_store import SQLiteBackend
+
+    async def checkout_without_handler(backend, count):
+        for _ in range(count):
+            cart = Cart(id=str(uuid.uuid4()), items=[CartItem(product_id="1", quantity=1)], created_at=datetime.now())
+            await backend.create_cart(cart)
+            order = Order(id=str(uuid.uuid4()), cart_id=cart.id, items=list(cart.lines.values()), subtotal=99.99,
+                          discount_amount=0, total=99.99, created_at=datetime.now())
+            await backend.complete_checkout(await backend.get_cart(cart.id), order, None, nth_order=3)
+
+    durable = InMemoryStore()
+    durable.open_wal(str(tmp_path / "wal"))
+    asyncio.run(checkout_without_handler(InMemoryBackend(durable), 4))
+    durable.wal.close()
+    recovered = InMemoryStore()
+    recovered.recover(str(tmp_path / "wal"))
+    sqlite_backend = SQLiteBackend(str(tmp_path / "shared.db"))
+    asyncio.run(checkout_without_handler(sqlite_backend, 7))
+
+    for backend, due in ((InMemoryBackend(recovered), [3]), (sqlite_backend, [3, 6])):
+        configure_storage(backend)
+        try:
+            assert asyncio.run(backend.pending_nth_order_codes()) == due
+            assert asyncio.run(CheckoutService.issue_pending_codes()) == len(due)
+            # Issued exactly once, however many workers retry
+            assert asyncio.run(CheckoutService.issue_pending_codes()) == 0
+            codes, _ = asyncio.run(backend.list_discount_codes())
+            assert sorted(code.order_number for code in codes) == due
+        finally:
+            configure_storage(None)
+    asyncio.run(sqlite_backend.close())
+
+def test_shared_sqlite_backend_end_to_end(tmp_path, monkeypatch):
+    monkeypatch.setenv("STORE_BACKEND", f"sqlite:///{tmp_path / 'shared.db'}")
+    with TestClient(app) as shared_client:
+        for i in range(3):
+            cart_id = shared_client.post("/cart").json()["id"]
+            shared_client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+            assert shared_client.post("/checkout", json={"cart_id": cart_id}).status_code == 200
+
+        stats = shared_client.get("/admin/statistics").json()
+        assert stats["total_orders"] == 3
+        assert stats["total_items_purchased"] == 3
+        code = shared_client.get("/admin/discount-codes").json()["items"][0]["code"]
+
+        cart_id = shared_client.post("/cart").json()["id"]
+        shared_client.post(f"/cart/{cart_id}/items", json={"product_id": "2", "quantity": 1})
+        order = shared_client.post("/checkout", json={"cart_id": cart_id, "discount_code": code}).json()
+        assert order["discount_code_used"] == code
+        assert shared_client.get(f"/orders/{order['id']}").json()["total"] == order["total"]
+        assert shared_client.get("/orders").json()["items"][-1]["id"] == order["id"]
+        assert shared_client.get(f"/cart/{cart_id}").status_code == 404
+    # The in-memory store was not touched
+    assert len(store.orders) == 0
+
+def test_shared_backend_checkout_races_across_workers(tmp_path):
+    from models.schemas import Cart, Order
+    from store.backend import CartNotFound, DiscountCodeUnavailable
+    from store.sqlite_store import SQLiteBackend
+    from datetime import datetime
+
+    path = str(tmp_path / "shared.db")
+    # Two backends on one file stand in for two worker processes
+    worker_a, worker_b = SQLiteBackend(path), SQLiteBackend(path)
+
+    async def attempt(backend, cart, code):
+        order = Order(id=str(uuid.uuid4()), cart_id=cart.id, items=list(cart.lines.values()),
+                      subtotal=10, discount_amount=1, total=9, discount_code_used=code,
+                      created_at=datetime.now())
+        try:
+            return await backend.complete_checkout(cart, order, code)
+        except (CartNotFound, DiscountCodeUnavailable) as exc:
+            return exc
+
+    async def run():
+        await worker_a.add_discount_code(DiscountCode(code="SAVE10-RACE", order_number=0,
+                                                      is_used=False, created_at=datetime.now()))
+        cart = Cart(id="shared-cart", items=[], created_at=datetime.now())
+        cart.set_quantity("1", 1)
+        await worker_a.create_cart(cart)
+        seen_a = await worker_a.get_cart("shared-cart")
+        seen_b = await worker_b.get_cart("shared-cart")
+        return await asyncio.gather(attempt(worker_a, seen_a, "SAVE10-RACE"),
+                                    attempt(worker_b, seen_b, "SAVE10-RACE"))
+
+    results = asyncio.run(run())
+    assert sorted(type(r).__name__ for r in results) == ["CartNotFound", "int"]
+    stats = asyncio.run(worker_b.get_statistics())
+    assert stats["total_orders"] == 1 and stats["used_discount_codes"] == 1
+    asyncio.run(worker_a.close())
+    asyncio.run(worker_b.close())
+
+def test_stale_cart_save_does_not_revive_a_checked_out_cart(tmp_path):
+    from models.schemas import Cart, Order
+    from store.backend import CartChanged, CartNotFound
+    from store.sqlite_store import SQLiteBackend
+    from datetime import datetime
+
+    worker_a, worker_b = SQLiteBackend(str(tmp_path / "shared.db")), SQLiteBackend(str(tmp_path / "shared.db"))
+
+    async def run():
+        cart = Cart(id="cart", items=[], created_at=datetime.now())
+        cart.set_quantity("1", 1)
+        await worker_a.create_cart(cart)
+
+        # Both workers read the cart; B changes it first, so A's write is refused
+        seen_a, seen_b = await worker_a.get_cart("cart"), await worker_b.get_cart("cart")
+        seen_b.set_quantity("2", 1)
+        await worker_b.save_cart(seen_b)
+        seen_a.set_quantity("3", 1)
+        with pytest.raises(CartChanged):
+            await worker_a.save_cart(seen_a)
+
+        # A re-reads; B checks the cart out before A writes - A must not bring it back
+        seen_a = await worker_a.get_cart("cart")
+        order = Order(id="o1", cart_id="cart", items=list(seen_b.lines.values()), subtotal=10,
+                      discount_amount=0, total=10, created_at=datetime.now())
+        await worker_b.complete_checkout(seen_b, order, None)
+        seen_a.set_quantity("3", 1)
+        with pytest.raises(CartNotFound):
+            await worker_a.save_cart(seen_a)
+        assert await worker_b.get_cart("cart") is None
+        await worker_a.close()
+        await worker_b.close()
+
+    asyncio.run(run())
+
+def test_products_etag_and_conditional_get():
+    first = client.get("/products")
+    etag = first.headers["etag"]
+    assert first.json() == client.get("/products").json()
+
+    not_modified = client.get("/products", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert client.get("/products", headers={"If-None-Match": f'"stale", W/{etag}'}).status_code == 304
+
+    single = client.get("/products/1")
+    assert single.json()["name"] == "Wireless Headphones"
+    assert client.get("/products/1", headers={"If-None-Match": single.headers["etag"]}).status_code == 304
+    assert client.get("/products/missing").status_code == 404
+
+def test_serialized_products_are_bounded(monkeypatch):
+    from services.cache import TTLCache
+    from services.serialized import SerializedCatalog
+    serialized = SerializedCatalog(store)
+    monkeypatch.setattr(serialized, "products", TTLCache(max_entries=2))
+    for product_id in store.products:
+        assert serialized.product(product_id)[0] == store.products[product_id].model_dump_json().encode()
+    assert len(serialized.products) == 2 and serialized.products.evictions == len(store.products) - 2
+
+def test_products_etag_changes_only_when_catalog_changes():
+    from models.schemas import Product
+    from services.serialized import serialized_catalog
+
+    etag = client.get("/products").headers["etag"]
+    rebuilds = serialized_catalog.rebuilds
+    client.get("/products")
+    assert serialized_catalog.rebuilds == rebuilds
+
+    product = store.products["1"]
+    store.upsert_product(product.model_copy(update={"price": 89.99}))
+    try:
+        response = client.get("/products", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert client.get("/products/1").json()["price"] == 89.99
+    finally:
+        store.upsert_product(product)
+    assert client.get("/products").headers["etag"] == etag
+
+def test_products_served_precompressed_once():
+    import gzip
+    from services.compression import compressed_cache, negotiate_encoding
+
+    compressed_cache.clear()
+    # Make the catalog large enough to be worth compressing
+    body_size = len(client.get("/products", headers={"Accept-Encoding": "identity"}).content)
+    assert body_size >= 1000
+
+    first = client.get("/products", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip"
+    assert first.headers["etag"].endswith('-gzip"')
+    assert "Accept-Encoding" in first.headers["vary"]
+    misses = compressed_cache.misses
+    second = client.get("/products", headers={"Accept-Encoding": "gzip, deflate"})
+    assert second.json() == first.json()
+    assert compressed_cache.misses == misses and len(compressed_cache) == 1
+
+    raw = client.get("/products", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in raw.headers
+    assert client.get("/products", headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["etag"]}).status_code == 304
+
+    assert negotiate_encoding("gzip;q=0, identity") is None
+    assert negotiate_encoding("br;q=1.0, gzip;q=0.5") in ("br", "gzip")
+    assert negotiate_encoding("*") is not None
+
+def test_statistics_conditional_get():
+    first = client.get("/admin/statistics")
+    assert client.get("/admin/statistics", headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+    client.post("/checkout", json={"cart_id": cart_id})
+    changed = client.get("/admin/statistics", headers={"If-None-Match": first.headers["etag"]})
+    assert changed.status_code == 200
+    assert changed.json()["total_orders"] == 1
+
+def test_order_archive_round_trips_orders():
+    from datetime import datetime, timedelta
+    from models.schemas import Order, CartItem
+    from store.order_archive import OrderArchive
+
+    archive = OrderArchive()
+    start = datetime(2024, 3, 1, 12, 0, 0, 123456)
+    orders = [
+        Order(id=str(uuid.uuid4()), cart_id=str(uuid.uuid4()),
+              items=[CartItem(product_id="1", quantity=2), CartItem(product_id="sku-9", quantity=1)],
+              subtotal=199.98, discount_amount=19.998, total=179.982,
+              discount_code_used="SAVE10-ABC", created_at=start),
+        Order(id="legacy-1", cart_id="c1", items=[CartItem(product_id="1", quantity=1)],
+              subtotal=99.99, discount_amount=0, total=99.99, created_at=start + timedelta(days=1)),
+    ]
+    for order in orders:
+        archive.append(order)
+
+    assert len(archive) == 2
+    assert archive[orders[0].id] == orders[0]
+    assert archive.get("legacy-1") == orders[1]
+    assert archive.get(str(uuid.uuid4())) is None
+    assert orders[0].id.upper() not in archive
+    assert archive.product_ids == ["1", "sku-9"]
+    assert archive.row_range(start + timedelta(hours=1)) == (1, 2)
+    assert archive.row_range(created_to=start) == (0, 1)
+    with pytest.raises(ValueError):
+        archive.append(orders[1])
+
+def test_order_that_does_not_fit_leaves_no_partial_row():
+    from datetime import datetime
+    from models.schemas import Order, CartItem
+
+    memory_store = InMemoryStore()
+    order_id, cart_id = str(uuid.uuid4()), str(uuid.uuid4())
+    def order(quantity):
+        return Order(id=order_id, cart_id=cart_id,
+                     items=[CartItem(product_id="1", quantity=1), CartItem(product_id="new", quantity=quantity)],
+                     subtotal=10.0, discount_amount=0, total=10.0, created_at=datetime(2024, 3, 1))
+
+    # Fails on the second line, after the first was already accepted
+    with pytest.raises(OverflowError):
+        memory_store.add_order(order(2 ** 64))
+    archive = memory_store.orders
+    assert len(archive) == 0
+    assert order_id not in archive
+    assert archive.rows_for_cart(cart_id) == []
+    assert archive.product_ids == [] and list(archive.item_offsets) == [0]
+    assert memory_store.total_items_purchased == 0
+
+    # The same order then goes in cleanly, with a quantity past 32 bits
+    memory_store.add_order(order(2 ** 40))
+    assert archive[order_id].items[1].quantity == 2 ** 40
+    assert archive.rows_for_cart(cart_id) == [0]
+    assert archive.select(0, 1, 10, product_id="new") == [0]
+
+@pytest.mark.parametrize("vectorised", [True, False])
+def test_storage_backend_analytics(backend, catalog, vectorised, monkeypatch):
+    from datetime import datetime, timezone
+    from models.schemas import Product, CartItem, Order
+    from store import analytics
+
+    if not vectorised:
+        monkeypatch.setattr(analytics, "np", None)
+
+    async def run():
+        for product_id, price in (("p1", 10.0), ("p2", 30.0)):
+            # Prices come from the worker's catalog, whichever backend stores the orders
+            catalog.upsert_product(Product(id=product_id, name=product_id, price=price,
+                                           description="Item", image_url="https://example.com/i.jpg"))
+        day = datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc)
+        placed = [
+            (day, [("p1", 1), ("p2", 1)], 4.0),
+            (day.replace(hour=10), [("p1", 2)], 0.0),
+            (day.replace(day=2), [("p2", 1)], 0.0),
+        ]
+        for i, (created_at, lines, discount) in enumerate(placed):
+            subtotal = sum({"p1": 10.0, "p2": 30.0}[p] * q for p, q in lines)
+            await backend.add_order(Order(
+                id=f"o{i}", cart_id=f"c{i}", items=[CartItem(product_id=p, quantity=q) for p, q in lines],
+                subtotal=subtotal, discount_amount=discount, total=subtotal - discount, created_at=created_at
+            ))
+
+        days = await backend.get_analytics(None, None, "day", None)
+        assert [(b["start"].day, b["revenue"], b["units"], b["orders"]) for b in days] == [(1, 56.0, 4, 2), (2, 30.0, 1, 1)]
+        assert days[0]["discount"] == 4.0
+
+        hours = await backend.get_analytics(day, day.replace(hour=9, minute=59), "hour", "product")
+        assert [(b["product_id"], b["revenue"], b["discount"]) for b in hours] == [("p1", 9.0, 1.0), ("p2", 27.0, 3.0)]
+        assert await backend.get_analytics(day.replace(day=3), None, "day", "product") == []
+
+    asyncio.run(run())
+
+def test_admin_analytics_endpoint():
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 2})
+    client.post("/checkout", json={"cart_id": cart_id})
+
+    response = client.get("/admin/analytics", params={"granularity": "hour", "group_by": "product"})
+    assert response.status_code == 200
+    buckets = response.json()["buckets"]
+    assert [(b["product_id"], b["units"], b["orders"]) for b in buckets] == [("1", 2, 1)]
+
+    assert client.get("/admin/analytics", params={"from": "2030-01-01T00:00:00", "to": "2020-01-01T00:00:00"}).status_code == 400
+    assert client.get("/admin/analytics", params={"granularity": "minute"}).status_code == 422
+
+def _metric(text: str, sample: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+def test_metrics_endpoint_prometheus_format():
+    route = 'method="GET",route="/products/{product_id}"'
+    before = client.get("/metrics").text
+    client.get("/products/1")
+    client.get("/products/does-not-exist")
+    cart_id = client.post("/cart").json()["id"]
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert "# TYPE http_request_duration_seconds histogram" in text
+    assert _metric(text, f"http_request_duration_seconds_count{{{route}}}") == \
+        _metric(before, f"http_request_duration_seconds_count{{{route}}}") + 2
+    assert _metric(text, f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}') == \
+        _metric(text, f"http_request_duration_seconds_count{{{route}}}")
+    assert _metric(text, f'http_requests_total{{{route},status="404"}}') >= 1
+    assert _metric(text, f"http_requests_in_flight{{{route}}}") == 0
+    assert _metric(text, 'http_requests_in_flight{method="GET",route="/metrics"}') == 1
+    assert _metric(text, "store_carts") == len(store.carts) and cart_id in store.carts
+    assert 'cache_hits_total{cache="response"}' in text
+
+def test_profiling_endpoints_require_token(monkeypatch):
+    from services.profiling import profiler
+
+    assert client.post("/admin/profiling/cpu", params={"seconds": 0.05}).status_code == 404
+    monkeypatch.setattr(profiler, "token", "s3cret")
+    assert client.post("/admin/profiling/cpu", params={"seconds": 0.05},
+                       headers={"X-Profiling-Token": "wrong"}).status_code == 403
+
+    response = client.post("/admin/profiling/cpu", params={"seconds": 0.1, "interval_ms": 1},
+                           headers={"X-Profiling-Token": "s3cret"})
+    assert response.status_code == 200
+    stack, weight = response.text.splitlines()[0].rsplit(" ", 1)
+    assert ";" in stack and int(weight) > 0
+
+    allocations = client.post("/admin/profiling/allocations", params={"seconds": 0.05},
+                              headers={"X-Profiling-Token": "s3cret"}).json()
+    assert set(allocations) == {"top_sites", "collapsed_stacks"}
+
+def test_profile_single_request_by_header(monkeypatch):
+    from services.profiling import profiler
+
+    # Without a configured token the header is ignored
+    assert "x-profile-id" not in client.get("/admin/statistics", headers={"X-Profile": "s3cret"}).headers
+
+    monkeypatch.setattr(profiler, "token", "s3cret")
+    response = client.get("/admin/statistics", headers={"X-Profile": "s3cret"})
+    profile_id = response.headers["x-profile-id"]
+    assert "x-profile-id" not in client.get("/admin/statistics").headers
+
+    profile = client.get(f"/admin/profiling/requests/{profile_id}", headers={"X-Profiling-Token": "s3cret"})
+    assert profile.status_code == 200
+    assert "business_logic.py:get_statistics" in profile.text
+
+def test_checkout_idempotency_key_replays_result():
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+
+    first = client.post("/checkout", json={"cart_id": cart_id}, headers={"Idempotency-Key": "retry-1"})
+    assert first.status_code == 200
+    # The cart is gone, but the retry gets the original order back
+    retry = client.post("/checkout", json={"cart_id": cart_id}, headers={"Idempotency-Key": "retry-1"})
+    assert retry.status_code == 200 and retry.json()["id"] == first.json()["id"]
+    assert len(store.orders) == 1
+
+    assert client.post("/checkout", json={"cart_id": cart_id}).status_code == 404
+    mismatch = client.post("/checkout", json={"cart_id": "other"}, headers={"Idempotency-Key": "retry-1"})
+    assert mismatch.status_code == 422
+    assert client.post("/checkout", json={"cart_id": cart_id}, headers={"Idempotency-Key": "x" * 256}).status_code == 400
+
+def test_idempotency_key_replays_on_another_worker(tmp_path):
+    from datetime import datetime, timedelta
+    from fastapi import HTTPException
+    from models.schemas import Cart, CheckoutRequest
+    from services.business_logic import CheckoutService
+    from store.backend import IdempotencyKeyUsed, configure_storage
+    from store.sqlite_store import SQLiteBackend
+
+    worker_a, worker_b = SQLiteBackend(str(tmp_path / "shared.db")), SQLiteBackend(str(tmp_path / "shared.db"))
+
+    async def run():
+        cart = Cart(id="cart", items=[], created_at=datetime.now())
+        cart.set_quantity("1", 1)
+        await worker_a.create_cart(cart)
+        request = CheckoutRequest(cart_id="cart")
+        try:
+            configure_storage(worker_a)
+            first = await CheckoutService.process_checkout(request, "shared-key")
+            # Worker B has never seen the key - its local cache is empty
+            idempotency_results.clear()
+            configure_storage(worker_b)
+            retry = await CheckoutService.process_checkout(request, "shared-key")
+            assert retry.id == first.id
+            with pytest.raises(HTTPException) as exc:
+                await CheckoutService.process_checkout(CheckoutRequest(cart_id="other"), "shared-key")
+            assert exc.value.status_code == 422
+
+            # A second checkout recording the same key is refused as a whole
+            other = Cart(id="other", items=[], created_at=datetime.now())
+            other.set_quantity("2", 1)
+            await worker_b.create_cart(other)
+            order = first.model_copy(update={"id": "o2", "cart_id": "other"})
+            with pytest.raises(IdempotencyKeyUsed):
+                await worker_b.complete_checkout(await worker_b.get_cart("other"), order, None, ("shared-key", "x"))
+            assert await worker_b.get_cart("other") is not None
+
+            assert await worker_b.purge_idempotency_keys(datetime.now() + timedelta(seconds=1)) == 1
+            assert await worker_a.get_idempotent_checkout("shared-key") is None
+        finally:
+            configure_storage(None)
+            await worker_a.close()
+            await worker_b.close()
+
+    asyncio.run(run())
+
+def test_concurrent_duplicate_checkouts_run_once(monkeypatch):
+    from datetime import datetime
+    from models.schemas import Cart, CartItem, CheckoutRequest
+    from services.business_logic import CheckoutService
+
+    async def slow_commit():
+        await asyncio.sleep(0.01)
+    monkeypatch.setattr(store, "commit", slow_commit)
+
+    cart = Cart(id=str(uuid.uuid4()), items=[CartItem(product_id="2", quantity=1)], created_at=datetime.now())
+    store.add_cart(cart)
+
+    async def run():
+        request = CheckoutRequest(cart_id=cart.id)
+        return await asyncio.gather(*(CheckoutService.process_checkout(request, "dup-key") for _ in range(5)))
+
+    orders = asyncio.run(run())
+    assert len({order.id for order in orders}) == 1
+    assert len(store.orders) == 1 and store.order_counter == 1
+
+def test_event_bus_batches_and_drains_on_stop():
+    from services.events import EventBus, OrderPlaced
+    bus = EventBus(max_queue=4, max_batch=3, workers=1)
+    batches = []
+
+    async def record(events):
+        batches.append([event.order_number for event in events])
+
+    async def fail(events):
+        raise RuntimeError("boom")
+    bus.subscribe("record", record)
+    bus.subscribe("fail", fail)
+
+    async def run():
+        bus.start()
+        # More events than the queue holds - publish waits for the worker
+        for number in range(1, 11):
+            await bus.publish(OrderPlaced(order=None, order_number=number))
+        await bus.stop()
+        assert not bus.running
+
+    asyncio.run(run())
+    assert [number for batch in batches for number in batch] == list(range(1, 11))
+    assert max(len(batch) for batch in batches) <= 3
+    record_stats, fail_stats = (stats for _, stats in bus.handlers)
+    assert record_stats.events == 10 and record_stats.errors == 0
+    assert fail_stats.errors == fail_stats.count == len(batches)
+
+def test_checkout_event_handlers_in_metrics():
+    with TestClient(app) as live_client:
+        for _ in range(store.nth_order):
+            cart_id = live_client.post("/cart").json()["id"]
+            live_client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+            assert live_client.post("/checkout", json={"cart_id": cart_id}).status_code == 200
+    # Leaving the lifespan drained the bus, so the nth-order code exists
+    assert len(store.discount_codes) == 1
+    body = client.get("/metrics").text
+    assert 'event_handler_duration_seconds_count{handler="nth_order_discount"}' in body
+    assert "event_queue_depth 0" in body
+
+def test_admission_gives_freed_slots_to_checkout_first():
+    from services.admission import AdmissionController, RouteClass, Rejected
+    controller = AdmissionController(classes=(
+        RouteClass("checkout", priority=0, max_concurrency=4, queue_target=1.0, rate=100, burst=100),
+        RouteClass("admin", priority=2, max_concurrency=4, queue_target=0.05, rate=100, burst=100),
+    ), max_concurrency=1)
+    checkout, admin = controller.classes["checkout"], controller.classes["admin"]
+
+    async def run():
+        order = []
+
+        async def request(state, name):
+            await controller.acquire(state, "client")
+            order.append(name)
+            controller.release(state)
+
+        await controller.acquire(checkout, "client")
+        waiting = [asyncio.create_task(request(admin, "admin")), asyncio.create_task(request(checkout, "checkout"))]
+        await asyncio.sleep(0)
+        controller.release(checkout)
+        await asyncio.gather(*waiting)
+        assert order == ["checkout", "admin"]
+
+        # Admin waits past its queueing target while the slot is held
+        await controller.acquire(checkout, "client")
+        with pytest.raises(Rejected) as exc:
+            await controller.acquire(admin, "client")
+        assert exc.value.status_code == 503
+        controller.release(checkout)
+
+    asyncio.run(run())
+    assert admin.shed == 1 and controller.in_flight == 0
+
+def test_admission_rate_limits_per_client(monkeypatch):
+    from services.admission import admission, TokenBuckets
+    with TestClient(app) as live_client:
+        monkeypatch.setattr(admission.classes["admin"], "buckets", TokenBuckets(rate=0.5, burst=2))
+        statuses = [live_client.get("/admin/statistics").status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        limited = live_client.get("/admin/statistics")
+        assert limited.headers["Retry-After"] == "2"
+        # Other classes and unclassified routes are unaffected
+        assert live_client.get("/products").status_code == 200
+        body = live_client.get("/metrics").text
+    assert 'admission_decisions_total{class="admin",decision="rate_limited"}' in body
+    assert not admission.enabled
+
+def test_backend_stock_reservations(backend):
+    from models.schemas import Cart, CartItem, Order
+    from datetime import datetime
+    from store.backend import OutOfStock
+
+    async def run():
+        await backend.set_stock("hot", 5)
+        await backend.reserve_stock("a", {"hot": 3, "untracked": 7})
+        with pytest.raises(OutOfStock) as exc:
+            await backend.reserve_stock("b", {"hot": 3})
+        assert exc.value.available == 2
+        await backend.reserve_stock("b", {"hot": 2})
+        await backend.reserve_stock("a", {"hot": 1})
+        assert await backend.get_availability() == [("hot", 5, 3)]
+
+        # Checkout sells the held units and drops the holds
+        cart = Cart(id="a", items=[CartItem(product_id="hot", quantity=1)], created_at=datetime.now())
+        await backend.create_cart(cart)
+        order = Order(id="o1", cart_id="a", items=cart.items, subtotal=1.0, discount_amount=0,
+                      total=1.0, created_at=datetime.now())
+        await backend.complete_checkout(cart, order, None)
+        assert await backend.get_availability() == [("hot", 4, 2)]
+
+        # A sold-out line fails the whole checkout
+        cart = Cart(id="c", items=[CartItem(product_id="hot", quantity=3)], created_at=datetime.now())
+        await backend.create_cart(cart)
+        with pytest.raises(OutOfStock):
+            await backend.complete_checkout(cart, order.model_copy(update={"id": "o2", "cart_id": "c", "items": cart.items}), None)
+        assert await backend.get_cart("c") is not None
+
+        await backend.delete_cart("b")
+        assert await backend.get_availability() == [("hot", 4, 0)]
+
+        if hasattr(backend, "store"):
+            backend.store.inventory.reservation_ttl = 0
+        else:
+            backend.reservation_ttl = 0
+        await backend.reserve_stock("d", {"hot": 4})
+        assert await backend.expire_reservations() == 1
+        assert await backend.get_availability() == [("hot", 4, 0)]
+
+    asyncio.run(run())
+
+def test_failed_checkout_applies_nothing(backend):
+    from models.schemas import Cart, CartItem, Order
+    from datetime import datetime
+
+    async def run():
+        await backend.set_stock("hot", 5)
+        await backend.add_discount_code(DiscountCode(code="SAVE10-F", order_number=0,
+                                                     is_used=False, created_at=datetime.now()))
+        await backend.add_order(Order(id="o1", cart_id="old", items=[CartItem(product_id="hot", quantity=1)],
+                                      subtotal=1.0, discount_amount=0, total=1.0, created_at=datetime.now()))
+        cart = Cart(id="c", items=[CartItem(product_id="hot", quantity=2)], created_at=datetime.now())
+        await backend.create_cart(cart)
+        await backend.reserve_stock("c", {"hot": 2})
+        counter = await backend.get_order_counter()
+
+        # Storing the order is the last step, and it fails - a reused order id
+        order = Order(id="o1", cart_id="c", items=cart.items, subtotal=2.0, discount_amount=0.2,
+                      total=1.8, discount_code_used="SAVE10-F", created_at=datetime.now())
+        with pytest.raises(Exception):
+            await backend.complete_checkout(cart, order, "SAVE10-F")
+        assert await backend.get_availability() == [("hot", 5, 2)]
+        assert not (await backend.get_discount_code("SAVE10-F")).is_used
+        assert await backend.get_order_counter() == counter
+        assert await backend.get_cart("c") is not None
+        assert (await backend.get_statistics())["total_orders"] == 1
+
+        await backend.complete_checkout(cart, order.model_copy(update={"id": "o2"}), "SAVE10-F")
+        assert await backend.get_availability() == [("hot", 3, 0)]
+        assert await backend.get_order_counter() == counter + 1
+
+    asyncio.run(run())
+
+def test_cart_reservations_and_availability():
+    assert client.put("/admin/inventory/1", json={"on_hand": 3}).status_code == 200
+    assert client.put("/admin/inventory/missing", json={"on_hand": 3}).status_code == 404
+    first = client.post("/cart").json()["id"]
+    second = client.post("/cart").json()["id"]
+
+    assert client.post(f"/cart/{first}/items", json={"product_id": "1", "quantity": 2}).status_code == 200
+    response = client.post(f"/cart/{second}/items", json={"product_id": "1", "quantity": 2})
+    assert response.status_code == 409 and "Only 1" in response.json()["detail"]
+    # A failing batch leaves both the cart and its holds untouched
+    batch = {"operations": [{"op": "add", "product_id": "2", "quantity": 1},
+                            {"op": "add", "product_id": "1", "quantity": 5}]}
+    assert client.post(f"/cart/{second}/items:batch", json=batch).status_code == 409
+    assert client.get(f"/cart/{second}").json()["items"] == []
+    assert client.get("/products/availability").json() == [
+        {"product_id": "1", "on_hand": 3, "reserved": 2, "available": 1}]
+
+    assert client.post("/checkout", json={"cart_id": first}).status_code == 200
+    assert client.get("/products/availability").json()[0] == {
+        "product_id": "1", "on_hand": 1, "reserved": 0, "available": 1}
+    assert client.post(f"/cart/{second}/items", json={"product_id": "1", "quantity": 1}).status_code == 200
+    assert client.delete(f"/cart/{second}/items/1").status_code == 200
+    assert client.get("/products/availability").json()[0]["reserved"] == 0
+
+def test_product_listing_with_availability():
+    assert client.put("/admin/inventory/1", json={"on_hand": 3}).status_code == 200
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 2})
+
+    listing = {p["id"]: p for p in client.get("/products", params={"include": "availability"}).json()}
+    assert listing["1"]["available"] == 1 and listing["1"]["name"] == "Wireless Headphones"
+    assert listing["2"]["available"] is None
+    # The default listing is unchanged
+    assert "available" not in client.get("/products").json()[0]
+    assert client.get("/products", params={"include": "stock"}).status_code == 422
+
+def test_backend_discount_code_lifecycle(backend):
+    from datetime import datetime, timedelta
+
+    async def run():
+        now = datetime.now()
+        for i in range(5):
+            # SAVE-0 and SAVE-1 have expired, SAVE-2 is spent below
+            expires_at = now - timedelta(days=10 - i) if i < 2 else now + timedelta(days=1)
+            await backend.add_discount_code(DiscountCode(code=f"SAVE-{i}", order_number=i, is_used=False,
+                                                         created_at=now, expires_at=expires_at))
+        assert not await backend.mark_discount_code_used("SAVE-0")
+        assert await backend.mark_discount_code_used("SAVE-2")
+
+        codes, cursor = await backend.list_discount_codes(limit=2)
+        seen = [c.code for c in codes]
+        while cursor:
+            codes, cursor = await backend.list_discount_codes(limit=2, cursor=cursor)
+            seen += [c.code for c in codes]
+        assert seen == [f"SAVE-{i}" for i in range(5)]
+        for status, expected in (("expired", ["SAVE-0", "SAVE-1"]), ("used", ["SAVE-2"]),
+                                 ("unused", ["SAVE-3", "SAVE-4"])):
+            codes, _ = await backend.list_discount_codes(status=status)
+            assert [c.code for c in codes] == expected
+
+        # Expired codes older than retention go; the recently used one stays
+        assert await backend.compact_discount_codes(now, timedelta(days=9, hours=12)) == (2, 1)
+        assert await backend.compact_discount_codes(now, timedelta(days=9, hours=12)) == (0, 0)
+        codes, _ = await backend.list_discount_codes()
+        assert [c.code for c in codes] == ["SAVE-1", "SAVE-2", "SAVE-3", "SAVE-4"]
+        stats = await backend.get_statistics()
+        assert (stats["used_discount_codes"], stats["unused_discount_codes"],
+                stats["expired_discount_codes"], stats["compacted_discount_codes"]) == (1, 2, 2, 1)
+
+    asyncio.run(run())
+
+def test_backend_compacts_discount_codes_in_batches(backend):
+    from datetime import datetime, timedelta
+
+    async def run():
+        now = datetime.now()
+        for i in range(7):
+            expires_at = now - timedelta(days=10) if i < 5 else now + timedelta(days=1)
+            await backend.add_discount_code(DiscountCode(code=f"C{i}", order_number=i, is_used=False,
+                                                         created_at=now, expires_at=expires_at))
+        assert await backend.mark_discount_code_used("C6")
+        for status, expected in (("expired", ["C2", "C3", "C4"]), ("unused", ["C5"]), ("used", ["C6"])):
+            codes, _ = await backend.list_discount_codes(status=status, cursor=await _seq_after(backend, "C1"))
+            assert [c.code for c in codes] == expected
+
+        steps = [await backend.compact_discount_codes(now, timedelta(days=1), max_batch=2) for _ in range(4)]
+        assert steps == [(2, 2), (2, 2), (1, 1), (0, 0)]
+        for status, expected in (("expired", []), ("unused", ["C5"]), ("used", ["C6"])):
+            codes, _ = await backend.list_discount_codes(status=status)
+            assert [c.code for c in codes] == expected
+        stats = await backend.get_statistics()
+        assert (stats["unused_discount_codes"], stats["expired_discount_codes"],
+                stats["compacted_discount_codes"]) == (1, 5, 5)
+
+    asyncio.run(run())
+
+async def _seq_after(backend, code):
+    """The cursor that follows code in the unfiltered listing"""
+    cursor = None
+    while True:
+        codes, next_cursor = await backend.list_discount_codes(limit=1, cursor=cursor)
+        if codes[0].code == code:
+            return next_cursor
+        cursor = next_cursor
+
+def test_expired_discount_code_rejected_and_stats_constant_size():
+    from datetime import datetime, timedelta
+    now = datetime.now()
+    store.add_discount_code(DiscountCode(code="OLD", order_number=3, is_used=False,
+                                         created_at=now - timedelta(days=40), expires_at=now - timedelta(days=10)))
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+    response = client.post("/checkout", json={"cart_id": cart_id, "discount_code": "OLD"})
+    assert response.status_code == 400 and "expired" in response.json()["detail"]
+
+    assert [c["code"] for c in client.get("/admin/discount-codes?status=expired").json()["items"]] == ["OLD"]
+    assert client.get("/admin/discount-codes?cursor=abc").status_code == 400
+    assert client.post("/admin/discount-codes/compact").json() == {"expired": 1, "compacted": 1}
+    stats = client.get("/admin/statistics").json()
+    assert "discount_codes" not in stats
+    assert stats["expired_discount_codes"] == 1 and stats["unused_discount_codes"] == 0
+    assert client.get("/admin/discount-codes").json() == {"items": [], "next_cursor": None, "limit": 50}
+
+def test_catalog_import_replaces_catalog_atomically():
+    products, index = store.products, store.catalog_index
+    cart_id = client.post("/cart").json()["id"]
+    client.post(f"/cart/{cart_id}/items", json={"product_id": "1", "quantity": 1})
+    assert client.get("/products").status_code == 200
+    body = "\n".join([
+        json.dumps({"id": "sku-1", "name": "Trail Shoe", "price": 89.5, "description": "Grippy trail running shoe",
+                    "image_url": "https://example.com/1.jpg"}),
+        json.dumps({"id": "sku-2", "name": "Road Shoe", "price": -1, "description": "Light road shoe",
+                    "image_url": "https://example.com/2.jpg"}),
+        "{not json",
+        json.dumps({"id": "sku-3", "name": "Trail Sock", "price": 9.0, "description": "Merino sock",
+                    "image_url": "https://example.com/3.jpg"}),
+    ])
+    try:
+        result = client.post("/admin/catalog/import", content=body).json()
+        assert (result["products"], result["rows"], result["rejected"]) == (2, 4, 2)
+        assert [error["line"] for error in result["errors"]] == [2, 3]
+
+        # Listing cache, serialised catalog and search index all see the new catalog
+        assert sorted(p["id"] for p in client.get("/products").json()) == ["sku-1", "sku-3"]
+        assert [p["id"] for p in client.get("/products/search", params={"q": "shoe"}).json()["items"]] == ["sku-1"]
+        assert client.get("/products/1").status_code == 404
+        assert client.post("/checkout", json={"cart_id": cart_id}).status_code == 409
+
+        csv_body = "id,name,price,description,image_url\nsku-4,Insole,12.5,Foam insole,https://example.com/4.jpg\n"
+        result = client.post("/admin/catalog/import?format=csv&mode=merge", content=csv_body).json()
+        assert result["products"] == 3
+        assert client.get("/products/sku-4").json()["price"] == 12.5
+
+        # Too many bad rows - refused whole, catalog untouched
+        bad = "\n".join("{}" for _ in range(102))
+        assert client.post("/admin/catalog/import", content=bad).status_code == 422
+        assert len(store.products) == 3
+    finally:
+        asyncio.run(store.replace_catalog(products, index))
+        ttl_cache.clear()
+
+def test_catalog_replacement_replays_from_wal(tmp_path):
+    from models.schemas import Product
+    from store.catalog_import import load_catalog
+    import io
+
+    durable = InMemoryStore()
+    durable.open_wal(str(tmp_path))
+    lines = "".join(
+        json.dumps({"id": f"p{i}", "name": f"Item {i}", "price": i + 1, "description": "Bulk item",
+                    "image_url": f"https://example.com/{i}.jpg"}) + "\n"
+        for i in range(12)
+    )
+    loaded = load_catalog(io.StringIO(lines), "jsonl", batch_size=5)
+    # Each product has its own fields set, so assigning to one leaves the rest alone
+    first, second = loaded.products["p0"], loaded.products["p1"]
+    assert first.__pydantic_fields_set__ == set(Product.model_fields)
+    assert first.__pydantic_fields_set__ is not second.__pydantic_fields_set__
+
+    async def replace():
+        durable.wal.start()
+        fsyncs = durable.wal.fsync_count
+        await durable.replace_catalog(loaded.products, loaded.index, log_batch=5)
+        # Three batches written out as they were logged, one fsync at the commit
+        assert durable.wal.fsync_count == fsyncs + 1
+        await durable.wal.stop()
+    asyncio.run(replace())
+    durable.wal.close()
+
+    recovered = InMemoryStore()
+    recovered.recover(str(tmp_path))
+    assert sorted(recovered.products) == sorted(f"p{i}" for i in range(12))
+    assert recovered.catalog_index.search("item", limit=20)[1] == 12
+
+def test_snapshot_during_catalog_replacement_keeps_it(tmp_path):
+    from store.catalog_import import load_catalog
+    import io
+
+    durable = InMemoryStore()
+    durable.open_wal(str(tmp_path))
+    lines = "".join(
+        json.dumps({"id": f"p{i}", "name": f"Item {i}", "price": i + 1, "description": "Bulk item",
+                    "image_url": f"https://example.com/{i}.jpg"}) + "\n"
+        for i in range(12)
+    )
+    loaded = load_catalog(io.StringIO(lines), "jsonl", batch_size=5)
+
+    async def run():
+        durable.wal.start()
+        replacing = asyncio.create_task(durable.replace_catalog(loaded.products, loaded.index, log_batch=5))
+        # Let the import log its first batch, then snapshot while it is still writing
+        await asyncio.sleep(0)
+        await durable.snapshot()
+        await replacing
+        await durable.wal.stop()
+    asyncio.run(run())
+    durable.wal.close()
+
+    recovered = InMemoryStore()
+    recovered.recover(str(tmp_path))
+    assert sorted(recovered.products) == sorted(f"p{i}" for i in range(12))
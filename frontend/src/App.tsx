@@ -27,7 +27,7 @@ function App() {
     checkout
   } = useCart()
 
-  const { statistics, loadStatistics } = useAdmin()
+  const { statistics, discountCodes, loadStatistics } = useAdmin()
 
   const handleToggleAdmin = () => {
     setShowAdmin(!showAdmin)
@@ -63,7 +63,7 @@ function App() {
         </div>
       ) : (
         <Suspense fallback={<LoadingSpinner />}>
-          <AdminDashboard statistics={statistics} />
+          <AdminDashboard statistics={statistics} discountCodes={discountCodes} />
         </Suspense>
       )}
 
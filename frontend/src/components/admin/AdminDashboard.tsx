@@ -1,13 +1,14 @@
-import type { Statistics } from '../../types'
+import type { DiscountCodeInfo, Statistics } from '../../types'
 import { StatCard } from './StatCard'
 import { DiscountCodeList } from './DiscountCodeList'
 import { Package, ShoppingCart, TrendingUp, Gift } from 'lucide-react'
 
 interface AdminDashboardProps {
     statistics: Statistics | null
+    discountCodes: DiscountCodeInfo[]
 }
 
-export const AdminDashboard = ({ statistics }: AdminDashboardProps) => {
+export const AdminDashboard = ({ statistics, discountCodes }: AdminDashboardProps) => {
     if (!statistics) return null
 
     return (
@@ -37,7 +38,7 @@ export const AdminDashboard = ({ statistics }: AdminDashboardProps) => {
             </div>
 
             <DiscountCodeList
-                discountCodes={statistics.discount_codes}
+                discountCodes={discountCodes}
                 nthOrderValue={statistics.nth_order_value}
             />
         </div>
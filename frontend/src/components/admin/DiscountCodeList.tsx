@@ -5,6 +5,12 @@ interface DiscountCodeListProps {
     nthOrderValue: number
 }
 
+const codeStatus = (code: DiscountCodeInfo) => {
+    if (code.is_used) return { label: 'Used', className: 'badge badge-error' }
+    if (code.expires_at && new Date(code.expires_at) <= new Date()) return { label: 'Expired', className: 'badge badge-error' }
+    return { label: 'Available', className: 'badge badge-success' }
+}
+
 export const DiscountCodeList = ({ discountCodes, nthOrderValue }: DiscountCodeListProps) => {
     return (
         <div style={{ marginTop: '3rem' }}>
@@ -16,21 +22,24 @@ export const DiscountCodeList = ({ discountCodes, nthOrderValue }: DiscountCodeL
                 <p className="loading">No discount codes generated yet</p>
             ) : (
                 <div className="discount-code-list">
-                    {discountCodes.map(code => (
-                        <div key={code.code} className="discount-code-item">
-                            <div>
-                                <div style={{ fontWeight: '600', marginBottom: '0.25rem' }}>
-                                    {code.code}
-                                </div>
-                                <div style={{ fontSize: '0.85rem', color: 'var(--text-secondary)' }}>
-                                    Generated on order #{code.order_number}
+                    {discountCodes.map(code => {
+                        const status = codeStatus(code)
+                        return (
+                            <div key={code.code} className="discount-code-item">
+                                <div>
+                                    <div style={{ fontWeight: '600', marginBottom: '0.25rem' }}>
+                                        {code.code}
+                                    </div>
+                                    <div style={{ fontSize: '0.85rem', color: 'var(--text-secondary)' }}>
+                                        Generated on order #{code.order_number}
+                                    </div>
                                 </div>
+                                <span className={status.className}>
+                                    {status.label}
+                                </span>
                             </div>
-                            <span className={code.is_used ? 'badge badge-error' : 'badge badge-success'}>
-                                {code.is_used ? 'Used' : 'Available'}
-                            </span>
-                        </div>
-                    ))}
+                        )
+                    })}
                 </div>
             )}
         </div>
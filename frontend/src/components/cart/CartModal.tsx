@@ -40,9 +40,8 @@ const CartModalComponent = ({
 
     const fetchAvailableCodes = async () => {
         try {
-            const res = await adminApi.getStatistics()
-            const unused = res.data.discount_codes.filter(code => !code.is_used)
-            setAvailableCodes(unused)
+            const res = await adminApi.getDiscountCodes({ status: 'unused' })
+            setAvailableCodes(res.data.items)
         } catch (error) {
             console.error('Error fetching discount codes:', error)
         }
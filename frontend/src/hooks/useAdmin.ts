@@ -1,15 +1,20 @@
 import { useState } from 'react'
-import type { Statistics } from '../types'
+import type { DiscountCodeInfo, Statistics } from '../types'
 import { adminApi } from '../services/api'
 
 // Admin hook - manages statistics and discount code generation
 export const useAdmin = () => {
     const [statistics, setStatistics] = useState<Statistics | null>(null)
+    const [discountCodes, setDiscountCodes] = useState<DiscountCodeInfo[]>([])
 
     const loadStatistics = async () => {
         try {
-            const res = await adminApi.getStatistics()
-            setStatistics(res.data)
+            const [stats, codes] = await Promise.all([
+                adminApi.getStatistics(),
+                adminApi.getDiscountCodes({ limit: 100 })
+            ])
+            setStatistics(stats.data)
+            setDiscountCodes(codes.data.items)
         } catch (error) {
             console.error('Error loading statistics:', error)
         }
@@ -17,6 +22,7 @@ export const useAdmin = () => {
 
     return {
         statistics,
+        discountCodes,
         loadStatistics
     }
 }
@@ -78,8 +78,9 @@ export const useCart = () => {
             messageTimeoutRef.current = setTimeout(() => {
                 setMessage({ type: '', text: '' })
             }, 3000)
-        } catch (error) {
-            setMessage({ type: 'error', text: 'Failed to add item to cart' })
+        } catch (error: any) {
+            // 409 carries how many units are still available
+            setMessage({ type: 'error', text: error.response?.data?.detail || 'Failed to add item to cart' })
         }
     }, [cart])
 
@@ -1,5 +1,5 @@
 import axios from 'axios'
-import type { Product, Cart, CartItem, Order, CheckoutRequest, Statistics } from '../types'
+import type { Availability, Product, ProductSearchParams, ProductSearchResult, Cart, CartItem, CartOperation, Order, OrderPage, CheckoutRequest, DiscountCodePage, Statistics } from '../types'
 
 const API_URL = '/api'
 
@@ -68,6 +68,11 @@ export const productApi = {
         return request
     },
     getById: (id: string) => api.get<Product>(`/products/${id}`),
+    // Server-side search - avoids fetching the whole catalog to filter it
+    search: (params: ProductSearchParams) =>
+        api.get<ProductSearchResult>('/products/search', { params }),
+    // Live stock of tracked products - not cached, holds change constantly
+    getAvailability: () => api.get<Availability[]>('/products/availability'),
 }
 
 export const cartApi = {
@@ -79,16 +84,24 @@ export const cartApi = {
         api.put(`/cart/${cartId}/items/${productId}`, null, { params: { quantity } }),
     removeItem: (cartId: string, productId: string) =>
         api.delete(`/cart/${cartId}/items/${productId}`),
+    applyBatch: (cartId: string, operations: CartOperation[]) =>
+        api.post(`/cart/${cartId}/items:batch`, { operations }),
 }
 
 export const checkoutApi = {
-    checkout: (request: CheckoutRequest) =>
-        api.post<Order>('/checkout', request),
-    getOrders: () => api.get<Order[]>('/orders'),
+    // Reuse the same key when retrying so the order is only placed once
+    checkout: (request: CheckoutRequest, idempotencyKey?: string) =>
+        api.post<Order>('/checkout', request,
+            idempotencyKey ? { headers: { 'Idempotency-Key': idempotencyKey } } : undefined),
+    getOrders: (params?: { limit?: number, cursor?: string, created_from?: string, created_to?: string, cart_id?: string, product_id?: string }) =>
+        api.get<OrderPage>('/orders', { params }),
     getOrderById: (id: string) => api.get<Order>(`/orders/${id}`),
 }
 
 export const adminApi = {
     getStatistics: () => api.get<Statistics>('/admin/statistics'),
     generateDiscount: () => api.post('/admin/generate-discount'),
+    // Paged - statistics only carry the counts
+    getDiscountCodes: (params?: { status?: 'used' | 'unused' | 'expired', limit?: number, cursor?: string }) =>
+        api.get<DiscountCodePage>('/admin/discount-codes', { params }),
 }
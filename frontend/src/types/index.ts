@@ -6,11 +6,40 @@ export interface Product {
     image_url: string
 }
 
+export interface ProductSearchParams {
+    q?: string
+    min_price?: number
+    max_price?: number
+    sort?: 'relevance' | 'price_asc' | 'price_desc' | 'name'
+    offset?: number
+    limit?: number
+}
+
+export interface ProductSearchResult {
+    items: Product[]
+    total: number
+    offset: number
+    limit: number
+}
+
+export interface Availability {
+    product_id: string
+    on_hand: number
+    reserved: number
+    available: number
+}
+
 export interface CartItem {
     product_id: string
     quantity: number
 }
 
+export interface CartOperation {
+    op: 'add' | 'update' | 'remove'
+    product_id: string
+    quantity?: number
+}
+
 export interface Cart {
     id: string
     items: CartItem[]
@@ -28,11 +57,25 @@ export interface Order {
     created_at: string
 }
 
+export interface OrderPage {
+    items: Order[]
+    next_cursor: string | null
+    limit: number
+}
+
 export interface DiscountCodeInfo {
     code: string
     order_number: number
     is_used: boolean
     created_at: string
+    expires_at: string | null
+    used_at: string | null
+}
+
+export interface DiscountCodePage {
+    items: DiscountCodeInfo[]
+    next_cursor: string | null
+    limit: number
 }
 
 export interface Statistics {
@@ -40,8 +83,10 @@ export interface Statistics {
     total_items_purchased: number
     total_purchase_amount: number
     total_discount_amount: number
+    used_discount_codes: number
+    unused_discount_codes: number
+    expired_discount_codes: number
     nth_order_value: number
-    discount_codes: DiscountCodeInfo[]
 }
 
 export interface Message {